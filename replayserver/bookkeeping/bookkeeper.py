@@ -1,25 +1,48 @@
 from replayserver.errors import BookkeepingError
 from replayserver.bookkeeping.storage import ReplaySaver
 from replayserver.bookkeeping.database import ReplayDatabaseQueries
+from replayserver.bookkeeping.executor import SaveExecutor
+from replayserver.bookkeeping.commit import ReplayCommitter
+from replayserver.bookkeeping.spool import SaveSpool
 from replayserver.logging import logger
 from replayserver import metrics
 
 
 class Bookkeeper:
-    def __init__(self, queries, saver):
+    def __init__(self, queries, saver, spool):
         self._queries = queries
         self._saver = saver
+        self._spool = spool
 
     @classmethod
     def build(cls, database, **config):
-        queries = ReplayDatabaseQueries(database)
-        saver = ReplaySaver.build(queries, **config)
-        return cls(queries, saver)
+        queries = ReplayDatabaseQueries.build(database, **config)
+        executor = SaveExecutor.build(**config)
+        committer = ReplayCommitter.build(executor, **config)
+        saver = ReplaySaver.build(queries, executor, committer, **config)
+        spool = SaveSpool.build(saver, executor, committer, **config)
+        return cls(queries, saver, spool)
+
+    async def start(self):
+        if self._spool is not None:
+            await self._spool.start()
+
+    async def stop(self):
+        if self._spool is not None:
+            await self._spool.stop()
+
+    def prepare_replay(self, game_id, stream):
+        self._saver.prepare_replay(game_id, stream)
 
     async def save_replay(self, game_id, stream):
         try:
+            if self._spool is not None:
+                await self._spool.add(game_id, stream)
+                logger.debug(f"Spooled replay {game_id}")
+                return
             logger.debug(f"Saving replay {game_id}")
-            await self._saver.save_replay(game_id, stream)
+            with metrics.track(metrics.saves_in_progress):
+                await self._saver.save_replay(game_id, stream)
             logger.debug(f"Saved replay {game_id}")
             metrics.saved_replays.inc()
         except BookkeepingError as e:
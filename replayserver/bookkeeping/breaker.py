@@ -0,0 +1,134 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from enum import Enum
+
+from replayserver.errors import BookkeepingError, \
+    DatabaseConnectionError, DatabaseUnavailableError
+from replayserver.logging import logger
+from replayserver import metrics
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Stops running database queries for a while once enough of them fail or
+    are slow, so that callers fail fast instead of all waiting on a
+    struggling database.
+
+    Once 'failures' queries failed to reach the database or took longer than
+    slow_call_time within 'window' seconds, the breaker opens and rejects
+    all queries for 'cooldown' seconds. After that a single probe query is
+    let through. If it succeeds, we close the breaker again, otherwise we
+    stay open for another cooldown.
+
+    Errors in the queries themselves (e.g. a missing table) say nothing
+    about database health, so they don't count as failures.
+    """
+    def __init__(self, failures, slow_call_time, window, cooldown):
+        self._failures = failures
+        self._slow_call_time = slow_call_time
+        self._window = window
+        self._cooldown = cooldown
+        self._failure_times = deque()
+        self._state = BreakerState.CLOSED
+        self._opened_at = None
+        self._probing = False
+
+    @classmethod
+    def build(cls, *, config_db_breaker_failures,
+              config_db_breaker_slow_query_time, config_db_breaker_window,
+              config_db_breaker_cooldown, **kwargs):
+        if config_db_breaker_failures <= 0:
+            return None
+        return cls(config_db_breaker_failures,
+                   config_db_breaker_slow_query_time,
+                   config_db_breaker_window, config_db_breaker_cooldown)
+
+    @property
+    def state(self):
+        return self._state
+
+    @contextmanager
+    def call(self):
+        """
+        Guards a single query. Raises DatabaseUnavailableError right away if
+        the breaker is open. DatabaseConnectionErrors raised inside count as
+        failures, other BookkeepingErrors are treated as answered queries.
+        """
+        self._before_call()
+        start = time.monotonic()
+        try:
+            yield
+        except DatabaseConnectionError:
+            self._on_failure()
+            raise
+        except BookkeepingError:
+            self._on_answered(start)
+            raise
+        except BaseException:
+            # Cancelled, don't hold the probe slot hostage
+            self._probing = False
+            raise
+        self._on_answered(start)
+
+    def _on_answered(self, start):
+        if time.monotonic() - start > self._slow_call_time:
+            self._on_failure()
+        else:
+            self._on_success()
+
+    def _before_call(self):
+        if self._state == BreakerState.OPEN:
+            if time.monotonic() - self._opened_at < self._cooldown:
+                self._reject()
+            self._set_state(BreakerState.HALF_OPEN)
+        if self._state == BreakerState.HALF_OPEN:
+            if self._probing:
+                self._reject()
+            self._probing = True
+
+    def _reject(self):
+        metrics.db_breaker_rejected_queries.inc()
+        raise DatabaseUnavailableError(
+            "Database circuit breaker is open, not running query")
+
+    def _on_success(self):
+        if self._state == BreakerState.HALF_OPEN:
+            self._probing = False
+            self._failure_times.clear()
+            self._set_state(BreakerState.CLOSED)
+            logger.info("Database is responsive again, closed circuit breaker")
+
+    def _on_failure(self):
+        now = time.monotonic()
+        if self._state == BreakerState.HALF_OPEN:
+            self._probing = False
+            self._open(now)
+            return
+        if self._state == BreakerState.OPEN:
+            return  # Started before we opened
+        self._failure_times.append(now)
+        while self._failure_times[0] < now - self._window:
+            self._failure_times.popleft()
+        if len(self._failure_times) >= self._failures:
+            self._open(now)
+            logger.warning(
+                f"{len(self._failure_times)} database queries failed or "
+                f"were slow in {self._window}s, opening circuit breaker for "
+                f"{self._cooldown}s")
+
+    def _open(self, now):
+        self._opened_at = now
+        self._failure_times.clear()
+        self._set_state(BreakerState.OPEN)
+
+    def _set_state(self, state):
+        self._state = state
+        for s in BreakerState:
+            metrics.db_breaker_state.labels(state=s.value).set(s == state)
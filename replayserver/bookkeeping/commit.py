@@ -0,0 +1,125 @@
+import asyncio
+import os
+from enum import Enum
+
+from replayserver.logging import logger
+
+
+class SaveDurability(Enum):
+    NONE = "none"       # Leave flushing files to the OS
+    FSYNC = "fsync"     # Fsync every saved replay right away
+    GROUP = "group"     # Sync replays saved in a short window together
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove_leftover(tmpfile):
+    try:
+        os.remove(tmpfile)
+    except OSError:
+        pass
+
+
+class ReplayCommitter:
+    """
+    Moves fully written replay files into place, so that a crash never
+    leaves a partially written replay behind.
+
+    Depending on durability mode, files (and directories they're renamed in)
+    are also synced to disk. In group mode, we gather files to commit for a
+    set interval and commit them in a single executor job. The job fsyncs
+    all files of the group, renames them and then fsyncs each directory
+    they landed in once, so hundreds of games ending at once don't wait in
+    line for an executor job each.
+    """
+    def __init__(self, executor, durability, group_interval):
+        self._executor = executor
+        self._durability = durability
+        self._group_interval = group_interval
+        self._pending = None
+
+    @classmethod
+    def build(cls, executor, *, config_save_durability,
+              config_save_group_commit_interval, **kwargs):
+        return cls(executor, config_save_durability,
+                   config_save_group_commit_interval / 1000)
+
+    async def commit(self, tmpfile, rfile):
+        """
+        Rename tmpfile to rfile, syncing it to disk if configured to.
+        Raises OSError on failure.
+        """
+        if self._durability is SaveDurability.GROUP:
+            await self._commit_in_group(tmpfile, rfile)
+            return
+        sync = self._durability is SaveDurability.FSYNC
+        error, = await self._executor.run(
+            "commit", self._commit_files, [(tmpfile, rfile)], sync)
+        if error is not None:
+            raise error
+
+    async def _commit_in_group(self, tmpfile, rfile):
+        if self._pending is None:
+            self._pending = []
+            loop = asyncio.get_event_loop()
+            loop.call_later(self._group_interval, self._start_group_commit)
+        done = asyncio.get_event_loop().create_future()
+        self._pending.append((tmpfile, rfile, done))
+        await done
+
+    def _start_group_commit(self):
+        group, self._pending = self._pending, None
+        asyncio.ensure_future(self._run_group_commit(group))
+
+    async def _run_group_commit(self, group):
+        files = [(tmpfile, rfile) for tmpfile, rfile, _ in group]
+        try:
+            errors = await self._executor.run(
+                "commit", self._commit_group, files)
+        except Exception as e:
+            errors = [e] * len(group)
+        for (_, _, done), error in zip(group, errors):
+            if done.cancelled():
+                continue
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
+
+    def _commit_group(self, files):
+        return self._commit_files(files, True)
+
+    def _commit_files(self, files, sync):
+        # Data of all files hits the disk before any of them is renamed, so
+        # a crash can't leave a partial replay under its final name
+        errors = [None] * len(files)
+        if sync:
+            for i, (tmpfile, _) in enumerate(files):
+                try:
+                    _fsync_path(tmpfile)
+                except OSError as e:
+                    errors[i] = e
+        dirs = set()
+        for i, (tmpfile, rfile) in enumerate(files):
+            if errors[i] is not None:
+                _remove_leftover(tmpfile)
+                continue
+            try:
+                os.replace(tmpfile, rfile)
+                dirs.add(os.path.dirname(rfile))
+            except OSError as e:
+                errors[i] = e
+                _remove_leftover(tmpfile)
+        if sync:
+            for d in dirs:
+                try:
+                    _fsync_path(d)
+                except OSError as e:
+                    logger.warning(f"Failed to sync directory {d}: {e}")
+        return errors
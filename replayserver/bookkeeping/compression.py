@@ -0,0 +1,239 @@
+import asyncio
+import struct
+import zlib
+from collections import deque
+
+from replayserver.logging import logger
+
+
+WINDOW_SIZE = 32 * 1024
+
+
+class ReplayCompressor:
+    """
+    Compresses header and data of a replay stream as they arrive, so that
+    saving a replay only has to flush the tail of compressed data instead of
+    compressing the whole replay at once.
+
+    Compression runs in the compression executor, in batches of at most
+    batch_size bytes, so we never hog a thread for long or hold a big extra
+    copy of data when we fall behind. A task compresses data only while there
+    is some to compress. In between, we wait for more with a stream data
+    callback.
+    """
+    def __init__(self, stream, executor, batch_size, level):
+        self._stream = stream
+        self._executor = executor
+        self._batch_size = batch_size
+        self._level = level
+        # Compressor state takes a few hundred KB, only make it once needed
+        self._compressor = None
+        self._compressed = []
+        self._length = 0
+        self._position = None   # None until header is compressed
+        self._done = asyncio.get_event_loop().create_future()
+        self._on_stream_changed()
+
+    @classmethod
+    def build(cls, stream, executor, *,
+              config_replay_compression_batch_size,
+              config_replay_compression_level,
+              config_replay_compression_workers,
+              config_replay_compression_min_block_size, **kwargs):
+        if config_replay_compression_workers > 1:
+            return ParallelReplayCompressor(
+                stream, executor, config_replay_compression_batch_size,
+                config_replay_compression_level,
+                config_replay_compression_workers,
+                config_replay_compression_min_block_size)
+        return cls(stream, executor, config_replay_compression_batch_size,
+                   config_replay_compression_level)
+
+    def _on_stream_changed(self):
+        if self._has_work():
+            asyncio.ensure_future(self._compress_available())
+        else:
+            self._stream.add_data_callback(self._on_stream_changed)
+
+    def _has_work(self):
+        if self._stream.ended():
+            return True
+        if self._position is None:
+            return self._stream.header is not None
+        return self._can_compress(len(self._stream.data) - self._position)
+
+    def _can_compress(self, pending):
+        return pending > 0
+
+    async def _compress_available(self):
+        try:
+            finished = await self._compress_batches()
+        except Exception as e:
+            logger.exception("Failed to compress replay")
+            if not self._done.done():
+                self._done.set_exception(e)
+                # Logged already, so don't complain if finish() never comes
+                self._done.exception()
+            return
+        if not finished:
+            self._stream.add_data_callback(self._on_stream_changed)
+            return
+        self._stream = None     # Let go of replay data, we're done with it
+        if not self._done.done():
+            self._done.set_result(None)
+
+    async def _compress_batches(self):
+        # Returns True once the whole stream is compressed
+        if self._position is None:
+            header = self._stream.header
+            if header is None:      # Stream ended without one
+                return True
+            await self._compress([header.data])
+            self._position = 0
+        while True:
+            data_length = len(self._stream.data)
+            if self._can_compress(data_length - self._position):
+                end = min(data_length, self._position + self._batch_size)
+                # Gather chunks here, buffer can change in the meantime
+                await self._compress(
+                    list(self._stream.data.chunks(self._position, end)))
+                self._position = end
+            elif self._stream.ended():
+                await self._compressed_everything()
+                return True
+            else:
+                return False
+
+    async def _compress(self, chunks):
+        compressed = await self._executor.run(
+            "compress", self._compress_chunks, chunks)
+        self._compressed.append(compressed)
+        self._length += sum(len(chunk) for chunk in chunks)
+
+    def _zlib_compressor(self):
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self._level)
+        return self._compressor
+
+    def _compress_chunks(self, chunks):
+        compressor = self._zlib_compressor()
+        return b"".join(compressor.compress(chunk) for chunk in chunks)
+
+    async def _compressed_everything(self):
+        pass
+
+    def _flush(self):
+        return self._zlib_compressor().flush()
+
+    async def wait_for_stream_done(self):
+        """
+        Wait until we won't read the stream anymore, whether we compressed
+        all of it or failed to.
+        """
+        await asyncio.wait([self._done])
+
+    async def finish(self):
+        """
+        Wait until the stream ends and all of it is compressed. Returns length
+        of uncompressed replay (header included) and a list of chunks of
+        zlib-compressed replay.
+        """
+        await self._done
+        self._compressed.append(self._flush())
+        compressed, self._compressed = self._compressed, []
+        return self._length, compressed
+
+
+class ParallelReplayCompressor(ReplayCompressor):
+    """
+    Compresses batches of replay data in parallel, like pigz does. Every
+    batch is compressed separately into raw deflate data, using last 32KB
+    of data before it as a preset dictionary, so we lose almost nothing
+    compared to compressing data in one go. Batches end with a sync flush,
+    so they can be just concatenated. We wrap them in a zlib header and a
+    checksum we calculate ourselves, so the result is a plain zlib stream.
+
+    At most 'workers' batches of a replay are compressed at once. The
+    compression executor needs that many threads to make use of it.
+
+    Every batch costs a sync flush and an executor job, so until the stream
+    ends we wait for at least min_block_size bytes of data before
+    compressing. Otherwise a trickle of small writes would be compressed as
+    many tiny blocks.
+    """
+    def __init__(self, stream, executor, batch_size, level, workers,
+                 min_block_size):
+        self._workers = workers
+        self._min_block_size = min(min_block_size, batch_size)
+        self._in_progress = deque()
+        self._window = b""
+        self._checksum = zlib.adler32(b"")
+        ReplayCompressor.__init__(self, stream, executor, batch_size, level)
+        self._compressed.append(self._zlib_header(level))
+
+    @staticmethod
+    def _zlib_header(level):
+        cmf = 0x78      # Deflate with 32KB window
+        if level < 0:   # Default
+            level = 6
+        if level < 2:
+            flevel = 0
+        elif level < 6:
+            flevel = 1
+        elif level == 6:
+            flevel = 2
+        else:
+            flevel = 3
+        flg = flevel << 6
+        flg += 31 - (cmf * 256 + flg) % 31
+        return bytes([cmf, flg])
+
+    def _can_compress(self, pending):
+        return pending > 0 and (pending >= self._min_block_size or
+                                self._stream.ended())
+
+    async def _compress(self, chunks):
+        if len(self._in_progress) >= self._workers:
+            await self._collect_oldest()
+        job = self._executor.run("compress", self._compress_batch,
+                                 chunks, self._window)
+        self._in_progress.append(asyncio.ensure_future(job))
+        for chunk in chunks:
+            self._checksum = zlib.adler32(chunk, self._checksum)
+            self._length += len(chunk)
+        self._window = self._last_window(chunks)
+
+    def _last_window(self, chunks):
+        tail = []
+        tail_length = 0
+        for chunk in reversed(chunks):
+            if tail_length >= WINDOW_SIZE:
+                break
+            tail.append(chunk)
+            tail_length += len(chunk)
+        if tail_length < WINDOW_SIZE:
+            tail.append(self._window)
+        return b"".join(reversed(tail))[-WINDOW_SIZE:]
+
+    def _compress_batch(self, chunks, window):
+        args = (self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        if window:
+            compressor = zlib.compressobj(*args, zdict=window)
+        else:
+            compressor = zlib.compressobj(*args)
+        compressed = [compressor.compress(chunk) for chunk in chunks]
+        compressed.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+        return b"".join(compressed)
+
+    async def _collect_oldest(self):
+        job = self._in_progress.popleft()
+        self._compressed.append(await job)
+
+    async def _compressed_everything(self):
+        while self._in_progress:
+            await self._collect_oldest()
+
+    def _flush(self):
+        # Empty final block, then checksum of uncompressed data
+        end = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return end.flush() + struct.pack(">I", self._checksum)
@@ -1,45 +1,94 @@
+import asyncio
+import functools
 import aiomysql
-from aiomysql import create_pool, DatabaseError
-from replayserver.errors import BookkeepingError
+from aiomysql import create_pool, DatabaseError, InterfaceError, \
+    OperationalError
+from replayserver.errors import BookkeepingError, DatabaseConnectionError
+from replayserver.bookkeeping.breaker import CircuitBreaker
+from replayserver.bookkeeping.sqlite import SqliteDatabase
 from replayserver.logging import logger
+from replayserver import metrics
 import time
+from enum import Enum
+
+
+def _timed(func):
+    """ Tracks latency of a query method in metrics. """
+    timer = metrics.db_query_duration.labels(query=func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with timer.time():
+            return await func(*args, **kwargs)
+    return wrapper
 
 
 class Database:
-    def __init__(self, pool_starter):
+    def __init__(self, pool_starter, acquire_timeout, breaker=None):
         self._pool_starter = pool_starter
+        self._acquire_timeout = acquire_timeout
+        self._breaker = breaker
         self._connection_pool = None
 
     @classmethod
     def build(cls, *, config_db_host, config_db_port, config_db_user,
-              config_db_password, config_db_name, **kwargs):
+              config_db_password, config_db_name, config_db_pool_min_size,
+              config_db_pool_max_size, config_db_pool_recycle,
+              config_db_pool_acquire_timeout, **kwargs):
 
         async def _start_pool():
             return await create_pool(host=config_db_host,
                                      port=config_db_port,
                                      user=config_db_user,
                                      password=config_db_password,
-                                     db=config_db_name)
+                                     db=config_db_name,
+                                     minsize=config_db_pool_min_size,
+                                     maxsize=config_db_pool_max_size,
+                                     pool_recycle=config_db_pool_recycle)
 
-        return cls(_start_pool)
+        breaker = CircuitBreaker.build(**kwargs)
+        return cls(_start_pool, config_db_pool_acquire_timeout, breaker)
 
     async def start(self):
         self._connection_pool = await self._pool_starter()
         logger.info("Initialized database connection pool")
 
     async def execute(self, query, params=[]):
-        if self._connection_pool is None:
+        pool = self._connection_pool
+        if pool is None:
             raise BookkeepingError("Tried to run query while pool is closed!")
+        if self._breaker is None:
+            return await self._execute(pool, query, params)
+        with self._breaker.call():
+            return await self._execute(pool, query, params)
+
+    async def _execute(self, pool, query, params):
         try:
-            async with self._connection_pool.acquire() as conn:
-                async with conn.cursor(aiomysql.DictCursor) as cur:
-                    await cur.execute(query, *params)
-                    data = await cur.fetchall()
-                await conn.commit()
+            conn = await self._acquire(pool)
+            try:
+                with metrics.track(metrics.db_connections_in_use):
+                    async with conn.cursor(aiomysql.DictCursor) as cur:
+                        await cur.execute(query, *params)
+                        data = await cur.fetchall()
+                    await conn.commit()
+            finally:
+                await pool.release(conn)
             return data
-        except (DatabaseError, RuntimeError) as e:
+        except (OperationalError, InterfaceError, RuntimeError) as e:
+            raise DatabaseConnectionError(
+                "Failed to run database query") from e
+        except DatabaseError as e:
             raise BookkeepingError("Failed to run database query") from e
 
+    async def _acquire(self, pool):
+        with metrics.db_pool_acquire_duration.time():
+            try:
+                return await asyncio.wait_for(pool.acquire(),
+                                              self._acquire_timeout)
+            except asyncio.TimeoutError:
+                raise DatabaseConnectionError(
+                    "Timed out waiting for a database connection")
+
     async def stop(self):
         self._connection_pool.close()
         await self._connection_pool.wait_closed()
@@ -47,10 +96,35 @@ class Database:
         logger.info("Closed database connection pool")
 
 
+class DatabaseBackend(Enum):
+    MYSQL = "MYSQL"
+    SQLITE = "SQLITE"
+
+    def build(self, **kwargs):
+        if self == DatabaseBackend.MYSQL:
+            return Database.build(**kwargs)
+        elif self == DatabaseBackend.SQLITE:
+            return SqliteDatabase.build(**kwargs)
+
+
+def build_database(*, config_db_backend, **kwargs):
+    return config_db_backend.build(**kwargs)
+
+
 class ReplayDatabaseQueries:
-    def __init__(self, db):
+    def __init__(self, db, mod_versions_ttl):
         self._db = db
+        # Featured mod versions only change when a mod is patched, so we
+        # cache them for a while. Concurrent lookups share one query.
+        self._mod_versions_ttl = mod_versions_ttl
+        self._mod_versions = {}     # mod -> (versions, expiry time)
+        self._mod_versions_queries = {}
+
+    @classmethod
+    def build(cls, db, *, config_db_mod_versions_cache_ttl, **kwargs):
+        return cls(db, config_db_mod_versions_cache_ttl)
 
+    @_timed
     async def get_teams_in_game(self, game_id):
         query = """
             SELECT
@@ -71,63 +145,152 @@ class ReplayDatabaseQueries:
             teams.setdefault(player['team'], []).append(player['login'])
         return teams
 
+    @_timed
+    async def get_teams_in_games(self, game_ids):
+        """
+        Gets teams of many games at once. Games with no players found are
+        missing from the result.
+        """
+        query = """
+            SELECT
+                `game_stats`.`id` AS game_id,
+                `login`.`login` AS login,
+                `game_player_stats`.`team` AS team
+            FROM `game_stats`
+            INNER JOIN `game_player_stats`
+              ON `game_player_stats`.`gameId` = `game_stats`.`id`
+            INNER JOIN `login`
+              ON `login`.id = `game_player_stats`.`playerId`
+            WHERE `game_stats`.`id` IN %s AND `game_player_stats`.`AI` = 0
+        """
+        # Tuple parameter expands to a list of values
+        players = await self._db.execute(query, ((tuple(game_ids),),))
+        games = {}
+        for player in players:
+            teams = games.setdefault(player['game_id'], {})
+            teams.setdefault(player['team'], []).append(player['login'])
+        return games
+
+    GAME_STATS_QUERY = """
+        SELECT
+            `game_stats`.`id` AS id,
+            `game_stats`.`startTime` AS start_time,
+            `game_stats`.`endTime` AS end_time,
+            `game_stats`.`gameType` AS game_type,
+            `login`.`login` AS host,
+            `game_stats`.`gameName` AS game_name,
+            `game_featuredMods`.`gamemod` AS game_mod,
+            `map`.`display_name` as map_name,
+            `map_version`.`filename` AS file_name,
+            (
+                SELECT COUNT(*) FROM `game_player_stats`
+                WHERE `game_player_stats`.`gameId` = `game_stats`.`id`
+            ) AS num_players
+        FROM `game_stats`
+        LEFT JOIN `map`
+          ON `game_stats`.`mapId` = `map`.`id`
+        LEFT JOIN `map_version`
+          ON `map_version`.`map_id` = `map`.`id`
+        LEFT JOIN `login`
+          ON `login`.id = `game_stats`.`host`
+        LEFT JOIN  `game_featuredMods`
+          ON `game_stats`.`gameMod` = `game_featuredMods`.`id`
+    """
+
+    @_timed
     async def get_game_stats(self, game_id):
         """
         Gets the game information.
         """
+        query = self.GAME_STATS_QUERY + "WHERE `game_stats`.`id` = %s"
+        game_stats = await self._db.execute(query, (game_id,))
+        if not game_stats:
+            raise BookkeepingError(f"No stats found for game {game_id}")
+        return self._game_stats_from_row(game_stats[0])
+
+    @_timed
+    async def get_many_game_stats(self, game_ids):
+        """
+        Gets information of many games at once. Games with no stats found
+        are missing from the result.
+        """
+        query = self.GAME_STATS_QUERY + "WHERE `game_stats`.`id` IN %s"
+        game_stats = await self._db.execute(query, ((tuple(game_ids),),))
+        result = {}
+        for row in game_stats:
+            # Same as for a single game, use the first row if there are more
+            if row['id'] not in result:
+                result[row['id']] = self._game_stats_from_row(row)
+        return result
+
+    @_timed
+    async def get_game_end(self, game_id):
         query = """
-            SELECT
-                `game_stats`.`startTime` AS start_time,
-                `game_stats`.`endTime` AS end_time,
-                `game_stats`.`gameType` AS game_type,
-                `login`.`login` AS host,
-                `game_stats`.`gameName` AS game_name,
-                `game_featuredMods`.`gamemod` AS game_mod,
-                `map`.`display_name` as map_name,
-                `map_version`.`filename` AS file_name
+            SELECT `game_stats`.`endTime` AS end_time
             FROM `game_stats`
-            LEFT JOIN `map`
-              ON `game_stats`.`mapId` = `map`.`id`
-            LEFT JOIN `map_version`
-              ON `map_version`.`map_id` = `map`.`id`
-            LEFT JOIN `login`
-              ON `login`.id = `game_stats`.`host`
-            LEFT JOIN  `game_featuredMods`
-              ON `game_stats`.`gameMod` = `game_featuredMods`.`id`
             WHERE `game_stats`.`id` = %s
         """
-        player_query = """
-           SELECT COUNT(*) FROM `game_player_stats`
-           WHERE `game_player_stats`.`gameId` = %s
-        """
         game_stats = await self._db.execute(query, (game_id,))
-        player_count = await self._db.execute(player_query, (game_id,))
         if not game_stats:
             raise BookkeepingError(f"No stats found for game {game_id}")
-        if not player_count:
-            raise BookkeepingError(f"No players found for game {game_id}")
-        start_time = game_stats[0]['start_time'].timestamp()
+        return self._end_timestamp(game_stats[0]['end_time'])
 
-        # We might end a replay before end_time is set in the db!
-        end_time = game_stats[0]['end_time']
-        if end_time is None:
-            end_time = time.time()
-        else:
-            end_time = end_time.timestamp()
+    def _game_stats_from_row(self, row):
         return {
-            'featured_mod': game_stats[0]['game_mod'],
-            'game_type': game_stats[0]['game_type'],
-            'recorder': game_stats[0]['host'],
-            'host': game_stats[0]['host'],
-            'launched_at': start_time,
-            'game_end': end_time,
-            'title': game_stats[0]['game_name'],
-            'mapname': game_stats[0]['map_name'],
-            'map_file_path': game_stats[0]['file_name'],
-            'num_players': player_count[0]['COUNT(*)']
+            'featured_mod': row['game_mod'],
+            'game_type': row['game_type'],
+            'recorder': row['host'],
+            'host': row['host'],
+            'launched_at': row['start_time'].timestamp(),
+            'game_end': self._end_timestamp(row['end_time']),
+            'title': row['game_name'],
+            'mapname': row['map_name'],
+            'map_file_path': row['file_name'],
+            'num_players': row['num_players']
         }
 
+    def _end_timestamp(self, end_time):
+        # We might end a replay before end_time is set in the db!
+        if end_time is None:
+            return time.time()
+        return end_time.timestamp()
+
+    @_timed
     async def get_mod_versions(self, mod):
+        cached = self._mod_versions.get(mod)
+        if cached is not None and cached[1] > time.monotonic():
+            metrics.mod_versions_cache.labels(result="hit").inc()
+            return cached[0]
+        query = self._mod_versions_queries.get(mod)
+        if query is not None:
+            metrics.mod_versions_cache.labels(result="wait").inc()
+        else:
+            result = "miss" if cached is None else "refresh"
+            metrics.mod_versions_cache.labels(result=result).inc()
+            query = asyncio.ensure_future(self._fetch_mod_versions(mod))
+            self._mod_versions_queries[mod] = query
+        # Cancelling one lookup shouldn't cancel the query for everyone
+        return await asyncio.shield(query)
+
+    async def _fetch_mod_versions(self, mod):
+        try:
+            versions = await self._query_mod_versions(mod)
+        except BookkeepingError as e:
+            cached = self._mod_versions.get(mod)
+            if cached is None:
+                raise
+            # Versions rarely change, stale ones are better than none
+            logger.warning(f"Failed to refresh {mod} versions, "
+                           f"using stale ones: {e}")
+            metrics.mod_versions_stale.inc()
+            return cached[0]
+        finally:
+            del self._mod_versions_queries[mod]
+        expiry = time.monotonic() + self._mod_versions_ttl
+        self._mod_versions[mod] = (versions, expiry)
+        return versions
+
+    async def _query_mod_versions(self, mod):
         query = """
             SELECT
                 `updates_{mod}_files`.`fileId` AS file_id,
@@ -0,0 +1,76 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from replayserver import metrics
+
+
+class SaveExecutor:
+    """
+    Runs blocking work of saving replays (compression, writing files) in its
+    own pool of threads, so it doesn't compete with other users of the
+    default executor.
+
+    At most workers + queue_size jobs are handed to the pool at once. The
+    rest wait on the event loop, so that a burst of saves (e.g. at the end of
+    a tournament round) doesn't pile up in the pool's unbounded queue.
+    """
+    THREAD_NAME = "replay-save"
+
+    def __init__(self, workers, queue_size):
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix=self.THREAD_NAME)
+        self._slots = asyncio.Semaphore(workers + queue_size)
+        self._queue_depth = metrics.save_queue_depth
+
+    @classmethod
+    def build(cls, *, config_save_executor_workers,
+              config_save_executor_queue_size, **kwargs):
+        return cls(config_save_executor_workers,
+                   config_save_executor_queue_size)
+
+    async def run(self, stage, func, *args):
+        """
+        Run func(*args) in the pool and return its result. Stage names the
+        job in metrics.
+        """
+        self._queue_depth.inc()
+        job = None
+        try:
+            async with self._slots:
+                job = self._pool.submit(self._run_job, stage, func, args)
+                return await asyncio.wrap_future(job)
+        finally:
+            # Jobs that started running already left the queue
+            if job is None or job.cancel():
+                self._queue_depth.dec()
+
+    def _run_job(self, stage, func, args):
+        self._queue_depth.dec()
+        with self._time_job(stage):
+            return func(*args)
+
+    def _time_job(self, stage):
+        return metrics.save_stage_duration.labels(stage=stage).time()
+
+
+class CompressionExecutor(SaveExecutor):
+    """
+    Pool for compressing replays while they're being written. Live games
+    keep it busy all the time, so it's kept apart from the save executor.
+    Otherwise saves at the end of a game would wait in line behind
+    compression of every other running game.
+    """
+    THREAD_NAME = "replay-compress"
+
+    def __init__(self, workers, queue_size):
+        SaveExecutor.__init__(self, workers, queue_size)
+        self._queue_depth = metrics.compression_queue_depth
+
+    @classmethod
+    def build(cls, *, config_compression_executor_workers,
+              config_compression_executor_queue_size, **kwargs):
+        return cls(config_compression_executor_workers,
+                   config_compression_executor_queue_size)
+
+    def _time_job(self, stage):
+        return metrics.compression_job_duration.time()
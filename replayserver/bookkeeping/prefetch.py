@@ -0,0 +1,92 @@
+import asyncio
+import collections
+
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger
+
+
+class MetadataPrefetcher:
+    """
+    Fetches stats and teams of running games ahead of saving their replays,
+    so that saving only has to refresh game end time.
+
+    Games are fetched after a delay, to give the database time to fill in
+    game info. Games that are due within the same short window are fetched
+    together, with one query for stats and one for teams. Since the delay is
+    the same for every game, games become due in the order they were added,
+    so a queue and a single timer for its head are enough to track them.
+    """
+    def __init__(self, queries, delay, batch_window):
+        self._queries = queries
+        self._delay = delay
+        self._batch_window = batch_window
+        self._waiting = collections.deque()
+        self._timer = None
+
+    @classmethod
+    def build(cls, queries, *, config_metadata_prefetch,
+              config_metadata_prefetch_delay,
+              config_metadata_batch_window, **kwargs):
+        if not config_metadata_prefetch:
+            return None
+        return cls(queries, config_metadata_prefetch_delay,
+                   config_metadata_batch_window / 1000)
+
+    def prefetch(self, game_id):
+        """
+        Returns a future that resolves to (game stats, teams) of a game, or
+        None if we failed to get them.
+        """
+        loop = asyncio.get_event_loop()
+        result = loop.create_future()
+        self._waiting.append((loop.time() + self._delay, game_id, result))
+        if self._timer is None:
+            self._schedule_batch()
+        return result
+
+    def _schedule_batch(self):
+        # Wait a bit longer than the first game needs, so that games due
+        # soon after it join its batch
+        due = self._waiting[0][0] + self._batch_window
+        self._timer = asyncio.get_event_loop().call_at(due, self._start_batch)
+
+    def _start_batch(self):
+        self._timer = None
+        now = asyncio.get_event_loop().time()
+        batch = {}
+        while self._waiting and self._waiting[0][0] <= now:
+            _, game_id, result = self._waiting.popleft()
+            if not result.done():
+                batch.setdefault(game_id, []).append(result)
+        if batch:
+            asyncio.ensure_future(self._fetch_batch(batch))
+        if self._waiting:
+            self._schedule_batch()
+
+    async def _fetch_batch(self, batch):
+        game_ids = list(batch.keys())
+        try:
+            game_stats, teams = await asyncio.gather(
+                self._queries.get_many_game_stats(game_ids),
+                self._queries.get_teams_in_games(game_ids))
+        except BookkeepingError as e:
+            logger.debug(f"Failed to prefetch info of games {game_ids}: {e}")
+        except Exception:
+            logger.exception(f"Unexpected error prefetching info of games "
+                             f"{game_ids}")
+        else:
+            for game_id, results in batch.items():
+                if game_id in game_stats and game_id in teams:
+                    info = (game_stats[game_id], teams[game_id])
+                    self._resolve(results, info)
+                else:
+                    logger.debug(f"No info found for game {game_id}")
+        finally:
+            # Whatever happened, nobody should wait for us forever
+            for results in batch.values():
+                self._resolve(results, None)
+
+    def _resolve(self, results, info):
+        for result in results:
+            if not result.done():
+                result.set_result(info)
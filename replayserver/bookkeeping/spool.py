@@ -0,0 +1,268 @@
+import asyncio
+import os
+import time
+
+from replayserver.errors import BookkeepingError, \
+    DatabaseConnectionError, DatabaseUnavailableError
+from replayserver.logging import logger
+from replayserver.receive.stream import OutsideSourceReplayStream
+from replayserver.struct.header import ReplayHeader, parse_header
+from replayserver import metrics
+
+
+class SpoolEntry:
+    def __init__(self, game_id, path, size, spooled_at, header, compressor,
+                 recovered=False):
+        self.game_id = game_id
+        self.path = path    # None if we failed to spool it
+        self.size = size
+        self.spooled_at = spooled_at
+        self.header = header
+        self.compressor = compressor
+        self.recovered = recovered  # Left over from a previous run
+
+
+class SaveSpool:
+    """
+    Keeps raw data of ended replays on local disk until they're saved.
+    Replays are spooled right away and saved by background tasks, which
+    retry fetching replay metadata with exponential backoff while the
+    database is unreachable. If it stays unreachable, they're saved with
+    what little metadata the header has. This way neither replay lifetime
+    nor replay data depends on the database being available at the time.
+
+    Replays left in the spool by a previous run are saved on start, a few
+    at a time, so we don't read a big backlog into memory at once. Replays
+    we give up on are kept in the spool with a ".failed" suffix.
+    """
+    SUFFIX = ".spool"
+    RECOVERY_BATCH = 8
+
+    def __init__(self, directory, saver, executor, committer, retry_delay,
+                 retry_max_delay, retry_attempts):
+        self._directory = directory
+        self._saver = saver
+        self._executor = executor
+        self._committer = committer
+        self._retry_delay = retry_delay
+        self._retry_max_delay = retry_max_delay
+        self._retry_attempts = retry_attempts
+        self._entries = set()
+        self._tasks = set()
+        metrics.spool_oldest_age.set_function(self._oldest_age)
+
+    @classmethod
+    def build(cls, saver, executor, committer, *, config_save_spool_dir,
+              config_save_retry_delay, config_save_retry_max_delay,
+              config_save_retry_attempts, **kwargs):
+        if config_save_spool_dir is None:
+            return None
+        return cls(config_save_spool_dir, saver, executor, committer,
+                   config_save_retry_delay, config_save_retry_max_delay,
+                   config_save_retry_attempts)
+
+    async def start(self):
+        """ Start saving replays left over in the spool. """
+        spooled = await self._executor.run("spool", self._list_spooled)
+        if spooled:
+            self._track(asyncio.ensure_future(self._recover_all(spooled)))
+
+    async def stop(self):
+        """
+        Give replays being saved some time to finish, then stop. Unsaved
+        replays stay in the spool for the next run.
+        """
+        tasks = list(self._tasks)
+        if not tasks:
+            return
+        await asyncio.wait(tasks, timeout=self._retry_delay)
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+    async def add(self, game_id, stream):
+        if stream.header is None:
+            self._saver.forget_replay(game_id)
+            raise BookkeepingError("Saved replay has no header")
+        compressor = self._saver.take_compressor(game_id, stream)
+        chunks = [stream.header.data] + list(stream.data.chunks())
+        path = self._path(game_id)
+        try:
+            await self._executor.run("spool", self._write_spooled,
+                                     path + ".tmp", chunks)
+            await self._committer.commit(path + ".tmp", path)
+        except IOError as e:
+            logger.error(f"Failed to spool replay {game_id}, "
+                         f"keeping it in memory: {e}")
+            path = None
+        size = sum(len(chunk) for chunk in chunks)
+        self._schedule(SpoolEntry(game_id, path, size, time.time(),
+                                  stream.header.struct, compressor))
+        # Caller may release stream data once we return. Stream ended
+        # already, so this is only the tail of compression.
+        await compressor.wait_for_stream_done()
+
+    def _path(self, game_id):
+        return os.path.join(self._directory, f"{game_id}{self.SUFFIX}")
+
+    def _write_spooled(self, path, chunks):
+        try:
+            with open(path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except IOError:
+            self._remove_file(path)
+            raise
+
+    def _list_spooled(self):
+        os.makedirs(self._directory, exist_ok=True)
+        spooled = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name.endswith(self.SUFFIX + ".tmp"):
+                self._remove_file(path)     # Never finished spooling
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                game_id = int(name[:-len(self.SUFFIX)])
+            except ValueError:
+                continue
+            spooled.append((game_id, path, os.stat(path).st_mtime))
+        return spooled
+
+    async def _recover_all(self, spooled):
+        slots = asyncio.Semaphore(self.RECOVERY_BATCH)
+        for game_id, path, mtime in spooled:
+            await slots.acquire()
+            task = await self._recover(game_id, path, mtime)
+            if task is None:
+                slots.release()
+            else:
+                task.add_done_callback(lambda _: slots.release())
+
+    async def _recover(self, game_id, path, mtime):
+        try:
+            data = await self._executor.run("spool", self._read_file, path)
+            header, length = parse_header(data, ReplayHeader.MAXLEN)
+            if header is None:
+                raise ValueError("Incomplete replay header")
+        except (IOError, ValueError) as e:
+            logger.error(f"Failed to recover spooled replay {game_id}: {e}")
+            await self._give_up(game_id, path)
+            return None
+        logger.info(f"Recovered spooled replay {game_id}")
+        stream = OutsideSourceReplayStream()
+        stream.set_header(ReplayHeader(data[:length], header))
+        stream.feed_data(memoryview(data)[length:])
+        stream.finish()
+        compressor = self._saver.take_compressor(game_id, stream)
+        return self._schedule(SpoolEntry(game_id, path, len(data), mtime,
+                                         header, compressor, recovered=True))
+
+    def _read_file(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _schedule(self, entry):
+        self._entries.add(entry)
+        metrics.spooled_replays.inc()
+        metrics.spool_size.inc(entry.size)
+        return self._track(asyncio.ensure_future(self._save(entry)))
+
+    def _track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _save(self, entry):
+        try:
+            with metrics.track(metrics.saves_in_progress):
+                await self._save_entry(entry)
+        finally:
+            self._entries.discard(entry)
+            metrics.spooled_replays.dec()
+            metrics.spool_size.dec(entry.size)
+
+    async def _save_entry(self, entry):
+        try:
+            info = await self._get_info_with_retries(entry)
+        except (DatabaseConnectionError, DatabaseUnavailableError):
+            # Out of retries. Better to save the replay with little info
+            # than to leave it unsaved.
+            info = self._get_degraded_info(entry)
+        except BookkeepingError as e:
+            logger.warning(f"Failed to get info for replay "
+                           f"{entry.game_id}: {e}")
+            # Replay only in memory would be lost if we gave up on it
+            info = None
+            if entry.path is None:
+                info = self._get_degraded_info(entry)
+        if info is None:
+            await self._give_up(entry.game_id, entry.path)
+            return
+        try:
+            await self._saver.write_replay(entry.game_id, info,
+                                           entry.compressor,
+                                           recovered=entry.recovered)
+        except BookkeepingError as e:
+            logger.warning(f"Failed to save replay {entry.game_id}: {e}")
+            await self._give_up(entry.game_id, entry.path)
+            return
+        logger.debug(f"Saved replay {entry.game_id}")
+        metrics.saved_replays.inc()
+        if entry.path is not None:
+            await self._executor.run("spool", self._remove_file, entry.path)
+
+    async def _get_info_with_retries(self, entry):
+        delay = self._retry_delay
+        for attempt in range(1, self._retry_attempts + 1):
+            try:
+                return await self._saver.get_replay_info(entry.game_id,
+                                                         entry.header)
+            except (DatabaseConnectionError, DatabaseUnavailableError) as e:
+                # Other errors are raised right away, retrying won't help
+                # with a bad query or replay
+                logger.info(f"Failed to get info for replay {entry.game_id}"
+                            f" (attempt {attempt}): {e}")
+                if attempt == self._retry_attempts:
+                    raise
+            metrics.save_retries.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self._retry_max_delay)
+
+    def _get_degraded_info(self, entry):
+        try:
+            info = self._saver.get_degraded_replay_info(entry.game_id,
+                                                        entry.header)
+        except BookkeepingError as e:
+            logger.warning(f"Failed to get info for replay "
+                           f"{entry.game_id}: {e}")
+            return None
+        logger.warning(f"Saving replay {entry.game_id} without game info")
+        metrics.degraded_saves.inc()
+        return info
+
+    async def _give_up(self, game_id, path):
+        if path is None:
+            logger.error(f"Giving up on saving replay {game_id}")
+            return
+        logger.error(f"Giving up on saving replay {game_id}, keeping its "
+                     f"data in {path}.failed")
+        try:
+            await self._executor.run("spool", os.replace, path,
+                                     path + ".failed")
+        except IOError as e:
+            logger.error(f"Failed to mark spooled replay {game_id} as "
+                         f"failed: {e}")
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _oldest_age(self):
+        if not self._entries:
+            return 0
+        oldest = min(entry.spooled_at for entry in self._entries)
+        return time.time() - oldest
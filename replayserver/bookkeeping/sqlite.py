@@ -0,0 +1,151 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger
+
+
+# Subset of faf-db schema that replay server queries touch
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS `login` (
+        `id` INTEGER PRIMARY KEY,
+        `login` TEXT NOT NULL,
+        `password` TEXT,
+        `email` TEXT
+    );
+    CREATE TABLE IF NOT EXISTS `map` (
+        `id` INTEGER PRIMARY KEY,
+        `display_name` TEXT
+    );
+    CREATE TABLE IF NOT EXISTS `map_version` (
+        `id` INTEGER PRIMARY KEY,
+        `filename` TEXT,
+        `map_id` INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS `game_featuredMods` (
+        `id` INTEGER PRIMARY KEY,
+        `gamemod` TEXT
+    );
+    CREATE TABLE IF NOT EXISTS `game_stats` (
+        `id` INTEGER PRIMARY KEY,
+        `startTime` TIMESTAMP,
+        `endTime` TIMESTAMP,
+        `gameType` TEXT,
+        `gameMod` INTEGER,
+        `host` INTEGER,
+        `mapId` INTEGER,
+        `gameName` TEXT,
+        `validity` INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS `game_player_stats` (
+        `id` INTEGER PRIMARY KEY,
+        `gameId` INTEGER,
+        `playerId` INTEGER,
+        `AI` INTEGER,
+        `team` INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS `game_player_stats_game`
+        ON `game_player_stats` (`gameId`);
+"""
+
+UPDATES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS `updates_{mod}` (
+        `id` INTEGER PRIMARY KEY,
+        `filename` TEXT,
+        `path` TEXT
+    );
+    CREATE TABLE IF NOT EXISTS `updates_{mod}_files` (
+        `id` INTEGER PRIMARY KEY,
+        `fileId` INTEGER,
+        `version` INTEGER,
+        `name` TEXT,
+        `md5` TEXT,
+        `obselete` INTEGER
+    );
+"""
+UPDATES_MODS = ["faf", "fafbeta", "fafdevelop", "coop"]
+
+
+class SqliteDatabase:
+    """
+    Stand-in for Database that keeps data in SQLite instead of MySQL, so
+    that the server can be run and load tested with no services around.
+    Tables we query are created on start.
+
+    Queries are written for MySQL, so we translate their %s placeholders,
+    and expand sequence parameters for IN clauses like aiomysql does. Every
+    query can be delayed by an artificial latency, to make the database
+    behave more like one over the network.
+    """
+    def __init__(self, path, latency):
+        self._path = path
+        self._latency = latency
+        self._conn = None
+        # SQLite calls block, keep them off the event loop
+        self._executor = ThreadPoolExecutor(
+            1, thread_name_prefix="replay-sqlite")
+
+    @classmethod
+    def build(cls, *, config_db_sqlite_path, config_db_sqlite_latency,
+              **kwargs):
+        return cls(config_db_sqlite_path, config_db_sqlite_latency / 1000)
+
+    async def start(self):
+        self._conn = await self._run(self._connect)
+        logger.info(f"Opened SQLite database at {self._path}")
+
+    def _connect(self):
+        conn = sqlite3.connect(self._path, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.row_factory = sqlite3.Row
+        schema = SCHEMA + "".join(UPDATES_SCHEMA.format(mod=mod)
+                                  for mod in UPDATES_MODS)
+        conn.executescript(schema)
+        return conn
+
+    async def execute(self, query, params=[]):
+        if self._conn is None:
+            raise BookkeepingError("Tried to run query while db is closed!")
+        if self._latency > 0:
+            await asyncio.sleep(self._latency)
+        try:
+            return await self._run(self._execute, self._conn, query, params)
+        except (sqlite3.Error, ValueError) as e:
+            raise BookkeepingError("Failed to run database query") from e
+
+    def _execute(self, conn, query, params):
+        query, values = self._translate(query, params)
+        with conn:
+            rows = conn.execute(query, values).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _translate(query, params):
+        # Same parameters as aiomysql cursor's execute after the query
+        args = params[0] if params else ()
+        if not isinstance(args, (tuple, list)):
+            args = (args,)
+        pieces = query.split("%s")
+        if len(pieces) != len(args) + 1:
+            raise ValueError("Query parameter count mismatch")
+        translated = [pieces[0]]
+        values = []
+        for arg, piece in zip(args, pieces[1:]):
+            if isinstance(arg, (tuple, list)):
+                translated.append("(" + ", ".join("?" * len(arg)) + ")")
+                values.extend(arg)
+            else:
+                translated.append("?")
+                values.append(arg)
+            translated.append(piece)
+        return "".join(translated), values
+
+    async def stop(self):
+        conn, self._conn = self._conn, None
+        await self._run(conn.close)
+        logger.info("Closed SQLite database")
+
+    def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, func, *args)
@@ -2,29 +2,125 @@ import os
 import json
 import base64
 import struct
-import zlib
 import asyncio
+import time
+from collections import deque
 
-from replayserver.errors import BookkeepingError
+from replayserver.errors import BookkeepingError, \
+    DatabaseConnectionError, DatabaseUnavailableError
+from replayserver.bookkeeping.compression import ReplayCompressor
+from replayserver.bookkeeping.executor import CompressionExecutor
+from replayserver.bookkeeping.prefetch import MetadataPrefetcher
+from replayserver.logging import logger
+from replayserver import metrics
+
+
+class Base64Writer:
+    """
+    Base64-encodes data written to it piece by piece and writes it out to a
+    file as it goes. Only ever holds a few bytes that don't align with a
+    base64 block and a single encoded block, no matter how much we write.
+    """
+    BLOCK_SIZE = 3 * 16 * 1024     # Has to be divisible by 3
+
+    def __init__(self, rfile):
+        self._file = rfile
+        self._leftover = b""
+
+    def write(self, data):
+        view = memoryview(data)
+        if self._leftover:
+            missing = 3 - len(self._leftover)
+            self._leftover += bytes(view[:missing])
+            view = view[missing:]
+            if len(self._leftover) < 3:
+                return
+            self._file.write(base64.b64encode(self._leftover))
+            self._leftover = b""
+        aligned = len(view) - len(view) % 3
+        for start in range(0, aligned, self.BLOCK_SIZE):
+            end = min(start + self.BLOCK_SIZE, aligned)
+            self._file.write(base64.b64encode(view[start:end]))
+        self._leftover = bytes(view[aligned:])
+
+    def close(self):
+        """ Write out remaining data, with padding. """
+        self._file.write(base64.b64encode(self._leftover))
+        self._leftover = b""
 
 
 class ReplayFilePaths:
-    def __init__(self, replay_store_path):
+    """
+    Allocates files for saved replays. Replay store can be slow (e.g. on
+    NFS), so all filesystem access happens in the save executor. We remember
+    the last few directories we created and create the directory for the next
+    hundred game ids in advance, so most allocations only create the file.
+    """
+    IDS_PER_DIRECTORY = 100
+    REMEMBERED_DIRS = 4
+
+    def __init__(self, replay_store_path, executor):
         self._replay_base_path = replay_store_path
+        self._executor = executor
+        self._created_dirs = deque(maxlen=self.REMEMBERED_DIRS)
 
     @classmethod
-    def build(cls, *, config_replay_store_path, **kwargs):
-        return cls(config_replay_store_path)
+    def build(cls, executor, *, config_replay_store_path, **kwargs):
+        return cls(config_replay_store_path, executor)
+
+    async def get(self, game_id, reuse_placeholder=False):
+        """
+        Creates an empty replay file and returns its path. If
+        reuse_placeholder is set, an empty file left by an earlier save that
+        never finished is returned instead of an error.
+        """
+        return await self._executor.run("allocate_file", self._get, game_id,
+                                        reuse_placeholder)
 
-    def get(self, game_id):
+    def _get(self, game_id, reuse_placeholder):
         rpath = self._replay_path(game_id)
-        os.makedirs(rpath, exist_ok=True)
         rfile = os.path.join(rpath, f"{str(game_id)}.fafreplay")
-        if os.path.exists(rfile):
-            raise BookkeepingError(f"Replay file {rfile} already exists")
-        open(rfile, 'a').close()    # Touch file
+        try:
+            self._create_file(rpath, rfile)
+        except FileExistsError:
+            if not (reuse_placeholder and self._is_placeholder(rfile)):
+                raise BookkeepingError(f"Replay file {rfile} already exists")
+        except OSError as e:
+            raise BookkeepingError(f"Could not create replay file {rfile}") \
+                from e
+        try:
+            self._ensure_dir(
+                self._replay_path(game_id + self.IDS_PER_DIRECTORY))
+        except OSError:
+            pass    # We'll try again once we need it
         return rfile
 
+    def _create_file(self, rpath, rfile):
+        self._ensure_dir(rpath)
+        try:
+            fd = self._open_new(rfile)
+        except FileNotFoundError:
+            # Someone removed the directory since we created it
+            self._created_dirs.remove(rpath)
+            self._ensure_dir(rpath)
+            fd = self._open_new(rfile)
+        os.close(fd)
+
+    def _open_new(self, rfile):
+        return os.open(rfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+
+    def _is_placeholder(self, rfile):
+        try:
+            return os.stat(rfile).st_size == 0
+        except OSError:
+            return False
+
+    def _ensure_dir(self, rpath):
+        if rpath in self._created_dirs:
+            return
+        os.makedirs(rpath, exist_ok=True)
+        self._created_dirs.append(rpath)
+
     def _replay_path(self, game_id):
         # Legacy folder structure:
         # digits 3-10 from the right,
@@ -38,28 +134,133 @@ class ReplayFilePaths:
 
 
 class ReplaySaver:
-    def __init__(self, paths, database):
+    def __init__(self, paths, database, executor, committer,
+                 compressor_builder, prefetcher):
         self._paths = paths
         self._database = database
+        self._executor = executor
+        self._committer = committer
+        self._compressor_builder = compressor_builder
+        self._prefetcher = prefetcher
+        self._compressors = {}
+        self._prefetches = {}
 
     @classmethod
-    def build(cls, database, **kwargs):
-        paths = ReplayFilePaths.build(**kwargs)
-        return cls(paths, database)
+    def build(cls, database, executor, committer, **kwargs):
+        paths = ReplayFilePaths.build(executor, **kwargs)
+        prefetcher = MetadataPrefetcher.build(database, **kwargs)
+
+        compression_executor = CompressionExecutor.build(**kwargs)
+
+        def compressor_builder(stream):
+            return ReplayCompressor.build(stream, compression_executor,
+                                          **kwargs)
+        return cls(paths, database, executor, committer, compressor_builder,
+                   prefetcher)
+
+    def prepare_replay(self, game_id, stream):
+        """
+        Start compressing the replay and fetching game info while it's still
+        being written, so that there is little left to do once we save it.
+        """
+        self._compressors[game_id] = self._compressor_builder(stream)
+        if self._prefetcher is not None:
+            self._prefetches[game_id] = self._prefetcher.prefetch(game_id)
+
+    def forget_replay(self, game_id):
+        """ Stop preparing a replay we won't save. """
+        self._compressors.pop(game_id, None)
+        self._take_prefetched(game_id)
+
+    def _take_prefetched(self, game_id):
+        prefetch = self._prefetches.pop(game_id, None)
+        if prefetch is None:
+            return None
+        if not prefetch.done():
+            prefetch.cancel()
+            metrics.metadata_prefetch.labels(result="not_ready").inc()
+            return None
+        info = prefetch.result()
+        result = "failed" if info is None else "used"
+        metrics.metadata_prefetch.labels(result=result).inc()
+        return info
+
+    def take_compressor(self, game_id, stream):
+        """
+        Returns the compressor of a prepared replay, or a new one if the
+        replay wasn't prepared.
+        """
+        compressor = self._compressors.pop(game_id, None)
+        if compressor is None:
+            compressor = self._compressor_builder(stream)
+        return compressor
 
     async def save_replay(self, game_id, stream):
         if stream.header is None:
+            self.forget_replay(game_id)
             raise BookkeepingError("Saved replay has no header")
-        info = await self._get_replay_info(game_id, stream.header.struct)
-        rfile = self._paths.get(game_id)
+        compressor = self.take_compressor(game_id, stream)
+        header = stream.header.struct
         try:
-            with open(rfile, "wb") as f:
-                await self._write_replay_in_thread(
-                    f, info, stream.header.data + stream.data.bytes())
+            info = await self.get_replay_info(game_id, header)
+        except (DatabaseConnectionError, DatabaseUnavailableError) as e:
+            # Better to save a replay with little info than to keep it in
+            # memory waiting for the database, or lose it
+            logger.warning(f"Saving replay {game_id} without game info: {e}")
+            metrics.degraded_saves.inc()
+            info = self.get_degraded_replay_info(game_id, header)
+        except BookkeepingError:
+            # Caller may release stream data once we return
+            await compressor.wait_for_stream_done()
+            raise
+        await self.write_replay(game_id, info, compressor)
+
+    async def write_replay(self, game_id, info, compressor, recovered=False):
+        """
+        Writes a replay file. Replays recovered after a crash may already
+        have an empty file allocated, which we then reuse.
+        """
+        with self._stage("finish_compression"):
+            length, compressed = await compressor.finish()
+        rfile = await self._paths.get(game_id, reuse_placeholder=recovered)
+        # Write to a temporary file first, so that the replay file is never
+        # partially written
+        tmpfile = rfile + ".tmp"
+        try:
+            await self._executor.run("write", self._write_replay,
+                                     tmpfile, info, length, compressed)
+            await self._committer.commit(tmpfile, rfile)
         except IOError as e:
             raise BookkeepingError("Could not write to replay file") from e
 
-    async def _get_replay_info(self, game_id, header):
+    async def get_replay_info(self, game_id, header):
+        prefetched = self._take_prefetched(game_id)
+        with self._stage("metadata"):
+            return await self._get_replay_info(game_id, header, prefetched)
+
+    def get_degraded_replay_info(self, game_id, header):
+        """
+        Replay info we can get without the database, for when it's
+        unavailable. Game info we know nothing about is left empty.
+        """
+        result = self._header_replay_info(game_id, header)
+        result.update({
+            'featured_mod': None,
+            'game_type': None,
+            'recorder': None,
+            'host': None,
+            'launched_at': None,
+            'game_end': time.time(),
+            'title': None,
+            'mapname': header.get('map_name'),
+            'map_file_path': None,
+            'num_players': len(header.get('remaining_timeouts', {})),
+            'teams': {},
+            'featured_mod_versions': {},
+        })
+        return result
+
+    def _header_replay_info(self, game_id, header):
         result = {}
         result['uid'] = game_id
         result['complete'] = True
@@ -71,9 +272,21 @@ class ReplaySaver:
             }
         except KeyError:    # TODO - validate elsewhere?
             raise BookkeepingError("Replay header has invalid sim_mods")
+        return result
+
+    async def _get_replay_info(self, game_id, header, prefetched):
+        result = self._header_replay_info(game_id, header)
 
-        game_stats = await self._database.get_game_stats(game_id)
-        teams = await self._database.get_teams_in_game(game_id)
+        if prefetched is not None:
+            # Only game end can change while the game is running
+            game_stats, teams = prefetched
+            game_end = await self._database.get_game_end(game_id)
+            game_stats = dict(game_stats, game_end=game_end)
+        else:
+            # Independent queries, so run them together
+            game_stats, teams = await asyncio.gather(
+                self._database.get_game_stats(game_id),
+                self._database.get_teams_in_game(game_id))
         result.update(game_stats)
         result['teams'] = self._fixup_team_dict(teams)
 
@@ -89,17 +302,28 @@ class ReplaySaver:
         # Replay format uses strings for teams for some reason
         return {str(t) if t is not None else "null": p for t, p in d.items()}
 
-    async def _write_replay_in_thread(self, rfile, info, data):
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None, lambda: self._write_replay(rfile, info, data))
+    def _stage(self, stage):
+        return metrics.save_stage_duration.labels(stage=stage).time()
 
-    def _write_replay(self, rfile, info, data):
+    def _write_replay(self, rfile, info, length, compressed):
         try:
-            rfile.write(json.dumps(info).encode('UTF-8'))
-            rfile.write(b"\n")
-            data = struct.pack("i", len(data)) + zlib.compress(data)
-            data = base64.b64encode(data)
-            rfile.write(data)
+            with open(rfile, "wb") as f:
+                f.write(json.dumps(info).encode('UTF-8'))
+                f.write(b"\n")
+                encoder = Base64Writer(f)
+                encoder.write(struct.pack("i", length))
+                for chunk in compressed:
+                    encoder.write(chunk)
+                encoder.close()
         except UnicodeEncodeError:
+            self._remove_file(rfile)
             raise BookkeepingError("Unicode encoding error")
+        except IOError:
+            self._remove_file(rfile)
+            raise
+
+    def _remove_file(self, rfile):
+        try:
+            os.remove(rfile)
+        except OSError:
+            pass
@@ -0,0 +1,306 @@
+import bisect
+import mmap
+import tempfile
+
+from replayserver.logging import logger
+
+
+def _is_immutable(data):
+    if isinstance(data, bytes):
+        return True
+    return (isinstance(data, memoryview) and data.readonly
+            and isinstance(data.obj, bytes))
+
+
+def _next_piece(chunks):
+    for chunk in chunks:
+        if chunk:
+            # Comparing memoryviews goes byte by byte, bytes use memcmp
+            return bytes(chunk) if isinstance(chunk, memoryview) else chunk
+    return None
+
+
+def chunks_equal(chunks1, chunks2):
+    """
+    Compare two sequences of chunks holding the same amount of data, without
+    joining them. Identical chunk objects are cheap to compare.
+    """
+    chunks1, chunks2 = iter(chunks1), iter(chunks2)
+    piece1, piece2 = b"", b""
+    pos1, pos2 = 0, 0
+    while True:
+        if pos1 == len(piece1):
+            piece1, pos1 = _next_piece(chunks1), 0
+        if pos2 == len(piece2):
+            piece2, pos2 = _next_piece(chunks2), 0
+        if piece1 is None or piece2 is None:
+            return piece1 is piece2
+        size = min(len(piece1) - pos1, len(piece2) - pos2)
+        if size == len(piece1) == len(piece2):
+            same = piece1 == piece2
+        else:
+            same = piece1[pos1:pos1 + size] == piece2[pos2:pos2 + size]
+        if not same:
+            return False
+        pos1 += size
+        pos2 += size
+
+
+class ChunkedBuffer:
+    """
+    Append-only byte buffer kept as a list of immutable chunks. Appending never
+    copies or reallocates data we already hold, unlike a growing bytearray,
+    which matters for replays that keep growing for hours.
+
+    Offsets of chunk starts are kept alongside the chunks, so finding the
+    chunk for a given position is a bisect away. Slicing only copies the data
+    it returns. Immutable chunks (bytes and views of them) are kept as they
+    are, so buffers can share chunk objects without copying them.
+
+    A prefix of the buffer can be handed over to another source holding the
+    same data (see share_prefix), so that identical data is not kept twice.
+    If we don't need the data at all, we can discard it and only keep track
+    of its length.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._offsets = []     # Position of first byte of each chunk
+        self._length = 0
+        self._base = None
+        self._base_length = 0
+        self.discarded = False
+
+    def append(self, data):
+        if not data:
+            return
+        if self.discarded:
+            self._length += len(data)
+            return
+        # Chunks have to stay immutable, anything else has to be copied.
+        if not _is_immutable(data):
+            data = bytes(data)
+        self._chunks.append(data)
+        self._offsets.append(self._length)
+        self._length += len(data)
+
+    def __iadd__(self, data):
+        self.append(data)
+        return self
+
+    def __len__(self):
+        return self._length
+
+    def share_prefix(self, base, length):
+        """
+        Serve data up to length from base instead of our own chunks, and drop
+        chunks we no longer need. Base has to support slicing and chunks()
+        like we do (e.g. data of another stream), and MUST hold data identical
+        to ours up to length for as long as we exist.
+        """
+        if length <= self._base_length:
+            return
+        if length > self._length:
+            raise ValueError("Cannot share more data than we have")
+        self._base = base
+        self._base_length = length
+        unneeded = 0
+        for offset, chunk in zip(self._offsets, self._chunks):
+            if offset + len(chunk) > length:
+                break
+            unneeded += 1
+        del self._chunks[:unneeded]
+        del self._offsets[:unneeded]
+
+    def discard(self):
+        """
+        Drop all data we hold, now and in the future. Returns amount of data
+        that was freed.
+        """
+        freed = sum(len(chunk) for chunk in self._chunks)
+        self._chunks.clear()
+        self._offsets.clear()
+        self._base = None
+        self._base_length = 0
+        self.discarded = True
+        return freed
+
+    def close(self):
+        """ Nothing to release, memory is freed with the buffer. """
+        pass
+
+    def __getitem__(self, val):
+        if not isinstance(val, slice):
+            raise ValueError("Only slicing is supported")
+        start, stop, step = val.indices(self._length)
+        if step != 1:
+            return self[start:stop][::step]
+        if start >= stop:
+            return b""
+        return b"".join(self.chunks(start, stop))
+
+    def chunks(self, start=0, stop=None):
+        """
+        Iterate over data between start and stop, one chunk at a time. Chunks
+        are returned as-is where possible and as memoryviews of them when cut,
+        so nothing is copied.
+        """
+        if stop is None or stop > self._length:
+            stop = self._length
+        if start >= stop:
+            return
+        if self.discarded:
+            raise ValueError("Data of this buffer was discarded")
+        if start < self._base_length:
+            yield from self._base.chunks(start, min(stop, self._base_length))
+            start = self._base_length
+            if start >= stop:
+                return
+        idx = max(bisect.bisect_right(self._offsets, start) - 1, 0)
+        while idx < len(self._chunks):
+            chunk = self._chunks[idx]
+            chunk_start = self._offsets[idx]
+            if chunk_start >= stop:
+                return
+            begin = max(start - chunk_start, 0)
+            end = min(stop - chunk_start, len(chunk))
+            if begin == 0 and end == len(chunk):
+                yield chunk
+            else:
+                yield memoryview(chunk)[begin:end]
+            idx += 1
+
+    def bytes(self):
+        return self[0:self._length]
+
+    def __bytes__(self):
+        return self.bytes()
+
+
+class _Segment:
+    """
+    Append-only scratch file, read back through mmap. The file is unlinked
+    right away, so it disappears once it's closed.
+    """
+    def __init__(self, directory, size):
+        self._file = tempfile.TemporaryFile(dir=directory, buffering=0)
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size,
+                              access=mmap.ACCESS_READ)
+        self.size = size
+        self.length = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            written = self._file.write(view)
+            view = view[written:]
+            self.length += written
+
+    def view(self, start, stop):
+        return memoryview(self._map)[start:stop]
+
+    def close(self):
+        self._file.close()
+        try:
+            self._map.close()
+        except BufferError:
+            # Someone still holds a view, the map goes once they let go
+            pass
+
+
+class _SegmentsView:
+    """ Sliceable view of data written to segments. """
+    def __init__(self, segments, segment_size):
+        self._segments = segments
+        self._segment_size = segment_size
+
+    def __getitem__(self, s):
+        return b"".join(self.chunks(s.start, s.stop))
+
+    def chunks(self, start, stop):
+        while start < stop:
+            idx, offset = divmod(start, self._segment_size)
+            end = min(stop - start + offset, self._segment_size)
+            yield self._segments[idx].view(offset, end)
+            start += end - offset
+
+
+class SpilledBuffer:
+    """
+    Append-only byte buffer that keeps only a recent window of data in
+    memory. Everything older is written to segment files in a scratch
+    directory and read back through mmap, so it can live in the page cache
+    instead of our memory.
+
+    If we fail to write to the scratch directory, we log an error and just
+    keep everything in memory from then on.
+    """
+    def __init__(self, directory, hot_window, segment_size):
+        self._directory = directory
+        self._hot_window = hot_window
+        self._segment_size = segment_size
+        self._segments = []
+        self._cold = _SegmentsView(self._segments, segment_size)
+        self._cold_length = 0
+        self._hot = ChunkedBuffer()
+        self._spill_failed = False
+
+    def append(self, data):
+        self._hot.append(data)
+        if not self._spill_failed:
+            self._spill()
+
+    def __iadd__(self, data):
+        self.append(data)
+        return self
+
+    def __len__(self):
+        return len(self._hot)
+
+    def __getitem__(self, val):
+        return self._hot[val]
+
+    def chunks(self, start=0, stop=None):
+        return self._hot.chunks(start, stop)
+
+    def bytes(self):
+        return self._hot.bytes()
+
+    def __bytes__(self):
+        return self.bytes()
+
+    def close(self):
+        """
+        Close segment files and their maps, instead of waiting for garbage
+        collection to do it. Spilled data can't be read afterwards.
+        """
+        for segment in self._segments:
+            segment.close()
+        self._spill_failed = True   # Don't make new segments either
+
+    def _spill(self):
+        spill_until = len(self._hot) - self._hot_window
+        if spill_until <= self._cold_length:
+            return
+        try:
+            for chunk in self._hot.chunks(self._cold_length, spill_until):
+                self._write_cold(chunk)
+        except OSError as e:
+            logger.error(f"Failed to spill replay data to disk, "
+                         f"keeping it in memory: {e}")
+            self._spill_failed = True
+            return
+        self._hot.share_prefix(self._cold, self._cold_length)
+
+    def _write_cold(self, data):
+        view = memoryview(data)
+        while view:
+            if (not self._segments
+                    or self._segments[-1].length == self._segment_size):
+                self._segments.append(
+                    _Segment(self._directory, self._segment_size))
+            segment = self._segments[-1]
+            piece = view[:segment.size - segment.length]
+            segment.write(piece)
+            self._cold_length += len(piece)
+            view = view[len(piece):]
@@ -23,6 +23,38 @@ class EmptyWaitMixin:
         self._empty.clear()
 
 
+class CallbackEvent:
+    """
+    Event that stays set once set. Besides waiting on it, one can register
+    plain callbacks to run when it's set, so that reacting to it doesn't need
+    a task parked on wait(). Callbacks added after the event was set run
+    right away.
+    """
+    def __init__(self):
+        self._event = Event()
+        self._callbacks = []
+
+    def set(self):
+        if self._event.is_set():
+            return
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    async def wait(self):
+        await self._event.wait()
+
+    def add_callback(self, callback):
+        if self._event.is_set():
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+
 class AsyncDict(MutableMapping, EmptyWaitMixin):
     "Tiny dict wrapper that lets us await until it's empty."
     def __init__(self):
@@ -22,3 +22,19 @@ class CannotAcceptConnectionError(BadConnectionError):
 
 class BookkeepingError(Exception):
     pass
+
+
+class DatabaseUnavailableError(BookkeepingError):
+    """
+    Used when we don't even try to query the database, because it has been
+    failing recently.
+    """
+    pass
+
+
+class DatabaseConnectionError(BookkeepingError):
+    """
+    Used when a query failed because of the database connection or server,
+    not because of the query itself.
+    """
+    pass
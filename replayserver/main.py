@@ -5,6 +5,9 @@ import signal
 
 from replayserver import Server
 from replayserver.receive.mergestrategy import MergeStrategies
+from replayserver.struct.header import HeaderParser
+from replayserver.bookkeeping.commit import SaveDurability
+from replayserver.bookkeeping.database import DatabaseBackend
 from replayserver.logging import logger
 
 __all__ = ["main"]
@@ -14,8 +17,17 @@ def eget(*args, **kwargs):
     return os.environ.get(*args, **kwargs)
 
 
+def env_bool(value):
+    if value.lower() in ["1", "true", "yes"]:
+        return True
+    if value.lower() in ["0", "false", "no"]:
+        return False
+    raise ValueError(f"Expected a boolean, got '{value}'")
+
+
 def get_config_from_env():
     MISSING = object()
+    MISSING_FOR_MYSQL = object()   # Only needed with MySQL database backend
     env_config = {
         "merger_grace_period_time": ("REPLAY_GRACE_PERIOD", 30, int),
         "replay_merge_strategy":
@@ -23,15 +35,73 @@ def get_config_from_env():
              MergeStrategies),
         "mergestrategy_stall_check_period":
             ("MERGESTRATEGY_STALL_CHECK_PERIOD", 60, int),
+        "mergestrategy_share_matching_data":
+            ("MERGESTRATEGY_SHARE_MATCHING_DATA", False, env_bool),
+        "mergestrategy_discard_diverged_data":
+            ("MERGESTRATEGY_DISCARD_DIVERGED_DATA", False, env_bool),
+        "mergestrategy_failover_lead_bytes":
+            ("MERGESTRATEGY_FAILOVER_LEAD_BYTES", 0, int),
+        "mergestrategy_failover_lead_time":
+            ("MERGESTRATEGY_FAILOVER_LEAD_TIME", 0, int),
+        "mergestrategy_quorum_size": ("MERGESTRATEGY_QUORUM_SIZE", 2, int),
+        "mergestrategy_quorum_block_size":
+            ("MERGESTRATEGY_QUORUM_BLOCK_SIZE", 4096, int),
+        "connection_read_size_min": ("CONNECTION_READ_SIZE_MIN", 4096, int),
+        "connection_read_size_max":
+            ("CONNECTION_READ_SIZE_MAX", 256 * 1024, int),
+        "replay_header_parser":
+            ("REPLAY_HEADER_PARSER", HeaderParser.BUFFER, HeaderParser),
         "sent_replay_delay": ("REPLAY_DELAY", 5 * 60, int),
         "replay_forced_end_time": ("REPLAY_FORCE_END_TIME", 5 * 60 * 60, int),
         "server_port": ("PORT", 15000, int),
-        "db_host": ("MYSQL_HOST", MISSING, str),
-        "db_port": ("MYSQL_PORT", MISSING, int),
-        "db_user": ("MYSQL_USER", MISSING, str),
-        "db_password": ("MYSQL_PASSWORD", MISSING, str),
-        "db_name": ("MYSQL_DB", MISSING, str),
+        "db_backend": ("DB_BACKEND", DatabaseBackend.MYSQL, DatabaseBackend),
+        "db_sqlite_path": ("DB_SQLITE_PATH", ":memory:", str),
+        "db_sqlite_latency": ("DB_SQLITE_LATENCY", 0, int),
+        "db_host": ("MYSQL_HOST", MISSING_FOR_MYSQL, str),
+        "db_port": ("MYSQL_PORT", MISSING_FOR_MYSQL, int),
+        "db_user": ("MYSQL_USER", MISSING_FOR_MYSQL, str),
+        "db_password": ("MYSQL_PASSWORD", MISSING_FOR_MYSQL, str),
+        "db_name": ("MYSQL_DB", MISSING_FOR_MYSQL, str),
+        "db_pool_min_size": ("MYSQL_POOL_MIN_SIZE", 1, int),
+        "db_pool_max_size": ("MYSQL_POOL_MAX_SIZE", 10, int),
+        "db_pool_recycle": ("MYSQL_POOL_RECYCLE", -1, int),
+        "db_pool_acquire_timeout": ("MYSQL_POOL_ACQUIRE_TIMEOUT", 30, int),
+        "db_breaker_failures": ("DB_BREAKER_FAILURES", 5, int),
+        "db_breaker_slow_query_time": ("DB_BREAKER_SLOW_QUERY_TIME", 10, int),
+        "db_breaker_window": ("DB_BREAKER_WINDOW", 60, int),
+        "db_breaker_cooldown": ("DB_BREAKER_COOLDOWN", 30, int),
+        "db_mod_versions_cache_ttl":
+            ("DB_MOD_VERSIONS_CACHE_TTL", 5 * 60, int),
+        "metadata_prefetch": ("METADATA_PREFETCH", False, env_bool),
+        "metadata_prefetch_delay": ("METADATA_PREFETCH_DELAY", 60, int),
+        "metadata_batch_window": ("METADATA_BATCH_WINDOW", 100, int),
         "replay_store_path": ("REPLAY_DIR", MISSING, str),
+        "replay_compression_batch_size":
+            ("REPLAY_COMPRESSION_BATCH_SIZE", 1024 * 1024, int),
+        "replay_compression_level": ("REPLAY_COMPRESSION_LEVEL", 6, int),
+        "replay_compression_workers":
+            ("REPLAY_COMPRESSION_WORKERS", 1, int),
+        "replay_compression_min_block_size":
+            ("REPLAY_COMPRESSION_MIN_BLOCK_SIZE", 128 * 1024, int),
+        "save_executor_workers": ("SAVE_EXECUTOR_WORKERS", 2, int),
+        "save_executor_queue_size": ("SAVE_EXECUTOR_QUEUE_SIZE", 16, int),
+        "compression_executor_workers":
+            ("COMPRESSION_EXECUTOR_WORKERS", 2, int),
+        "compression_executor_queue_size":
+            ("COMPRESSION_EXECUTOR_QUEUE_SIZE", 16, int),
+        "save_durability":
+            ("SAVE_DURABILITY", SaveDurability.NONE, SaveDurability),
+        "save_group_commit_interval":
+            ("SAVE_GROUP_COMMIT_INTERVAL", 50, int),
+        "save_spool_dir": ("SAVE_SPOOL_DIR", None, str),
+        "save_retry_delay": ("SAVE_RETRY_DELAY", 5, int),
+        "save_retry_max_delay": ("SAVE_RETRY_MAX_DELAY", 5 * 60, int),
+        "save_retry_attempts": ("SAVE_RETRY_ATTEMPTS", 20, int),
+        "replay_spill_dir": ("REPLAY_SPILL_DIR", None, str),
+        "replay_spill_hot_window":
+            ("REPLAY_SPILL_HOT_WINDOW", 8 * 1024 * 1024, int),
+        "replay_spill_segment_size":
+            ("REPLAY_SPILL_SEGMENT_SIZE", 64 * 1024 * 1024, int),
         "sent_replay_position_update_interval":
             ("SENT_REPLAY_UPDATE_INTERVAL", 1, int),
         "prometheus_port": ("PROMETHEUS_PORT", None, int),
@@ -42,6 +112,11 @@ def get_config_from_env():
         env_name, env_default, env_type = v
         env_value = eget(env_name, None)
         if env_value is None:
+            if env_default is MISSING_FOR_MYSQL:
+                if config["db_backend"] == DatabaseBackend.MYSQL:
+                    env_default = MISSING
+                else:
+                    env_default = None
             if env_default is MISSING:
                 raise ValueError((f"Missing config key: {k}. "
                                   f"Set it using env var {env_name}."))
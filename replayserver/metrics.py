@@ -1,4 +1,4 @@
-from prometheus_client import Gauge, Counter
+from prometheus_client import Gauge, Counter, Histogram
 from contextlib import contextmanager
 
 
@@ -10,6 +10,24 @@ served_conns = Counter(
     "replayserver_served_connections_total",
     "How many connections we served to completion.",
     ["result"])
+connection_read_size = Histogram(
+    "replayserver_connection_read_size_bytes",
+    "Size of reads requested from writer connections.",
+    buckets=[2 ** i for i in range(10, 21)])
+connection_read_chunks = Counter(
+    "replayserver_connection_read_chunks_total",
+    "Number of data chunks read from writer connections.")
+discarded_diverged_bytes = Counter(
+    "replayserver_discarded_diverged_bytes_total",
+    "Bytes read from writer connections that diverged and then discarded.")
+merge_stream_switches = Counter(
+    "replayserver_merge_stream_switches_total",
+    "Times merging switched to following another writer, by reason.",
+    ["reason"])
+merge_switch_lag = Histogram(
+    "replayserver_merge_switch_lag_bytes",
+    "How far the newly followed writer was ahead of the merged replay.",
+    buckets=[2 ** i for i in range(4, 25, 2)])
 
 running_replays = Gauge(
     "replayserver_running_replays_count",
@@ -21,6 +39,71 @@ saved_replays = Counter(
     "replayserver_saved_replay_files_total",
     "Total replays successfully saved to disk.")
 
+saves_in_progress = Gauge(
+    "replayserver_saves_in_progress_count",
+    "Count of replays currently being saved.")
+save_queue_depth = Gauge(
+    "replayserver_save_queue_depth",
+    "Count of replay saving jobs waiting for a free worker.")
+save_stage_duration = Histogram(
+    "replayserver_save_stage_duration_seconds",
+    "Time taken by each stage of saving replays.",
+    ["stage"])
+compression_queue_depth = Gauge(
+    "replayserver_compression_queue_depth",
+    "Count of live replay compression jobs waiting for a free worker.")
+compression_job_duration = Histogram(
+    "replayserver_compression_job_duration_seconds",
+    "Time taken by a batch of live replay compression.")
+
+spooled_replays = Gauge(
+    "replayserver_spooled_replays_count",
+    "Count of ended replays waiting in the save spool.")
+spool_size = Gauge(
+    "replayserver_spool_size_bytes",
+    "Size of replay data waiting in the save spool.")
+spool_oldest_age = Gauge(
+    "replayserver_spool_oldest_replay_age_seconds",
+    "How long the oldest replay in the save spool has been waiting.")
+save_retries = Counter(
+    "replayserver_save_metadata_retries_total",
+    "Number of times fetching replay metadata was retried.")
+
+db_pool_acquire_duration = Histogram(
+    "replayserver_db_pool_acquire_duration_seconds",
+    "Time spent waiting for a connection from the database pool.")
+db_connections_in_use = Gauge(
+    "replayserver_db_connections_in_use_count",
+    "Count of database pool connections currently running queries.")
+db_query_duration = Histogram(
+    "replayserver_db_query_duration_seconds",
+    "Time taken by replay database queries, pool wait included.",
+    ["query"])
+db_breaker_state = Gauge(
+    "replayserver_db_circuit_breaker_state",
+    "Current state of the database circuit breaker, 1 for current state.",
+    ["state"])
+db_breaker_rejected_queries = Counter(
+    "replayserver_db_circuit_breaker_rejected_queries_total",
+    "Database queries not run because the circuit breaker was open.")
+degraded_saves = Counter(
+    "replayserver_degraded_saves_total",
+    "Replays saved without game info because the database was unavailable.")
+
+mod_versions_cache = Counter(
+    "replayserver_mod_versions_cache_lookups_total",
+    "Featured mod version lookups, by whether they were cached, waited for "
+    "a query in progress or made a query.",
+    ["result"])
+mod_versions_stale = Counter(
+    "replayserver_mod_versions_stale_total",
+    "Failed featured mod version refreshes that served stale versions.")
+
+metadata_prefetch = Counter(
+    "replayserver_metadata_prefetch_total",
+    "Game info prefetched for saved replays, by whether it was used.",
+    ["result"])
+
 
 @contextmanager
 def track(metric):
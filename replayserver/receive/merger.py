@@ -1,66 +1,75 @@
-import asyncio
-from asyncio.locks import Event
 from contextlib import contextmanager
 
 from replayserver.errors import CannotAcceptConnectionError
-from replayserver.collections import AsyncCounter
+from replayserver.collections import CallbackEvent
+from replayserver.timers import get_timer_wheel
 from replayserver.receive.stream import ConnectionReplayStream, \
     OutsideSourceReplayStream
 
 
 class MergerEndCondition:
-    def __init__(self, count, grace_period):
-        self._count = count
+    """
+    Decides when writing a replay is over - when there were no writer
+    connections for a grace period, or when forced. Driven by connection
+    events and a timer instead of a waiting task.
+    """
+    def __init__(self, grace_period, on_end):
         self._grace_period = grace_period
-        self._force_end = Event()
-
-    async def wait_for_end(self):
-        await self._wait_for_any(self._no_connections_for_a_while(),
-                                 self._force_end.wait())
-
-    async def _no_connections_for_a_while(self):
-        while True:
-            await self._count.wait_until_empty()
-            if (await self._grace_period_without_connections()):
-                return
-
-    async def _grace_period_without_connections(self):
-        try:
-            await asyncio.wait_for(self._count.wait_until_not_empty(),
-                                   timeout=self._grace_period)
-            return False
-        except asyncio.TimeoutError:
-            return True
-
-    async def _wait_for_any(self, *coros):
-        _, p = await asyncio.wait(coros, return_when=asyncio.FIRST_COMPLETED)
-        for task in p:
-            task.cancel()
+        self._on_end = on_end
+        self._connections = 0
+        self._grace_timer = None
+        self.ended = False
+        self._start_grace_period()
+
+    def connection_added(self):
+        self._connections += 1
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+
+    def connection_removed(self):
+        self._connections -= 1
+        if self._connections == 0:
+            self._start_grace_period()
+
+    def _start_grace_period(self):
+        if not self.ended:
+            self._grace_timer = get_timer_wheel().call_later(
+                self._grace_period, self.force_end)
 
     def force_end(self):
-        self._force_end.set()
+        if self.ended:
+            return
+        self.ended = True
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+        on_end, self._on_end = self._on_end, None
+        on_end()
 
 
 class Merger:
     def __init__(self, stream_builder, grace_period_time, merge_strategy,
                  canonical_stream):
         self._stream_builder = stream_builder
-        self._stream_count = AsyncCounter()
+        self._stream_count = 0
         self._merge_strategy = merge_strategy
         self.canonical_stream = canonical_stream
         self._closing = False
-        self._ended = Event()
-        self._end_condition = MergerEndCondition(self._stream_count,
-                                                 grace_period_time)
-        asyncio.ensure_future(self._lifetime())
+        self._ended = CallbackEvent()
+        self._end_condition = MergerEndCondition(grace_period_time,
+                                                 self._writing_ended)
 
     @classmethod
     def build(cls, *, config_merger_grace_period_time,
               config_replay_merge_strategy, **kwargs):
-        canonical_replay = OutsideSourceReplayStream()
+        canonical_replay = OutsideSourceReplayStream.build(**kwargs)
         merge_strategy = config_replay_merge_strategy.build(
             canonical_replay, **kwargs)
-        stream_builder = ConnectionReplayStream.build
+
+        def stream_builder(connection):
+            return ConnectionReplayStream.build(connection, **kwargs)
+
         return cls(stream_builder, config_merger_grace_period_time,
                    merge_strategy, canonical_replay)
 
@@ -68,12 +77,15 @@ class Merger:
     def _stream_tracking(self, connection):
         stream = self._stream_builder(connection)
         self._merge_strategy.stream_added(stream)
-        self._stream_count.inc()
+        self._stream_count += 1
+        self._end_condition.connection_added()
         try:
             yield stream
         finally:
             self._merge_strategy.stream_removed(stream)
-            self._stream_count.dec()
+            self._stream_count -= 1
+            self._end_condition.connection_removed()
+            self._check_finished()
 
     async def handle_connection(self, connection):
         if self._closing:
@@ -89,13 +101,20 @@ class Merger:
     def close(self):
         self._end_condition.force_end()
 
-    async def _lifetime(self):
-        await self._end_condition.wait_for_end()
+    def _writing_ended(self):
         self._closing = True
-        await self._stream_count.wait_until_empty()
+        self._check_finished()
+
+    def _check_finished(self):
+        # Let connections still around finish before we end
+        if not self._closing or self._stream_count > 0 or self._ended.is_set():
+            return
         self._merge_strategy.finalize()
         self.canonical_stream.finish()
         self._ended.set()
 
     async def wait_for_ended(self):
         await self._ended.wait()
+
+    def add_end_callback(self, callback):
+        self._ended.add_callback(callback)
@@ -1,16 +1,24 @@
-from enum import Enum
 import asyncio
+import hashlib
+from enum import Enum
+
+from replayserver import metrics
+from replayserver.buffer import chunks_equal
+from replayserver.timers import get_timer_wheel
 
 
 class MergeStrategies(Enum):
     GREEDY = "GREEDY"
     FOLLOW_STREAM = "FOLLOW_STREAM"
+    QUORUM = "QUORUM"
 
     def build(self, *args, **kwargs):
         if self == MergeStrategies.GREEDY:
             return GreedyMergeStrategy.build(*args, **kwargs)
         elif self == MergeStrategies.FOLLOW_STREAM:
             return FollowStreamMergeStrategy.build(*args, **kwargs)
+        elif self == MergeStrategies.QUORUM:
+            return QuorumMergeStrategy.build(*args, **kwargs)
 
 
 class MergeStrategy:
@@ -59,7 +67,8 @@ class GreedyMergeStrategy(MergeStrategy):
         canon_len = len(self.sink_stream.data)
         if len(stream.data) <= canon_len:
             return
-        self.sink_stream.feed_data(stream.data[canon_len:])
+        for chunk in stream.data.chunks(canon_len):
+            self.sink_stream.feed_data(chunk)
 
     def finalize(self):
         self.sink_stream.finish()
@@ -74,20 +83,19 @@ class DivergenceTracking:
         self._stream = stream
         self._sink = sink
         self.diverges = False
-        self._compared_num = 0
+        self.matching_length = 0
 
     def check_divergence(self):
         if self.diverges:
             return
-        start = self._compared_num
+        start = self.matching_length
         end = min(len(self._stream.data), len(self._sink.data))
         if start >= end:
             return
-        # This is safe since we don't await with the memoryviews
-        with memoryview(self._stream.data.bytes()) as view1, \
-                memoryview(self._sink.data.bytes()) as view2:
-            self.diverges = view1[start:end] != view2[start:end]
-        self._compared_num = end
+        self.diverges = not chunks_equal(self._stream.data.chunks(start, end),
+                                         self._sink.data.chunks(start, end))
+        if not self.diverges:
+            self.matching_length = end
 
 
 class FollowStreamMergeStrategy(MergeStrategy):
@@ -110,18 +118,49 @@ class FollowStreamMergeStrategy(MergeStrategy):
     4. Matching set MAY contain diverging streams. They are lazily removed
        when we check if a stream is fit to be tracked.
     5. After finalize(), ALL streams either diverge or are prefices of sink.
+
+    If share_matching_data or discard_diverged_data is set, we check every
+    stream for divergence as soon as it gets new data. Streams that match the
+    sink then read the matching part from the sink instead of keeping their
+    own copy, and streams that diverge stop keeping data at all.
+
+    Waiting for the stall check can freeze the sink for a whole check period
+    while other streams are ahead. If failover_lead_bytes or
+    failover_lead_time is set, we switch right away to a matching stream that
+    gets new data while it's at least that many bytes ahead of the sink, or
+    while the sink hasn't advanced for that many seconds.
     """
-    def __init__(self, sink_stream, mergestrategy_stall_check_period):
+    def __init__(self, sink_stream, mergestrategy_stall_check_period,
+                 share_matching_data, discard_diverged_data,
+                 failover_lead_bytes, failover_lead_time):
         MergeStrategy.__init__(self, sink_stream)
         self._candidates = {}
         self._tracked = None
-        self._stalling_watchdog = asyncio.ensure_future(
-            self._guard_against_stalling(mergestrategy_stall_check_period))
+        self._share_matching_data = share_matching_data
+        self._discard_diverged_data = discard_diverged_data
+        self._stall_check_period = mergestrategy_stall_check_period
+        self._stall_check_position = len(sink_stream.data)
+        self._stall_check = get_timer_wheel().call_later(
+            mergestrategy_stall_check_period, self._guard_against_stalling)
+        self._failover_lead_bytes = failover_lead_bytes
+        self._failover_lead_time = failover_lead_time
+        self._sink_advanced_at = self._now()
 
     @classmethod
     def build(cls, sink_stream, *, config_mergestrategy_stall_check_period,
-              **kwargs):
-        return cls(sink_stream, config_mergestrategy_stall_check_period)
+              config_mergestrategy_share_matching_data,
+              config_mergestrategy_discard_diverged_data,
+              config_mergestrategy_failover_lead_bytes,
+              config_mergestrategy_failover_lead_time, **kwargs):
+        return cls(sink_stream, config_mergestrategy_stall_check_period,
+                   config_mergestrategy_share_matching_data,
+                   config_mergestrategy_discard_diverged_data,
+                   config_mergestrategy_failover_lead_bytes,
+                   config_mergestrategy_failover_lead_time)
+
+    @staticmethod
+    def _now():
+        return asyncio.get_event_loop().time()
 
     def _is_ahead_of_sink(self, stream):
         return len(stream.data) > len(self.sink_stream.data)
@@ -137,12 +176,20 @@ class FollowStreamMergeStrategy(MergeStrategy):
         check.check_divergence()
         if check.diverges:
             del self._candidates[stream]
+            if self._discard_diverged_data:
+                stream.discard_data()
 
     def _feed_sink(self):
         if self._tracked is None:
             return
         sink_len = len(self.sink_stream.data)
-        self.sink_stream.feed_data(self._tracked.data[sink_len:])
+        if len(self._tracked.data) <= sink_len:
+            return
+        # Pass chunks along as they are, so the sink shares them with the
+        # tracked stream instead of copying
+        for chunk in self._tracked.data.chunks(sink_len):
+            self.sink_stream.feed_data(chunk)
+        self._sink_advanced_at = self._now()
 
     def _find_new_stream(self):
         for stream in list(self._candidates.keys()):
@@ -162,14 +209,49 @@ class FollowStreamMergeStrategy(MergeStrategy):
             self._candidates.pop(stream, None)
             self._find_new_stream()
 
+    def _check_new_data(self, stream):
+        if stream not in self._candidates:
+            return
+        self._check_for_divergence(stream)
+        check = self._candidates.get(stream)
+        if check is not None and self._share_matching_data:
+            stream.share_data_prefix(self.sink_stream, check.matching_length)
+
+    def _should_fail_over_to(self, stream):
+        if stream not in self._candidates:
+            return False
+        lead = len(stream.data) - len(self.sink_stream.data)
+        if lead <= 0:
+            return False
+        leads_by_bytes = (self._failover_lead_bytes > 0
+                          and lead >= self._failover_lead_bytes)
+        leads_by_time = (self._failover_lead_time > 0
+                         and self._now() - self._sink_advanced_at
+                         >= self._failover_lead_time)
+        if not (leads_by_bytes or leads_by_time):
+            return False
+        # Checking for divergence is the costly part, do it last
+        return self._eligible_for_tracking(stream)
+
+    def _switch_to(self, stream, reason):
+        metrics.merge_stream_switches.labels(reason=reason).inc()
+        metrics.merge_switch_lag.observe(
+            len(stream.data) - len(self.sink_stream.data))
+        self._tracked = stream
+
     def new_data(self, stream):
         if self._tracked is None and self._eligible_for_tracking(stream):
             self._tracked = stream
+        elif (self._tracked is not None and stream is not self._tracked
+              and self._should_fail_over_to(stream)):
+            self._switch_to(stream, "lead")
         if stream is self._tracked:
             self._feed_sink()
+        if self._share_matching_data or self._discard_diverged_data:
+            self._check_new_data(stream)
 
     def finalize(self):
-        self._stalling_watchdog.cancel()
+        self._stall_check.cancel()
         # Check any ended streams we saved for later
         while self._tracked is not None:
             self.stream_removed(self._tracked)
@@ -180,7 +262,7 @@ class FollowStreamMergeStrategy(MergeStrategy):
         if self.sink_stream.header is None:
             self.sink_stream.set_header(stream.header)
 
-    async def _guard_against_stalling(self, stall_check_period):
+    def _guard_against_stalling(self):
         """
         Stops tracking a stream if it didn't advance for stall_check_period
         seconds, possibly finding a better one.
@@ -191,11 +273,274 @@ class FollowStreamMergeStrategy(MergeStrategy):
         further ahead or won't track until first eligible stream appears.
         """
         current_pos = len(self.sink_stream.data)
-        previous_pos = current_pos
+        if (current_pos == self._stall_check_position
+                and self._tracked is not None):
+            self._tracked = None
+            self._find_new_stream()
+            if self._tracked is not None:
+                metrics.merge_stream_switches.labels(reason="stall").inc()
+                metrics.merge_switch_lag.observe(
+                    len(self.sink_stream.data) - current_pos)
+        self._stall_check_position = current_pos
+        self._stall_check = get_timer_wheel().call_later(
+            self._stall_check_period, self._guard_against_stalling)
+
+
+class BlockDigests:
+    """
+    Digests of complete, fixed-size blocks of a stream. Every block is hashed
+    only once, as soon as the stream has all of it.
+    """
+    def __init__(self, stream, block_size):
+        self.stream = stream
+        self._block_size = block_size
+        self.digests = []
+        self.diverges = False
+        self.live = True
+
+    def update(self):
+        bs = self._block_size
+        for block in range(len(self.digests), len(self.stream.data) // bs):
+            digest = hashlib.sha256()
+            for chunk in self.stream.data.chunks(block * bs,
+                                                 (block + 1) * bs):
+                digest.update(chunk)
+            self.digests.append(digest.digest())
+
+
+class QuorumMergeStrategy(MergeStrategy):
+    """
+    Adds a block of data to the sink as soon as quorum_size streams agree on
+    it, so that the sink advances as fast as the fastest streams that agree,
+    instead of depending on a single stream like FOLLOW_STREAM does. Streams
+    are compared by digests of fixed-size blocks, so we never compare the
+    same data twice. A stream whose block differs from the sink's diverges
+    and isn't considered anymore.
+
+    Streams that ended still vote with the data they have. If fewer than
+    quorum_size matching streams are still connected, we won't reach a
+    quorum on new data, so we follow a single stream instead, like
+    FOLLOW_STREAM. On finalize(), the sink is extended with data of matching
+    streams that are ahead of it, until there are none.
+
+    Enough connected streams don't guarantee a quorum either, since all but
+    one of them might lag behind or stall. So we also follow a stream if the
+    sink didn't advance for a whole stall_check_period while a matching
+    stream is ahead of it, or, like FOLLOW_STREAM, once a matching stream
+    gets new data while failover_lead_bytes ahead of the sink or while the
+    sink hasn't advanced for failover_lead_time. We follow until streams
+    agree on a new block again.
+
+    Invariants:
+    0. Sink digests hold digests of all complete blocks of the sink.
+    1. A block of a stream was compared with the sink's as soon as both
+       were complete. Diverging streams are marked as such.
+    2. Tracked stream, if any, matches the sink and has at least as much
+       data. We only track if less than quorum_size matching streams are
+       connected, or if we gave up waiting for a quorum.
+    """
+    def __init__(self, sink_stream, quorum_size, block_size,
+                 stall_check_period, failover_lead_bytes,
+                 failover_lead_time):
+        MergeStrategy.__init__(self, sink_stream)
+        self._quorum_size = quorum_size
+        self._block_size = block_size
+        self._streams = {}
+        self._sink_digests = []
+        self._tracked = None
+        self._connected = 0     # Connected streams that didn't diverge
+        self._following = False     # Gave up waiting for a quorum
+        self._failover_lead_bytes = failover_lead_bytes
+        self._failover_lead_time = failover_lead_time
+        self._sink_advanced_at = self._now()
+        self._stall_check_period = stall_check_period
+        self._stall_check_position = len(sink_stream.data)
+        self._stall_check = get_timer_wheel().call_later(
+            stall_check_period, self._guard_against_stalling)
+
+    @classmethod
+    def build(cls, sink_stream, *, config_mergestrategy_quorum_size,
+              config_mergestrategy_quorum_block_size,
+              config_mergestrategy_stall_check_period,
+              config_mergestrategy_failover_lead_bytes,
+              config_mergestrategy_failover_lead_time, **kwargs):
+        return cls(sink_stream, config_mergestrategy_quorum_size,
+                   config_mergestrategy_quorum_block_size,
+                   config_mergestrategy_stall_check_period,
+                   config_mergestrategy_failover_lead_bytes,
+                   config_mergestrategy_failover_lead_time)
+
+    @staticmethod
+    def _now():
+        return asyncio.get_event_loop().time()
+
+    def stream_added(self, stream):
+        self._streams[stream] = BlockDigests(stream, self._block_size)
+        self._connected += 1
+        self._update_tracking()
+
+    def stream_removed(self, stream):
+        # Keep its blocks, they still count towards a quorum
+        blocks = self._streams[stream]
+        blocks.live = False
+        if not blocks.diverges:
+            self._connected -= 1
+        if stream is self._tracked:
+            self._tracked = None
+        self._update_tracking()
+
+    def new_header(self, stream):
+        if self.sink_stream.header is None:
+            self.sink_stream.set_header(stream.header)
+
+    def new_data(self, stream):
+        blocks = self._streams[stream]
+        self._update_digests(blocks)
+        if stream is self._tracked:
+            self._feed_sink(blocks)
+        if len(blocks.digests) > len(self._sink_digests):
+            self._commit_agreed_blocks()
+        if (self._tracked is None and self._connected >= self._quorum_size
+                and self._should_follow(blocks)):
+            self._follow(blocks, "lead")
+        self._update_tracking()
+
+    def finalize(self):
+        self._stall_check.cancel()
+        self._tracked = None
+        while True:
+            blocks = self._find_stream_ahead(live_only=False)
+            if blocks is None:
+                break
+            self._feed_sink(blocks)
+        self._streams.clear()
+        self.sink_stream.finish()
+
+    def _diverged(self, blocks):
+        if not blocks.diverges:
+            blocks.diverges = True
+            if blocks.live:
+                self._connected -= 1
+
+    def _update_digests(self, blocks):
+        start = len(blocks.digests)
+        blocks.update()
+        end = min(len(blocks.digests), len(self._sink_digests))
+        for block in range(start, end):
+            if blocks.digests[block] != self._sink_digests[block]:
+                self._diverged(blocks)
+
+    def _sink_block_completed(self, digest):
+        block = len(self._sink_digests)
+        self._sink_digests.append(digest)
+        for blocks in self._streams.values():
+            if len(blocks.digests) > block and blocks.digests[block] != digest:
+                self._diverged(blocks)
+
+    def _feed_sink(self, blocks, stop=None):
+        self._update_digests(blocks)
+        start = len(self.sink_stream.data)
+        # Pass chunks along as they are, so the sink shares them with the
+        # stream instead of copying
+        for chunk in blocks.stream.data.chunks(start, stop):
+            self.sink_stream.feed_data(chunk)
+        if len(self.sink_stream.data) > start:
+            self._sink_advanced_at = self._now()
+        end = len(self.sink_stream.data) // self._block_size
+        for block in range(len(self._sink_digests), end):
+            self._sink_block_completed(blocks.digests[block])
+
+    def _matches_sink(self, blocks):
+        if blocks.diverges:
+            return False
+        # Complete blocks of both were compared already, check the rest
+        bs = self._block_size
+        start = min(len(blocks.digests), len(self._sink_digests)) * bs
+        end = min(len(blocks.stream.data), len(self.sink_stream.data))
+        if start < end and not chunks_equal(
+                blocks.stream.data.chunks(start, end),
+                self.sink_stream.data.chunks(start, end)):
+            self._diverged(blocks)
+        return not blocks.diverges
+
+    def _commit_agreed_blocks(self):
+        committed = False
         while True:
-            previous_pos = current_pos
-            await asyncio.sleep(stall_check_period)
-            current_pos = len(self.sink_stream.data)
-            if current_pos == previous_pos and self._tracked is not None:
-                self._tracked = None
-                self._find_new_stream()
+            block = len(self._sink_digests)
+            votes = {}
+            for blocks in self._streams.values():
+                if not blocks.diverges and len(blocks.digests) > block:
+                    votes.setdefault(blocks.digests[block], []).append(blocks)
+            agreed = [v for v in votes.values()
+                      if len(v) >= self._quorum_size]
+            if not agreed:
+                break
+            voters = agreed[0]
+            # We might have followed a stream partway into the block
+            if not self._matches_sink(voters[0]):
+                for blocks in voters:
+                    self._diverged(blocks)
+                continue
+            self._feed_sink(voters[0], (block + 1) * self._block_size)
+            committed = True
+        if committed:
+            # Tracked stream might be behind the sink now, pick again
+            self._tracked = None
+            self._following = False
+
+    def _should_follow(self, blocks):
+        lead = len(blocks.stream.data) - len(self.sink_stream.data)
+        if lead <= 0:
+            return False
+        leads_by_bytes = (self._failover_lead_bytes > 0
+                          and lead >= self._failover_lead_bytes)
+        leads_by_time = (self._failover_lead_time > 0
+                         and self._now() - self._sink_advanced_at
+                         >= self._failover_lead_time)
+        if not (leads_by_bytes or leads_by_time):
+            return False
+        return self._matches_sink(blocks)
+
+    def _follow(self, blocks, reason):
+        metrics.merge_stream_switches.labels(reason=reason).inc()
+        metrics.merge_switch_lag.observe(
+            len(blocks.stream.data) - len(self.sink_stream.data))
+        self._following = True
+        self._tracked = blocks.stream
+        self._feed_sink(blocks)
+
+    def _guard_against_stalling(self):
+        """
+        If the sink didn't advance since last check, follow a stream that's
+        ahead of it, whether we were waiting for a quorum or following a
+        stream that stalled.
+        """
+        current_pos = len(self.sink_stream.data)
+        if current_pos == self._stall_check_position:
+            blocks = self._find_stream_ahead(live_only=True)
+            if blocks is not None:
+                self._follow(blocks, "stall")
+        self._stall_check_position = len(self.sink_stream.data)
+        self._stall_check = get_timer_wheel().call_later(
+            self._stall_check_period, self._guard_against_stalling)
+
+    def _update_tracking(self):
+        if self._connected >= self._quorum_size and not self._following:
+            self._tracked = None
+            return
+        if self._tracked is not None:
+            return
+        blocks = self._find_stream_ahead(live_only=True)
+        if blocks is not None:
+            self._tracked = blocks.stream
+            self._feed_sink(blocks)
+
+    def _find_stream_ahead(self, live_only):
+        sink_len = len(self.sink_stream.data)
+        for blocks in self._streams.values():
+            if live_only and not blocks.live:
+                continue
+            if (len(blocks.stream.data) > sink_len
+                    and self._matches_sink(blocks)):
+                return blocks
+        return None
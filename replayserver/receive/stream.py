@@ -1,12 +1,34 @@
+import functools
+
 from replayserver.stream import ReplayStream, ConcreteDataMixin, \
     DataEventMixin, HeaderEventMixin, EndedEventMixin
+from replayserver.buffer import SpilledBuffer
 from replayserver.struct.header import ReplayHeader
 from replayserver.errors import MalformedDataError
+from replayserver import metrics
+
+
+class AdaptiveReadSize:
+    """
+    How much to ask for when reading from a connection. Grows while the
+    connection keeps filling our reads up, so that a busy connection costs us
+    fewer reads, and shrinks back once it returns less than we asked for.
+    """
+    def __init__(self, min_size, max_size):
+        self._min_size = min_size
+        self._max_size = max(min_size, max_size)
+        self.value = min_size
+
+    def update(self, read_size):
+        if read_size >= self.value:
+            self.value = min(self.value * 2, self._max_size)
+        elif read_size < self.value // 2:
+            self.value = max(self.value // 2, self._min_size)
 
 
 class ConnectionReplayStream(ConcreteDataMixin, DataEventMixin,
                              HeaderEventMixin, EndedEventMixin, ReplayStream):
-    def __init__(self, header_reader, connection):
+    def __init__(self, header_reader, connection, read_size):
         ConcreteDataMixin.__init__(self)
         DataEventMixin.__init__(self)
         HeaderEventMixin.__init__(self)
@@ -15,16 +37,23 @@ class ConnectionReplayStream(ConcreteDataMixin, DataEventMixin,
 
         self._header_reader = header_reader
         self._connection = connection
+        self._read_size = read_size
         self._leftovers = b""
 
     @classmethod
-    def build(cls, connection, **kwargs):
-        header_reader = ReplayHeader.from_connection
-        return cls(header_reader, connection)
+    def build(cls, connection, *, config_connection_read_size_min,
+              config_connection_read_size_max, config_replay_header_parser,
+              **kwargs):
+        header_reader = functools.partial(ReplayHeader.from_connection,
+                                          parser=config_replay_header_parser)
+        read_size = AdaptiveReadSize(config_connection_read_size_min,
+                                     config_connection_read_size_max)
+        return cls(header_reader, connection, read_size)
 
     async def read_header(self):
         try:
-            result = await self._header_reader(self._connection)
+            result = await self._header_reader(self._connection,
+                                               self._read_size.value)
             # Don't add leftover data right away, caller doesn't expect that
             self._header, self._leftovers = result
         except MalformedDataError:
@@ -32,32 +61,59 @@ class ConnectionReplayStream(ConcreteDataMixin, DataEventMixin,
             raise
         finally:
             self._signal_header_read_or_ended()
+            self._run_data_callbacks()
 
     async def read(self):
         if self._leftovers:
             data = self._leftovers
             self._leftovers = b""
         else:
-            data = await self._connection.read(4096)
+            data = await self._read_from_connection()
             if not data:
                 self._end()
+            elif self._data.discarded:
+                metrics.discarded_diverged_bytes.inc(len(data))
         self._data += data
         self._signal_new_data_or_ended()
 
+    def discard_data(self):
+        freed = ConcreteDataMixin.discard_data(self)
+        metrics.discarded_diverged_bytes.inc(freed)
+        return freed
+
+    async def _read_from_connection(self):
+        size = self._read_size.value
+        data = await self._connection.read(size)
+        self._read_size.update(len(data))
+        metrics.connection_read_size.observe(size)
+        metrics.connection_read_chunks.inc()
+        return data
+
 
 class OutsideSourceReplayStream(ConcreteDataMixin, DataEventMixin,
                                 HeaderEventMixin, EndedEventMixin,
                                 ReplayStream):
-    def __init__(self):
-        ConcreteDataMixin.__init__(self)
+    def __init__(self, data=None):
+        ConcreteDataMixin.__init__(self, data)
         DataEventMixin.__init__(self)
         HeaderEventMixin.__init__(self)
         EndedEventMixin.__init__(self)
         ReplayStream.__init__(self)
 
+    @classmethod
+    def build(cls, *, config_replay_spill_dir, config_replay_spill_hot_window,
+              config_replay_spill_segment_size, **kwargs):
+        if config_replay_spill_dir is None:
+            return cls()
+        data = SpilledBuffer(config_replay_spill_dir,
+                             config_replay_spill_hot_window,
+                             config_replay_spill_segment_size)
+        return cls(data)
+
     def set_header(self, header):
         self._header = header
         self._signal_header_read_or_ended()
+        self._run_data_callbacks()
 
     def feed_data(self, data):
         self._data += data
@@ -1,32 +1,36 @@
-import asyncio
-from asyncio.locks import Event
 from contextlib import contextmanager
 
 from replayserver.send.stream import DelayedReplayStream
 from replayserver.errors import MalformedDataError, \
     CannotAcceptConnectionError
-from replayserver.collections import AsyncCounter
+from replayserver.collections import CallbackEvent
 
 
 class Sender:
+    """
+    Sends the delayed replay stream to readers. Ends once the stream ended
+    and the last reader is done. Checked whenever either happens, so an idle
+    sender doesn't need a task of its own.
+    """
     def __init__(self, delayed_stream):
         self._stream = delayed_stream
-        self._conn_count = AsyncCounter()
-        self._ended = Event()
-        asyncio.ensure_future(self._lifetime())
+        self._conn_count = 0
+        self._ended = CallbackEvent()
+        self._stream.add_end_callback(self._check_ended)
 
     @classmethod
-    def build(cls, stream, **kwargs):
-        delayed_stream = DelayedReplayStream.build(stream, **kwargs)
+    def build(cls, stream, ticker, **kwargs):
+        delayed_stream = DelayedReplayStream.build(stream, ticker, **kwargs)
         return cls(delayed_stream)
 
     @contextmanager
     def _connection_count(self):
-        self._conn_count.inc()
+        self._conn_count += 1
         try:
             yield
         finally:
-            self._conn_count.dec()
+            self._conn_count -= 1
+            self._check_ended()
 
     async def handle_connection(self, connection):
         if self._stream.ended():
@@ -56,10 +60,12 @@ class Sender:
     def close(self):
         pass
 
-    async def _lifetime(self):
-        await self._stream.wait_for_ended()
-        await self._conn_count.wait_until_empty()
-        self._ended.set()
+    def _check_ended(self):
+        if self._stream.ended() and self._conn_count == 0:
+            self._ended.set()
 
     async def wait_for_ended(self):
         await self._ended.wait()
+
+    def add_end_callback(self, callback):
+        self._ended.add_callback(callback)
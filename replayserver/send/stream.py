@@ -1,25 +1,18 @@
-import asyncio
 from replayserver.stream import ReplayStream, DataEventMixin, EndedEventMixin
-from replayserver.send.timestamp import Timestamp
 
 
 class DelayedReplayStream(DataEventMixin, EndedEventMixin, ReplayStream):
-    def __init__(self, stream, timestamp):
+    def __init__(self, stream, ticker):
         DataEventMixin.__init__(self)
         EndedEventMixin.__init__(self)
         ReplayStream.__init__(self)
         self._stream = stream
-        self._timestamp = timestamp
         self._current_position = 0
-        asyncio.ensure_future(self._track_current_position())
+        ticker.track(stream, self._update_position)
 
     @classmethod
-    def build(cls, stream, *, config_sent_replay_position_update_interval,
-              config_sent_replay_delay, **kwargs):
-        timestamp = Timestamp(stream,
-                              config_sent_replay_position_update_interval,
-                              config_sent_replay_delay)
-        return cls(stream, timestamp)
+    def build(cls, stream, ticker, **kwargs):
+        return cls(stream, ticker)
 
     @property
     def header(self):
@@ -46,11 +39,10 @@ class DelayedReplayStream(DataEventMixin, EndedEventMixin, ReplayStream):
     def _data_bytes(self):
         return self._stream.data[:self._current_position]
 
-    async def _track_current_position(self):
-        async for position in self._timestamp.timestamps():
-            if position <= self._current_position:
-                continue
+    def _update_position(self, position, ended):
+        if position > self._current_position:
             self._current_position = position
             self._signal_new_data_or_ended()
-        self._end()
-        self._signal_new_data_or_ended()
+        if ended:
+            self._end()
+            self._signal_new_data_or_ended()
@@ -1,20 +1,82 @@
 import asyncio
 import math
-from collections import deque
+from array import array
 
 
 class Timestamp:
+    """
+    Remembers how much data a stream had over the last 'delay' seconds,
+    sampled every 'interval' seconds. Samples are kept in a fixed-size ring
+    of integers.
+    """
     def __init__(self, stream, interval, delay):
         self._stream = stream
+        # Oldest of n+1 samples is from n intervals ago
+        stamp_number = math.ceil(delay / interval) + 1
+        self._stamps = array("Q", [0]) * stamp_number
+        self._next = 0
+
+    def stamp(self):
+        """
+        Samples stream length. Returns stream length from 'delay' seconds
+        ago, or current length if the stream ended.
+        """
+        if self._stream.ended():
+            return len(self._stream.data)
+        self._stamps[self._next] = len(self._stream.data)
+        self._next = (self._next + 1) % len(self._stamps)
+        return self._stamps[self._next]
+
+    def ended(self):
+        return self._stream.ended()
+
+
+class TimestampTicker:
+    """
+    Keeps track of delayed positions of all streams we send, using a single
+    timer for all of them instead of one per stream. Every 'interval'
+    seconds each tracked stream is sampled and its callback is called with
+    its delayed position.
+    """
+    def __init__(self, interval, delay):
         self._interval = interval
         self._delay = delay
+        self._tracked = {}  # Timestamp -> callback
+        self._ticking = None
+
+    @classmethod
+    def build(cls, *, config_sent_replay_position_update_interval,
+              config_sent_replay_delay, **kwargs):
+        return cls(config_sent_replay_position_update_interval,
+                   config_sent_replay_delay)
+
+    def track(self, stream, callback):
+        """
+        Call callback(position, ended) on every tick, with position of stream
+        from 'delay' seconds ago, until the stream ends. Once it ends, the
+        callback is called one last time with its final length.
+        """
+        self._tracked[Timestamp(stream, self._interval, self._delay)] = \
+            callback
+        if self._ticking is None:
+            self._ticking = asyncio.ensure_future(self._tick_while_tracking())
+
+    def __len__(self):
+        return len(self._tracked)
+
+    async def _tick_while_tracking(self):
+        try:
+            while True:
+                self._tick()
+                if not self._tracked:
+                    return
+                await asyncio.sleep(self._interval)
+        finally:
+            self._ticking = None
 
-    async def timestamps(self):
-        # Last item in deque size n+1 is from n intervals ago
-        stamp_number = math.ceil(self._delay / self._interval) + 1
-        stamps = deque([0], maxlen=stamp_number)
-        while not self._stream.ended():
-            stamps.append(len(self._stream.data))
-            yield stamps[0]
-            await asyncio.sleep(self._interval)
-        yield len(self._stream.data)
+    def _tick(self):
+        for stamp, callback in list(self._tracked.items()):
+            ended = stamp.ended()
+            if ended:
+                del self._tracked[stamp]
+            callback(stamp.stamp(), ended)
@@ -2,6 +2,7 @@ from enum import Enum
 import asyncio
 from asyncio.streams import IncompleteReadError, LimitOverrunError
 from replayserver.errors import MalformedDataError
+from replayserver.timers import get_timer_wheel
 
 
 class Connection:
@@ -66,7 +67,8 @@ class ConnectionHeader:
     @classmethod
     async def read(cls, connection, timeout=60):    # FIXME - hardcoded
         try:
-            return await asyncio.wait_for(cls._do_read(connection), timeout)
+            with get_timer_wheel().timeout(timeout):
+                return await cls._do_read(connection)
         except asyncio.TimeoutError:
             raise MalformedDataError("Timed out while reading header")
 
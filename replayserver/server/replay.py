@@ -1,15 +1,30 @@
 import asyncio
-from asyncio.locks import Event
 from contextlib import contextmanager
+from enum import Enum
 
 from replayserver.server.connection import ConnectionHeader
 from replayserver.send.sender import Sender
 from replayserver.receive.merger import Merger
+from replayserver.collections import CallbackEvent
 from replayserver.errors import MalformedDataError
 from replayserver.logging import logger
+from replayserver.timers import get_timer_wheel
+
+
+class ReplayState(Enum):
+    WRITING = "writing"     # Merging data from writers
+    SAVING = "saving"       # Writers are done, saving the replay
+    DRAINING = "draining"   # Saved, waiting for readers to finish
+    ENDED = "ended"
 
 
 class Replay:
+    """
+    Goes through ReplayState phases in order. Each transition is triggered
+    by an event - merger or sender ending, or saving finishing - so a replay
+    only has a task while it's being saved. Timeout force-closes the replay
+    if it takes too long.
+    """
     def __init__(self, merger, sender, bookkeeper, timeout, game_id):
         self.merger = merger
         self.sender = sender
@@ -17,15 +32,18 @@ class Replay:
         self._game_id = game_id
         self._connections = set()
         self._timeout = timeout
-        self._ended = Event()
-        asyncio.ensure_future(self._lifetime())
-        self._force_close = asyncio.ensure_future(self._timeout_force_close())
+        self.state = ReplayState.WRITING
+        self._ended = CallbackEvent()
+        self._force_close = get_timer_wheel().call_later(
+            timeout, self._timeout_force_close)
+        self.merger.add_end_callback(self._writing_ended)
 
     @classmethod
-    def build(cls, game_id, bookkeeper, *, config_replay_forced_end_time,
-              **kwargs):
+    def build(cls, game_id, bookkeeper, ticker, *,
+              config_replay_forced_end_time, **kwargs):
         merger = Merger.build(**kwargs)
-        sender = Sender.build(merger.canonical_stream, **kwargs)
+        sender = Sender.build(merger.canonical_stream, ticker, **kwargs)
+        bookkeeper.prepare_replay(game_id, merger.canonical_stream)
         return cls(merger, sender, bookkeeper, config_replay_forced_end_time,
                    game_id)
 
@@ -54,26 +72,34 @@ class Replay:
         for connection in self._connections:
             connection.close()
 
-    async def _timeout_force_close(self):
-        try:
-            await asyncio.wait_for(self.wait_for_ended(),
-                                   timeout=self._timeout)
-        except asyncio.TimeoutError:
-            logger.info(f"Timeout - force-ending {self}")
-            self.close()
-
-    async def _lifetime(self):
-        await self.merger.wait_for_ended()
+    def _timeout_force_close(self):
+        logger.info(f"Timeout - force-ending {self}")
+        self.close()
+
+    def _writing_ended(self):
         logger.debug(f"{self} write phase ended")
+        self.state = ReplayState.SAVING
+        asyncio.ensure_future(self._save())
+
+    async def _save(self):
         await self.bookkeeper.save_replay(self._game_id,
                                           self.merger.canonical_stream)
-        await self.sender.wait_for_ended()
+        self.state = ReplayState.DRAINING
+        self.sender.add_end_callback(self._sending_ended)
+
+    def _sending_ended(self):
         self._force_close.cancel()
+        # Saved and sent, nobody needs replay data anymore
+        self.merger.canonical_stream.close_data()
+        self.state = ReplayState.ENDED
         self._ended.set()
         logger.debug(f"Lifetime of {self} ended")
 
     async def wait_for_ended(self):
         await self._ended.wait()
 
+    def add_end_callback(self, callback):
+        self._ended.add_callback(callback)
+
     def __str__(self):
         return f"Replay {self._game_id}"
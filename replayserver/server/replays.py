@@ -1,8 +1,9 @@
-import asyncio
+from functools import partial
 
 from replayserver import metrics
 from replayserver.collections import AsyncDict
 from replayserver.server.replay import Replay
+from replayserver.send.timestamp import TimestampTicker
 from replayserver.server.connection import ConnectionHeader
 from replayserver.errors import CannotAcceptConnectionError
 from replayserver.logging import logger
@@ -16,7 +17,10 @@ class Replays:
 
     @classmethod
     def build(cls, bookkeeper, **kwargs):
-        return cls(lambda game_id: Replay.build(game_id, bookkeeper, **kwargs))
+        # Shared by all replays, so they don't need a timer each
+        ticker = TimestampTicker.build(**kwargs)
+        return cls(lambda game_id: Replay.build(game_id, bookkeeper, ticker,
+                                                **kwargs))
 
     async def handle_connection(self, header, connection):
         replay = self._get_matching_replay(header)
@@ -41,12 +45,11 @@ class Replays:
     def _create(self, game_id):
         replay = self._replay_builder(game_id)
         self._replays[game_id] = replay
-        asyncio.ensure_future(self._remove_replay_when_done(game_id, replay))
+        replay.add_end_callback(partial(self._remove_replay, game_id))
         logger.debug(f"New Replay created: id {game_id}")
         metrics.running_replays.inc()
 
-    async def _remove_replay_when_done(self, game_id, replay):
-        await replay.wait_for_ended()
+    def _remove_replay(self, game_id):
         self._replays.pop(game_id, None)
         logger.debug(f"Replay removed: id {game_id}")
         metrics.running_replays.dec()
@@ -2,7 +2,7 @@ from asyncio.locks import Event
 import prometheus_client
 
 from replayserver.server.connectionproducer import ConnectionProducer
-from replayserver.bookkeeping.database import Database
+from replayserver.bookkeeping.database import build_database
 from replayserver.server.connections import Connections
 from replayserver.server.replays import Replays
 from replayserver.bookkeeping.bookkeeper import Bookkeeper
@@ -24,7 +24,7 @@ class Server:
     @classmethod
     def build(cls, *,
               dep_connection_producer=ConnectionProducer.build,
-              dep_database=Database.build,
+              dep_database=build_database,
               config_prometheus_port,
               **kwargs):
         database = dep_database(**kwargs)
@@ -39,6 +39,7 @@ class Server:
         if self._prometheus_port is not None:
             prometheus_client.start_http_server(self._prometheus_port)
         await self._database.start()
+        await self._bookkeper.start()
         await self._connection_producer.start()
         self._stopped.clear()
 
@@ -47,6 +48,7 @@ class Server:
         self._connections.close_all()
         await self._replays.stop_all()
         await self._connections.wait_until_empty()
+        await self._bookkeper.stop()
         await self._database.stop()
         self._stopped.set()
 
@@ -1,5 +1,8 @@
 from asyncio.locks import Event
 
+from replayserver.buffer import ChunkedBuffer
+from replayserver.collections import CallbackEvent
+
 
 class ReplayStreamData:
     def __init__(self, stream):
@@ -16,6 +19,13 @@ class ReplayStreamData:
     def bytes(self):
         return self._stream._data_bytes()
 
+    def chunks(self, start=0, stop=None):
+        """
+        Iterate over data between start and stop in pieces, avoiding copies
+        where the stream allows it.
+        """
+        return self._stream._data_chunks(start, stop)
+
 
 class ReplayStream:
     """
@@ -61,6 +71,9 @@ class ReplayStream:
     def _data_bytes(self):
         raise NotImplementedError
 
+    def _data_chunks(self, start, stop):
+        yield self._data_slice(slice(start, stop))
+
     async def wait_for_data(self, position=None):
         """
         Wait until there is data after current position (or 'position', if
@@ -73,6 +86,14 @@ class ReplayStream:
         """
         raise NotImplementedError
 
+    def add_data_callback(self, callback):
+        """
+        Call callback() once, the next time the header or new data arrives
+        or the stream ends. Unlike wait_for_data, doesn't need a task waiting
+        for it.
+        """
+        raise NotImplementedError
+
     def ended(self):
         """
         Whether the stream is finished processing. MUST return True if there
@@ -83,6 +104,13 @@ class ReplayStream:
     async def wait_for_ended(self):
         raise NotImplementedError
 
+    def add_end_callback(self, callback):
+        """
+        Call callback() once the stream ends, or right away if it already
+        ended.
+        """
+        raise NotImplementedError
+
 
 class HeaderEventMixin:
     """ Useful when the class adds header via a coroutine. """
@@ -101,10 +129,20 @@ class DataEventMixin:
     """ Useful when the class adds data via a coroutine. """
     def __init__(self):
         self._new_data_or_ended = Event()
+        self._data_callbacks = []
 
     def _signal_new_data_or_ended(self):
         self._new_data_or_ended.set()
         self._new_data_or_ended.clear()
+        self._run_data_callbacks()
+
+    def _run_data_callbacks(self):
+        callbacks, self._data_callbacks = self._data_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_data_callback(self, callback):
+        self._data_callbacks.append(callback)
 
     def wait_for_data(self, position=None):
         if position is None:
@@ -121,7 +159,7 @@ class DataEventMixin:
 
 class EndedEventMixin:
     def __init__(self):
-        self._ended = Event()
+        self._ended = CallbackEvent()
 
     def _end(self):
         self._ended.set()
@@ -132,12 +170,18 @@ class EndedEventMixin:
     async def wait_for_ended(self):
         await self._ended.wait()
 
+    def add_end_callback(self, callback):
+        self._ended.add_callback(callback)
+
 
 class ConcreteDataMixin:
-    """ Useful when the class holds the data instead of proxying it. """
-    def __init__(self):
+    """
+    Useful when the class holds the data instead of proxying it. Data is kept
+    in a ChunkedBuffer, unless given a different buffer with same interface.
+    """
+    def __init__(self, data=None):
         self._header = None
-        self._data = bytearray()
+        self._data = ChunkedBuffer() if data is None else data
 
     @property
     def header(self):
@@ -150,4 +194,29 @@ class ConcreteDataMixin:
         return self._data[s]
 
     def _data_bytes(self):
-        return self._data
+        return self._data.bytes()
+
+    def _data_chunks(self, start, stop):
+        return self._data.chunks(start, stop)
+
+    def share_data_prefix(self, stream, length):
+        """
+        Stop keeping our own copy of data up to length and read it from
+        stream instead. Stream's data MUST be the same as ours up to length.
+        """
+        self._data.share_prefix(stream.data, length)
+
+    def close_data(self):
+        """
+        Release resources our data holds besides memory, like spill files.
+        Call once nobody is going to read the data anymore.
+        """
+        self._data.close()
+
+    def discard_data(self):
+        """
+        Stop keeping our data, now and in the future. Data length is still
+        tracked, but data itself can't be accessed anymore. Returns amount of
+        data that was freed.
+        """
+        return self._data.discard()
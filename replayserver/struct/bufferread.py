@@ -0,0 +1,64 @@
+class NeedMoreData(Exception):
+    """
+    Raised when reading past the end of available data. Carries the total
+    amount of data needed to get further than we did.
+    """
+    def __init__(self, needed):
+        Exception.__init__(self, needed)
+        self.needed = needed
+
+
+class BufferReader:
+    """
+    Reads values from a buffer (bytes or bytearray) at explicit offsets,
+    without copying it. If there isn't enough data, raises NeedMoreData
+    instead of waiting for it.
+
+    Since parsing is retried from the start once more data arrives, a
+    'scanned' dict can be shared between readers of the same, growing buffer.
+    It remembers how far take_until already searched without finding the
+    terminator, so that a long unterminated value isn't rescanned every time.
+    """
+    def __init__(self, data, maxlen=None, scanned=None):
+        self._data = data
+        self._view = memoryview(data)
+        self.position = 0
+        self._maxlen = maxlen
+        self._scanned = {} if scanned is None else scanned
+
+    def release(self):
+        """
+        Release our view of the buffer, so that a bytearray can be resized
+        again. Views returned by take() have to be gone by then.
+        """
+        self._view.release()
+
+    def _ensure(self, end):
+        if self._maxlen is not None and end > self._maxlen:
+            raise ValueError(f"Exceeded maximum read length {self._maxlen}")
+        if end > len(self._data):
+            raise NeedMoreData(end)
+
+    def take(self, amount):
+        end = self.position + amount
+        self._ensure(end)
+        data = self._view[self.position:end]
+        self.position = end
+        return data
+
+    def unpack(self, struct):
+        """ Read a single value using a precompiled struct.Struct. """
+        self._ensure(self.position + struct.size)
+        value = struct.unpack_from(self._view, self.position)[0]
+        self.position += struct.size
+        return value
+
+    def take_until(self, b):
+        start = self._scanned.get(self.position, self.position)
+        end = self._data.find(b, start)
+        if end == -1:
+            # A longer terminator might straddle the current end
+            self._scanned[self.position] = max(
+                self.position, len(self._data) - len(b) + 1)
+            self._ensure(len(self._data) + 1)
+        return self.take(end - self.position + 1)   # Take inclusive
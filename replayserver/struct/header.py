@@ -3,6 +3,7 @@ from enum import Enum
 
 from replayserver.struct.streamread import GeneratorData, read_exactly, \
     read_until
+from replayserver.struct.bufferread import BufferReader, NeedMoreData
 from replayserver.errors import MalformedDataError
 
 
@@ -119,6 +120,114 @@ def read_header(gen):
     return result
 
 
+# Below is the same parser working on a buffer we already have instead of
+# suspending generators. It is all-or-nothing - if the data is incomplete, we
+# learn how much more we need and have to parse again once we have it.
+UINT8 = struct.Struct("<B")
+INT8 = struct.Struct("<b")
+UINT32 = struct.Struct("<I")
+FLOAT = struct.Struct("<f")
+
+
+def parse_string(buf):
+    data = buf.take_until(b'\0')
+    return str(data[:-1], "utf-8")  # can raise UnicodeDecodeError
+
+
+def parse_lua_value(buf, lua_dict_depth=0, can_be_lua_end=False):
+    type_ = LuaType(buf.unpack(UINT8))     # can raise ValueError
+
+    if type_ == LuaType.NUMBER:
+        return buf.unpack(FLOAT)
+    elif type_ == LuaType.STRING:
+        return parse_string(buf)
+    elif type_ == LuaType.NIL:
+        return None
+    elif type_ == LuaType.BOOL:
+        return buf.unpack(UINT8) == 0   # Not a typo
+    elif type_ == LuaType.LUA_END:
+        if can_be_lua_end:
+            return LuaType.LUA_END
+        else:
+            raise ValueError("Unexpected lua table end")
+    elif type_ == LuaType.LUA:
+        if lua_dict_depth > 30:
+            raise ValueError("Exceeded maximum lua table nesting")
+        result = {}
+        while True:
+            key = parse_lua_value(buf, lua_dict_depth + 1, True)
+            if key == LuaType.LUA_END:
+                return result
+            value = parse_lua_value(buf, lua_dict_depth + 1)
+            if isinstance(key, dict):
+                raise ValueError("Lua tables as table keys are not supported")
+            result[key] = value
+
+
+def _parse_header(buf):
+    result = {}
+    result["version"] = parse_string(buf)
+    buf.take(3)     # skip
+
+    replay_version_and_map = parse_string(buf)
+    # can raise ValueError
+    replay_version, map_name = replay_version_and_map.split("\r\n", 2)
+    result["replay_version"] = replay_version
+    result["map_name"] = map_name
+    buf.take(4)     # skip
+
+    buf.unpack(UINT32)  # Mod (data?) size
+    result["mods"] = parse_lua_value(buf)
+
+    ssize = buf.unpack(UINT32)  # Scenario (data?) size
+    buf.take(ssize)
+
+    player_count = buf.unpack(INT8)
+    timeouts = {}
+    for i in range(player_count):
+        name = parse_string(buf)
+        timeouts[name] = buf.unpack(UINT32)
+    result["remaining_timeouts"] = timeouts
+
+    result["cheats_enabled"] = buf.unpack(UINT8)
+
+    army_count = buf.unpack(UINT8)
+    for i in range(army_count):
+        ssize = buf.unpack(UINT32)  # Army (data?) size
+        buf.take(ssize)
+        player_id = buf.unpack(UINT8)
+        if player_id != 255:
+            buf.take(1)     # Unknown skip
+
+    result["random_seed"] = buf.unpack(UINT32)
+    return result
+
+
+def parse_header(data, maxlen=None, scanned=None):
+    """
+    Parses the header at the start of data (bytes or bytearray). Returns a
+    (header, header_length) pair. If data is incomplete, returns
+    (None, needed_length) instead, where needed_length is how much data we
+    need at least before trying again. Raises ValueError on invalid data.
+
+    When retrying with more data, pass the same 'scanned' dict each time so
+    that string terminators aren't searched for from scratch.
+    """
+    buf = BufferReader(data, maxlen, scanned)
+    try:
+        header = _parse_header(buf)
+        return header, buf.position
+    except NeedMoreData as e:
+        return None, e.needed
+    finally:
+        buf.release()
+
+
+class HeaderParser(Enum):
+    GENERATOR = "GENERATOR"
+    BUFFER = "BUFFER"
+
+
 class ReplayHeader:
     # Headers are pretty large, but 1MB should absolutely be enough
     MAXLEN = 1024 * 1024
@@ -128,11 +237,41 @@ class ReplayHeader:
         self.struct = struct
 
     @classmethod
-    async def from_connection(cls, connection):
+    async def from_connection(cls, connection, read_size=4096,
+                              parser=HeaderParser.BUFFER):
+        if parser == HeaderParser.BUFFER:
+            return await cls._from_connection_buffer(connection, read_size)
+        else:
+            return await cls._from_connection_generator(connection,
+                                                        read_size)
+
+    @classmethod
+    async def _from_connection_buffer(cls, connection, read_size):
+        data = bytearray()
+        needed = 1
+        scanned = {}
+        while True:
+            chunk = await connection.read(read_size)
+            if not chunk:
+                raise MalformedDataError("Replay header ended prematurely")
+            data += chunk
+            if len(data) < needed:
+                continue
+            try:
+                header, length = parse_header(data, cls.MAXLEN,
+                                              scanned)
+            except ValueError as e:
+                raise MalformedDataError("Invalid replay header") from e
+            if header is not None:
+                return cls(data[:length], header), data[length:]
+            needed = length
+
+    @classmethod
+    async def _from_connection_generator(cls, connection, read_size):
         generator = cls._generate(cls.MAXLEN)
         generator.send(None)
         while True:
-            data = await connection.read(4096)  # TODO - configure?
+            data = await connection.read(read_size)
             if not data:
                 raise MalformedDataError("Replay header ended prematurely")
             try:
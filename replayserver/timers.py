@@ -0,0 +1,217 @@
+import asyncio
+import math
+import weakref
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:  # Python 3.6
+    _current_task = asyncio.Task.current_task
+
+
+class TimerHandle:
+    """ A timer scheduled in a TimerWheel. Cancelling it is cheap. """
+    __slots__ = ["tick", "_callback", "_args", "_wheel", "_bucket"]
+
+    def __init__(self, wheel, tick, callback, args):
+        self.tick = tick
+        self._callback = callback
+        self._args = args
+        self._wheel = wheel
+        self._bucket = None
+
+    def cancel(self):
+        if self._bucket is not None:
+            self._wheel._remove(self)
+            # Like asyncio handles, don't keep callback's owner alive
+            self._callback = None
+            self._args = None
+
+    def cancelled(self):
+        return self._bucket is None and self._wheel is not None
+
+    def _run(self):
+        self._wheel = None
+        callback, args = self._callback, self._args
+        self._callback = None
+        self._args = None
+        callback(*args)
+
+
+class _Timeout:
+    def __init__(self, wheel, delay):
+        self._wheel = wheel
+        self._delay = delay
+        self._task = None
+        self._handle = None
+        self._expired = False
+
+    def __enter__(self):
+        self._task = _current_task()
+        self._handle = self._wheel.call_later(self._delay, self._expire)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._handle.cancel()
+        if exc_type is asyncio.CancelledError and self._expired:
+            raise asyncio.TimeoutError from None
+
+    def _expire(self):
+        self._expired = True
+        self._task.cancel()
+
+
+class TimerWheel:
+    """
+    Schedules many coarse, mostly cancelled timers cheaply, like deadlines of
+    replays and connections. Adding or cancelling a timer is O(1) and needs
+    no task or event loop timer of its own. The wheel keeps a single event
+    loop timer. While any timer is pending, it wakes up at least once per
+    rotation of the lowest level (every 0.32s with defaults) to move timers
+    down, and otherwise only for ticks that have a timer due.
+
+    Timers are kept in 'levels' wheels of 'slots' buckets each. A bucket
+    of level n spans slots ** n ticks. Timers are put in the lowest level
+    whose current rotation they fall in, and move to lower levels once time
+    reaches their bucket. Timers that are too far away wait in an overflow
+    bucket. With defaults, a tick is 5ms and levels span 0.32s, 20s, 22min
+    and 23h.
+
+    Timers fire no earlier than requested, and up to a tick late.
+    """
+    def __init__(self, tick=0.005, slots=64, levels=4):
+        self._tick = tick
+        self._slots = slots
+        self._levels = levels
+        self._spans = [slots ** level for level in range(levels + 1)]
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._overflow = {}
+        self._count = 0
+        self._start = None      # Loop time of tick 0, None if idle
+        self._current = 0       # Last tick we processed
+        self._wakeup = None
+        self._wakeup_tick = None
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """ Like loop.call_later, returns a TimerHandle. """
+        now = asyncio.get_event_loop().time()
+        if self._start is None:
+            self._start = now
+            self._current = 0
+        tick = math.ceil((now + delay - self._start) / self._tick)
+        handle = TimerHandle(self, max(tick, self._current + 1), callback,
+                             args)
+        self._insert(handle)
+        self._count += 1
+        if self._wakeup is None or self._wakeup_tick > handle.tick:
+            self._schedule_wakeup()
+        return handle
+
+    def timeout(self, delay):
+        """
+        Context manager that cancels the current task if it doesn't leave
+        the block within delay seconds, raising asyncio.TimeoutError instead.
+        Unlike asyncio.wait_for, doesn't wrap anything in a new task.
+        """
+        return _Timeout(self, delay)
+
+    def _insert(self, handle):
+        t = handle.tick
+        spans = self._spans
+        for level in range(self._levels):
+            if t // spans[level + 1] == self._current // spans[level + 1]:
+                slot = (t // spans[level]) % self._slots
+                bucket = self._wheels[level][slot]
+                break
+        else:
+            bucket = self._overflow
+        bucket[handle] = None
+        handle._bucket = bucket
+
+    def _remove(self, handle):
+        del handle._bucket[handle]
+        handle._bucket = None
+        self._count -= 1
+        # If that was the last timer, we'll go idle on next wakeup
+
+    def _cascade(self, bucket):
+        for handle in bucket:
+            self._insert(handle)
+
+    def _process_tick(self, tick):
+        self._current = tick
+        s = self._slots
+        if tick % self._spans[self._levels] == 0:
+            overflow, self._overflow = self._overflow, {}
+            self._cascade(overflow)
+        for level in reversed(range(1, self._levels)):
+            if tick % self._spans[level] == 0:
+                slot = (tick // self._spans[level]) % s
+                bucket, self._wheels[level][slot] = \
+                    self._wheels[level][slot], {}
+                self._cascade(bucket)
+        due, self._wheels[0][tick % s] = self._wheels[0][tick % s], {}
+        for handle in due:
+            if handle._bucket is not due:
+                continue    # Cancelled by an earlier callback
+            handle._bucket = None
+            self._count -= 1
+            try:
+                handle._run()
+            except Exception as e:
+                asyncio.get_event_loop().call_exception_handler({
+                    "message": "Exception in timer wheel callback",
+                    "exception": e,
+                })
+
+    def _next_due_tick(self):
+        # Either a due bucket in current rotation, or next time we cascade
+        s = self._slots
+        rotation_end = (self._current // s + 1) * s
+        for tick in range(self._current + 1, rotation_end):
+            if self._wheels[0][tick % s]:
+                return tick
+        return rotation_end
+
+    def _schedule_wakeup(self):
+        tick = self._next_due_tick()
+        if self._wakeup is not None:
+            if self._wakeup_tick <= tick:
+                return
+            self._wakeup.cancel()
+        loop = asyncio.get_event_loop()
+        self._wakeup = loop.call_at(self._start + tick * self._tick,
+                                    self._on_wakeup)
+        self._wakeup_tick = tick
+
+    def _on_wakeup(self):
+        now = asyncio.get_event_loop().time()
+        target = max(self._wakeup_tick,
+                     math.floor((now - self._start) / self._tick))
+        self._wakeup = None
+        while self._count > 0:
+            tick = self._next_due_tick()
+            if tick > target:
+                break
+            self._process_tick(tick)
+        # Nothing due until target, so no need to process ticks in between
+        self._current = max(self._current, target)
+        if self._count > 0:
+            self._schedule_wakeup()
+        else:
+            self._start = None
+
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+def get_timer_wheel():
+    """ Returns the timer wheel of the current event loop. """
+    loop = asyncio.get_event_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = TimerWheel()
+        _wheels[loop] = wheel
+    return wheel
@@ -6,7 +6,7 @@ from tests.timeskipper import TimeSkipper
 from tests.docker_db_config import docker_faf_db_config
 
 __all__ = ["timeout", "fast_forward_time", "TimeSkipper",
-           "skip_if_needs_asynctest_107", "slow_test",
+           "skip_if_needs_asynctest_107", "slow_test", "benchmark",
            "docker_faf_db_config"]
 
 
@@ -52,3 +52,9 @@ def slow_test(fn):
     return unittest.skipIf(
         "SKIP_SLOW_TESTS" in os.environ,
         "Test is slow")(fn)
+
+
+def benchmark(fn):
+    return unittest.skipUnless(
+        "RUN_BENCHMARKS" in os.environ,
+        "Benchmark, set RUN_BENCHMARKS to run")(fn)
@@ -0,0 +1,40 @@
+import time
+import tracemalloc
+
+from tests import benchmark
+from replayserver.buffer import ChunkedBuffer
+
+
+CHUNK = b"x" * 4096
+TOTAL = 64 * 1024 * 1024
+
+
+def fill(buf):
+    for _ in range(TOTAL // len(CHUNK)):
+        # Data arriving from a socket is a fresh bytes object every time
+        buf += bytes(memoryview(CHUNK))
+    return buf
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    buf = fill(build())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for pos in range(0, TOTAL, TOTAL // 1000):
+        buf[pos:pos + 4096]
+    sliced = time.perf_counter() - start
+    return elapsed, peak, sliced
+
+
+@benchmark
+def test_benchmark_buffer_append():
+    for name, build in [("bytearray", bytearray),
+                        ("ChunkedBuffer", ChunkedBuffer)]:
+        elapsed, peak, sliced = measure(build)
+        print(f"\n{name}: appended {TOTAL // 2**20}MB in {elapsed:.3f}s, "
+              f"peak {peak / 2**20:.1f}MB, 1000 slices in {sliced:.4f}s")
@@ -0,0 +1,94 @@
+import pytest
+import asyncio
+import time
+
+from tests import benchmark
+from tests.replays import example_replay
+from replayserver.bookkeeping.compression import ReplayCompressor, \
+    ParallelReplayCompressor
+from replayserver.bookkeeping.executor import CompressionExecutor
+from replayserver.receive.stream import OutsideSourceReplayStream
+
+
+TOTAL = 32 * 1024 * 1024
+BATCH = 1024 * 1024
+MIN_BLOCK = 128 * 1024
+INCREMENTAL_TOTAL = 4 * 1024 * 1024
+ARRIVAL = 4 * 1024      # Roughly what a game sends at once
+
+
+class Header:
+    data = example_replay.header_data
+
+
+def replay_body(total=TOTAL):
+    # Replays are mostly repetitive command streams, repeat a real one
+    body = example_replay.data[len(example_replay.header_data):]
+    return body * (total // len(body))
+
+
+def replay_stream():
+    stream = OutsideSourceReplayStream()
+    stream.set_header(Header())
+    stream.feed_data(replay_body())
+    stream.finish()
+    return stream
+
+
+def make_compressor(stream, level, workers, min_block):
+    executor = CompressionExecutor(workers, 16)
+    if workers == 1:
+        return ReplayCompressor(stream, executor, BATCH, level)
+    return ParallelReplayCompressor(stream, executor, BATCH, level, workers,
+                                    min_block)
+
+
+async def run_compression(level, workers):
+    stream = replay_stream()
+    start = time.perf_counter()
+    compressor = make_compressor(stream, level, workers, MIN_BLOCK)
+    length, compressed = await compressor.finish()
+    elapsed = time.perf_counter() - start
+    return elapsed, length, sum(len(c) for c in compressed)
+
+
+async def run_incremental_compression(workers, min_block):
+    # Data arrives in small pieces over time, like from a live game. What
+    # counts is how long it takes to finish compressing once the game ends.
+    body = replay_body(INCREMENTAL_TOTAL)
+    stream = OutsideSourceReplayStream()
+    compressor = make_compressor(stream, 6, workers, min_block)
+    stream.set_header(Header())
+    for i in range(0, len(body), ARRIVAL):
+        stream.feed_data(body[i:i + ARRIVAL])
+        await asyncio.sleep(0.0001)
+    start = time.perf_counter()
+    stream.finish()
+    length, compressed = await compressor.finish()
+    elapsed = time.perf_counter() - start
+    # One piece per compressed batch, plus a few for header and trailer
+    return elapsed, length, sum(len(c) for c in compressed), len(compressed)
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_benchmark_compression(event_loop):
+    print()
+    for level in [1, 6, 9]:
+        for workers in [1, 2, 4]:
+            elapsed, length, size = await run_compression(level, workers)
+            print(f"Level {level}, {workers} workers: {elapsed * 1000:.0f}ms,"
+                  f" {length / elapsed / 2**20:.0f}MB/s, "
+                  f"compressed to {size / length * 100:.2f}%")
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_benchmark_incremental_compression(event_loop):
+    print()
+    for workers, min_block in [(1, 0), (4, 0), (4, MIN_BLOCK)]:
+        elapsed, length, size, pieces = await run_incremental_compression(
+            workers, min_block)
+        print(f"{workers} workers, min block {min_block // 1024}KB: "
+              f"{elapsed * 1000:.1f}ms to finish, {pieces} pieces, "
+              f"compressed to {size / length * 100:.2f}%")
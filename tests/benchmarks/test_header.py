@@ -0,0 +1,41 @@
+import time
+
+from tests import benchmark
+from tests.replays import example_replay
+from replayserver.struct.header import ReplayHeader, parse_header
+
+
+ROUNDS = 2000
+CHUNK = 4096
+
+
+def parse_with_generator(data):
+    generator = ReplayHeader._generate(ReplayHeader.MAXLEN)
+    generator.send(None)
+    for pos in range(0, len(data), CHUNK):
+        try:
+            generator.send(data[pos:pos + CHUNK])
+        except StopIteration as v:
+            return v.value
+
+
+def parse_with_buffer(data):
+    buf = bytearray()
+    for pos in range(0, len(data), CHUNK):
+        buf += data[pos:pos + CHUNK]
+        header, length = parse_header(buf, ReplayHeader.MAXLEN)
+        if header is not None:
+            return header
+
+
+@benchmark
+def test_benchmark_header_parsers():
+    data = bytes(example_replay.data)
+    for name, parse in [("generator", parse_with_generator),
+                        ("buffer", parse_with_buffer)]:
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            parse(data)
+        elapsed = time.perf_counter() - start
+        print(f"\n{name} parser: {ROUNDS} example headers in {elapsed:.3f}s, "
+              f"{elapsed / ROUNDS * 1e6:.1f}us per header")
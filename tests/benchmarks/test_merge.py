@@ -0,0 +1,73 @@
+import pytest
+import time
+
+from tests import benchmark
+from replayserver.receive.mergestrategy import MergeStrategies
+from replayserver.receive.stream import OutsideSourceReplayStream
+from replayserver.stream import ReplayStream, ConcreteDataMixin
+
+
+CHUNK = 4096
+TOTAL = 32 * 1024 * 1024
+config = {
+    "config_mergestrategy_stall_check_period": 60,
+    "config_mergestrategy_share_matching_data": False,
+    "config_mergestrategy_discard_diverged_data": False,
+    "config_mergestrategy_failover_lead_bytes": 0,
+    "config_mergestrategy_failover_lead_time": 0,
+    "config_mergestrategy_quorum_size": 2,
+    "config_mergestrategy_quorum_block_size": 4096,
+}
+
+
+class WriterStream(ConcreteDataMixin, ReplayStream):
+    def __init__(self):
+        ConcreteDataMixin.__init__(self)
+        ReplayStream.__init__(self)
+        self._header = "Header"
+
+    def ended(self):
+        return False
+
+
+def run_merge(strategy, writers, extra_config):
+    sink = OutsideSourceReplayStream()
+    strat = strategy.build(sink, **dict(config, **extra_config))
+    streams = [WriterStream() for _ in range(writers)]
+    for stream in streams:
+        strat.stream_added(stream)
+        strat.new_header(stream)
+
+    payload = b"x" * CHUNK
+    start = time.perf_counter()
+    for _ in range(TOTAL // CHUNK):
+        for stream in streams:
+            # Every connection gives us its own bytes object
+            stream._data += bytes(memoryview(payload))
+            strat.new_data(stream)
+    elapsed = time.perf_counter() - start
+
+    for stream in streams:
+        strat.stream_removed(stream)
+    strat.finalize()
+    assert len(sink.data) == TOTAL
+    return elapsed
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_benchmark_merge_throughput():
+    print()
+    for strategy, extra_config in [
+            (MergeStrategies.GREEDY, {}),
+            (MergeStrategies.FOLLOW_STREAM, {}),
+            (MergeStrategies.FOLLOW_STREAM,
+             {"config_mergestrategy_share_matching_data": True}),
+            (MergeStrategies.QUORUM, {}),
+            (MergeStrategies.QUORUM,
+             {"config_mergestrategy_quorum_block_size": 64 * 1024})]:
+        for writers in [2, 8, 12]:
+            elapsed = run_merge(strategy, writers, extra_config)
+            mbs = TOTAL / elapsed / 2**20
+            print(f"{strategy.value} {extra_config}, {writers} writers: "
+                  f"{mbs:.0f}MB/s canonical, {mbs * writers:.0f}MB/s total")
@@ -0,0 +1,115 @@
+import pytest
+import asyncio
+import logging
+import time
+import tracemalloc
+
+from tests import benchmark
+from replayserver.bookkeeping.bookkeeper import Bookkeeper
+from replayserver.bookkeeping.commit import SaveDurability
+from replayserver.bookkeeping.sqlite import SqliteDatabase
+from replayserver.logging import logger
+from replayserver.server.replay import Replay
+from replayserver.send.timestamp import TimestampTicker
+from replayserver.receive.mergestrategy import MergeStrategies
+from replayserver.struct.header import HeaderParser
+
+
+config = {
+    "config_merger_grace_period_time": 30,
+    "config_replay_merge_strategy": MergeStrategies.FOLLOW_STREAM,
+    "config_mergestrategy_stall_check_period": 60,
+    "config_connection_read_size_min": 4096,
+    "config_connection_read_size_max": 256 * 1024,
+    "config_replay_header_parser": HeaderParser.BUFFER,
+    "config_sent_replay_delay": 5 * 60,
+    "config_sent_replay_position_update_interval": 1,
+    "config_replay_forced_end_time": 5 * 60 * 60,
+    "config_mergestrategy_share_matching_data": False,
+    "config_mergestrategy_discard_diverged_data": False,
+    "config_mergestrategy_failover_lead_bytes": 0,
+    "config_mergestrategy_failover_lead_time": 0,
+    "config_replay_spill_dir": None,
+    "config_replay_spill_hot_window": 8 * 1024 * 1024,
+    "config_replay_spill_segment_size": 64 * 1024 * 1024,
+    "config_replay_compression_batch_size": 1024 * 1024,
+    "config_replay_compression_level": 6,
+    "config_replay_compression_workers": 1,
+    "config_replay_compression_min_block_size": 128 * 1024,
+    "config_db_mod_versions_cache_ttl": 5 * 60,
+    "config_metadata_prefetch": True,
+    "config_metadata_prefetch_delay": 60,
+    "config_metadata_batch_window": 100,
+    "config_save_executor_workers": 2,
+    "config_save_executor_queue_size": 16,
+    "config_compression_executor_workers": 2,
+    "config_compression_executor_queue_size": 16,
+    "config_save_durability": SaveDurability.NONE,
+    "config_save_group_commit_interval": 50,
+    "config_save_spool_dir": None,
+    "config_save_retry_delay": 5,
+    "config_save_retry_max_delay": 5 * 60,
+    "config_save_retry_attempts": 20,
+}
+all_tasks = getattr(asyncio, "all_tasks", asyncio.Task.all_tasks)
+
+
+def loop_state(loop):
+    return len(all_tasks(loop)), len(loop._scheduled)
+
+
+async def run_idle_replays(loop, count, bookkeeper):
+    ticker = TimestampTicker.build(**config)
+    tasks_before, timers_before = loop_state(loop)
+    tracemalloc.start()
+    start = time.perf_counter()
+    replays = [Replay.build(game_id, bookkeeper, ticker, **config)
+               for game_id in range(count)]
+    await asyncio.sleep(0)
+    setup = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tasks, timers = loop_state(loop)
+
+    # Cost of an idle loop iteration with all these replays around
+    start = time.perf_counter()
+    for _ in range(100):
+        await asyncio.sleep(0)
+    idle = (time.perf_counter() - start) / 100
+
+    start = time.perf_counter()
+    for replay in replays:
+        replay.close()
+    await asyncio.gather(*[r.wait_for_ended() for r in replays])
+    close = time.perf_counter() - start
+    return (tasks - tasks_before, timers - timers_before, memory / count,
+            setup, idle, close)
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_benchmark_idle_replays(event_loop, tmpdir):
+    # Real bookkeeper, so that preparing replays for saving is included
+    db = SqliteDatabase(":memory:", 0)
+    await db.start()
+    bookkeeper = Bookkeeper.build(
+        db, config_replay_store_path=str(tmpdir), **config)
+    # Replays close without a header, don't log failing to save each one
+    log_level = logger.level
+    logger.setLevel(logging.ERROR)
+    print()
+    try:
+        for count in [1000, 10000]:
+            await print_idle_replays(event_loop, count, bookkeeper)
+    finally:
+        logger.setLevel(log_level)
+        await db.stop()
+
+
+async def print_idle_replays(loop, count, bookkeeper):
+    tasks, timers, memory, setup, idle, close = await run_idle_replays(
+        loop, count, bookkeeper)
+    print(f"{count} idle replays use {tasks} tasks, {timers} loop "
+          f"timers, {memory / 1024:.1f}KiB per replay. Setup "
+          f"{setup * 1000:.0f}ms, idle loop iteration "
+          f"{idle * 1000000:.0f}us, close {close * 1000:.0f}ms")
@@ -0,0 +1,82 @@
+import pytest
+import asyncio
+import time
+
+from tests import benchmark
+from tests.replays import example_replay
+from replayserver.bookkeeping.commit import ReplayCommitter, SaveDurability
+from replayserver.bookkeeping.database import ReplayDatabaseQueries
+from replayserver.bookkeeping.executor import SaveExecutor
+from replayserver.bookkeeping.sqlite import SqliteDatabase
+from replayserver.bookkeeping.storage import ReplaySaver
+from replayserver.receive.stream import OutsideSourceReplayStream
+from replayserver.struct.header import ReplayHeader, parse_header
+
+
+REPLAYS = 200
+BODY = example_replay.data[len(example_replay.header_data):]
+
+
+async def sqlite_database(latency):
+    db = SqliteDatabase(":memory:", latency)
+    await db.start()
+    await db.execute("INSERT INTO `login` VALUES (1, 'user1', '', '')")
+    await db.execute("INSERT INTO `map` VALUES (1, 'scmp_1')")
+    await db.execute("INSERT INTO `map_version` "
+                     "VALUES (1, 'maps/scmp_1.zip', 1)")
+    await db.execute("INSERT INTO `game_featuredMods` VALUES (1, 'faf')")
+    game_ids = tuple(range(1, REPLAYS + 1))
+    await db.execute("""
+        INSERT INTO `game_stats` VALUES
+    """ + ", ".join(["""
+            (%s, '2001-01-01 00:00:00', '2001-01-02 00:00:00', '0',
+             1, 1, 1, 'Name of the game', 1)"""] * REPLAYS), (game_ids,))
+    await db.execute("""
+        INSERT INTO `game_player_stats` (`gameId`, `playerId`, `AI`, `team`)
+        VALUES
+    """ + ", ".join(["(%s, 1, 0, 1)"] * REPLAYS), (game_ids,))
+    return db
+
+
+def replay_stream():
+    header, _ = parse_header(example_replay.header_data)
+    stream = OutsideSourceReplayStream()
+    stream.set_header(ReplayHeader(example_replay.header_data, header))
+    stream.feed_data(BODY)
+    stream.finish()
+    return stream
+
+
+async def run_saves(latency, tmpdir):
+    db = await sqlite_database(latency)
+    executor = SaveExecutor(2, 16)
+    committer = ReplayCommitter(executor, SaveDurability.NONE, 0.05)
+    saver = ReplaySaver.build(
+        ReplayDatabaseQueries(db, 5 * 60), executor, committer,
+        config_replay_store_path=str(tmpdir),
+        config_replay_compression_batch_size=1024 * 1024,
+        config_replay_compression_level=6,
+        config_replay_compression_workers=1,
+        config_replay_compression_min_block_size=128 * 1024,
+        config_compression_executor_workers=2,
+        config_compression_executor_queue_size=16,
+        config_metadata_prefetch=False,
+        config_metadata_prefetch_delay=0,
+        config_metadata_batch_window=0)
+    streams = [replay_stream() for _ in range(REPLAYS)]
+    start = time.perf_counter()
+    await asyncio.gather(*(saver.save_replay(game_id, stream)
+                           for game_id, stream in enumerate(streams, 1)))
+    elapsed = time.perf_counter() - start
+    await db.stop()
+    return elapsed
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_benchmark_save_throughput(event_loop, tmpdir):
+    print()
+    for latency in [0, 0.005, 0.02]:
+        elapsed = await run_saves(latency, tmpdir.mkdir(str(latency)))
+        print(f"Query latency {latency * 1000:.0f}ms: {REPLAYS} replays in "
+              f"{elapsed * 1000:.0f}ms, {REPLAYS / elapsed:.0f} replays/s")
@@ -0,0 +1,69 @@
+import pytest
+import asyncio
+import time
+
+from tests import benchmark
+from replayserver.timers import TimerWheel
+
+
+IDLE = 5000
+all_tasks = getattr(asyncio, "all_tasks", asyncio.Task.all_tasks)
+
+
+def loop_state(loop):
+    return len(all_tasks(loop)), len(loop._scheduled)
+
+
+async def wait_for_deadlines(loop, events):
+    # What we did before: a task and a loop timer per deadline
+    async def wait(event):
+        try:
+            await asyncio.wait_for(event.wait(), 60)
+        except asyncio.TimeoutError:
+            pass
+    return [asyncio.ensure_future(wait(event)) for event in events]
+
+
+async def wheel_deadlines(loop, events):
+    wheel = TimerWheel()
+    return [wheel.call_later(60, event.set) for event in events]
+
+
+async def run_deadlines(loop, schedule):
+    events = [asyncio.Event() for _ in range(IDLE)]
+    tasks_before, timers_before = loop_state(loop)
+    start = time.perf_counter()
+    deadlines = await schedule(loop, events)
+    await asyncio.sleep(0)      # Let tasks start waiting
+    setup = time.perf_counter() - start
+    tasks, timers = loop_state(loop)
+
+    # Cost of an idle loop iteration with all these deadlines pending
+    start = time.perf_counter()
+    for _ in range(100):
+        await asyncio.sleep(0)
+    idle = (time.perf_counter() - start) / 100
+
+    # Most deadlines never expire, they're cancelled
+    start = time.perf_counter()
+    for deadline in deadlines:
+        deadline.cancel()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    cancel = time.perf_counter() - start
+    return (tasks - tasks_before, timers - timers_before, setup, idle,
+            cancel)
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_benchmark_idle_deadlines(event_loop):
+    print()
+    for name, schedule in [("wait_for", wait_for_deadlines),
+                           ("timer wheel", wheel_deadlines)]:
+        tasks, timers, setup, idle, cancel = await run_deadlines(
+            event_loop, schedule)
+        print(f"{name}: {IDLE} idle deadlines use {tasks} tasks, "
+              f"{timers} loop timers. Setup {setup * 1000:.1f}ms, "
+              f"idle loop iteration {idle * 1000000:.0f}us, "
+              f"cancel {cancel * 1000:.1f}ms")
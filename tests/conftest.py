@@ -2,6 +2,7 @@ import pytest
 import asynctest
 from asyncio.locks import Event
 from tests import TimeSkipper
+from replayserver.collections import CallbackEvent
 
 
 pytest_plugins = ['tests.fixtures.connection', 'tests.fixtures.stream',
@@ -22,9 +23,22 @@ def locked_mock_coroutines(event_loop):
     return get
 
 
+@pytest.fixture
+def manual_end_callbacks():
+    def get():
+        manual_end = CallbackEvent()
+        add_callback_mock = asynctest.Mock(side_effect=manual_end.add_callback)
+        return (manual_end, add_callback_mock)
+
+    return get
+
+
 @pytest.fixture
 def mock_bookkeeper():
     class C:
+        def prepare_replay():
+            pass
+
         async def save_replay():
             pass
 
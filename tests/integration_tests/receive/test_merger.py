@@ -4,6 +4,7 @@ from tests.replays import example_replay
 from tests import fast_forward_time, timeout
 
 from replayserver.receive.mergestrategy import MergeStrategies
+from replayserver.struct.header import HeaderParser
 from replayserver.receive.merger import Merger
 from replayserver.errors import MalformedDataError, CannotAcceptConnectionError
 
@@ -12,6 +13,16 @@ config = {
     "config_merger_grace_period_time": 30,
     "config_replay_merge_strategy": MergeStrategies.FOLLOW_STREAM,
     "config_mergestrategy_stall_check_period": 60,
+    "config_connection_read_size_min": 4096,
+    "config_connection_read_size_max": 256 * 1024,
+    "config_replay_header_parser": HeaderParser.BUFFER,
+    "config_mergestrategy_share_matching_data": False,
+    "config_mergestrategy_discard_diverged_data": False,
+    "config_mergestrategy_failover_lead_bytes": 0,
+    "config_mergestrategy_failover_lead_time": 0,
+    "config_replay_spill_dir": None,
+    "config_replay_spill_hot_window": 8 * 1024 * 1024,
+    "config_replay_spill_segment_size": 64 * 1024 * 1024,
 }
 
 
@@ -4,6 +4,7 @@ from tests.replays import example_replay
 from tests import fast_forward_time, timeout
 
 from replayserver.send.sender import Sender
+from replayserver.send.timestamp import TimestampTicker
 from replayserver.struct.header import ReplayHeader
 
 
@@ -27,7 +28,8 @@ def data_receive_mixin():
 
 
 def test_sender_init(outside_source_stream):
-    Sender.build(outside_source_stream, **config)
+    ticker = TimestampTicker.build(**config)
+    Sender.build(outside_source_stream, ticker, **config)
 
 
 @pytest.mark.asyncio
@@ -35,7 +37,8 @@ def test_sender_init(outside_source_stream):
 @timeout(1000)
 async def test_sender_one_connection(event_loop, outside_source_stream,
                                      mock_connections, data_receive_mixin):
-    sender = Sender.build(outside_source_stream, **config)
+    ticker = TimestampTicker.build(**config)
+    sender = Sender.build(outside_source_stream, ticker, **config)
     conn = mock_connections()
     data_receive_mixin(conn, 0.1)
 
@@ -1,14 +1,26 @@
 from replayserver.server.replays import Replays
 from replayserver.receive.mergestrategy import MergeStrategies
+from replayserver.struct.header import HeaderParser
 
 
 config = {
     "config_merger_grace_period_time": 30,
     "config_replay_merge_strategy": MergeStrategies.FOLLOW_STREAM,
     "config_mergestrategy_stall_check_period": 60,
+    "config_connection_read_size_min": 4096,
+    "config_connection_read_size_max": 256 * 1024,
+    "config_replay_header_parser": HeaderParser.BUFFER,
     "config_sent_replay_delay": 5 * 60,
     "config_sent_replay_position_update_interval": 1,
     "config_replay_forced_end_time": 5 * 60 * 60,
+    "config_mergestrategy_share_matching_data": False,
+    "config_mergestrategy_discard_diverged_data": False,
+    "config_mergestrategy_failover_lead_bytes": 0,
+    "config_mergestrategy_failover_lead_time": 0,
+    "config_replay_spill_dir": None,
+    "config_replay_spill_hot_window": 8 * 1024 * 1024,
+    "config_replay_spill_segment_size": 64 * 1024 * 1024,
+    "config_replay_compression_batch_size": 1024 * 1024,
 }
 
 
@@ -5,23 +5,67 @@ from tests.replays import example_replay
 
 from replayserver import Server
 from replayserver.receive.mergestrategy import MergeStrategies
+from replayserver.struct.header import HeaderParser
+from replayserver.bookkeeping.commit import SaveDurability
+from replayserver.bookkeeping.database import DatabaseBackend
 
 
 config = {
     "merger_grace_period_time": 1,
     "replay_merge_strategy": MergeStrategies.FOLLOW_STREAM,
     "mergestrategy_stall_check_period": 60,
+    "connection_read_size_min": 4096,
+    "connection_read_size_max": 256 * 1024,
+    "replay_header_parser": HeaderParser.BUFFER,
     "sent_replay_delay": 5,
     "sent_replay_position_update_interval": 0.1,
     "replay_forced_end_time": 60,
     "server_port": 15000,
+    "db_backend": DatabaseBackend.MYSQL,
+    "db_sqlite_path": ":memory:",
+    "db_sqlite_latency": 0,
     "db_host": docker_faf_db_config["host"],
     "db_port": docker_faf_db_config["port"],
     "db_user": docker_faf_db_config["user"],
     "db_password": docker_faf_db_config["password"],
     "db_name":     docker_faf_db_config["db"],
+    "db_pool_min_size": 1,
+    "db_pool_max_size": 10,
+    "db_pool_recycle": -1,
+    "db_pool_acquire_timeout": 30,
+    "db_breaker_failures": 5,
+    "db_breaker_slow_query_time": 10,
+    "db_breaker_window": 60,
+    "db_breaker_cooldown": 30,
+    "db_mod_versions_cache_ttl": 5 * 60,
+    "metadata_prefetch": False,
+    "metadata_prefetch_delay": 60,
+    "metadata_batch_window": 100,
     "replay_store_path": "/tmp/replaceme",
-    "prometheus_port": None
+    "prometheus_port": None,
+    "mergestrategy_share_matching_data": False,
+    "mergestrategy_discard_diverged_data": False,
+    "mergestrategy_failover_lead_bytes": 0,
+    "mergestrategy_failover_lead_time": 0,
+    "mergestrategy_quorum_size": 2,
+    "mergestrategy_quorum_block_size": 4096,
+    "replay_spill_dir": None,
+    "replay_spill_hot_window": 8 * 1024 * 1024,
+    "replay_spill_segment_size": 64 * 1024 * 1024,
+    "replay_compression_batch_size": 1024 * 1024,
+    "replay_compression_level": 6,
+    "replay_compression_workers": 1,
+    "replay_compression_min_block_size": 128 * 1024,
+    "save_executor_workers": 2,
+    "save_executor_queue_size": 16,
+    "compression_executor_workers": 2,
+    "compression_executor_queue_size": 16,
+    "save_durability": SaveDurability.NONE,
+    "save_group_commit_interval": 50,
+    "save_spool_dir": None,
+    "save_retry_delay": 5,
+    "save_retry_max_delay": 5 * 60,
+    "save_retry_attempts": 20,
 }
 config = {"config_" + k: v for k, v in config.items()}
 
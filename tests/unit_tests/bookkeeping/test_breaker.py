@@ -0,0 +1,123 @@
+import pytest
+
+from replayserver.bookkeeping.breaker import CircuitBreaker, BreakerState
+from replayserver.errors import BookkeepingError, \
+    DatabaseConnectionError, DatabaseUnavailableError
+
+
+@pytest.fixture
+def monotonic(mocker):
+    return mocker.patch("time.monotonic", return_value=1000)
+
+
+def fail(breaker, error=DatabaseConnectionError):
+    with pytest.raises(error):
+        with breaker.call():
+            raise error
+
+
+def succeed(breaker):
+    with breaker.call():
+        pass
+
+
+def test_breaker_opens_after_failures(monotonic):
+    breaker = CircuitBreaker(3, 10, 60, 30)
+    fail(breaker)
+    fail(breaker)
+    succeed(breaker)
+    assert breaker.state == BreakerState.CLOSED
+    fail(breaker)
+    assert breaker.state == BreakerState.OPEN
+    with pytest.raises(DatabaseUnavailableError):
+        succeed(breaker)
+
+
+def test_breaker_ignores_query_errors(monotonic):
+    breaker = CircuitBreaker(2, 10, 60, 30)
+    for i in range(5):
+        fail(breaker, BookkeepingError)
+    assert breaker.state == BreakerState.CLOSED
+
+    # A slow query counts even if it failed on its own
+    for i in range(2):
+        with pytest.raises(BookkeepingError):
+            with breaker.call():
+                monotonic.return_value += 11
+                raise BookkeepingError
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_breaker_query_error_closes_after_probe(monotonic):
+    breaker = CircuitBreaker(1, 10, 60, 30)
+    fail(breaker)
+    monotonic.return_value = 1031
+    fail(breaker, BookkeepingError)     # Database answered, it's up again
+    assert breaker.state == BreakerState.CLOSED
+
+
+def test_breaker_forgets_old_failures(monotonic):
+    breaker = CircuitBreaker(3, 10, 60, 30)
+    fail(breaker)
+    fail(breaker)
+    monotonic.return_value = 1061
+    fail(breaker)
+    fail(breaker)
+    assert breaker.state == BreakerState.CLOSED
+    fail(breaker)
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_breaker_counts_slow_calls(monotonic):
+    breaker = CircuitBreaker(2, 10, 60, 30)
+    for i in range(2):
+        with breaker.call():
+            monotonic.return_value += 11
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_breaker_probes_after_cooldown(monotonic):
+    breaker = CircuitBreaker(1, 10, 60, 30)
+    fail(breaker)
+    monotonic.return_value = 1029
+    with pytest.raises(DatabaseUnavailableError):
+        succeed(breaker)
+
+    monotonic.return_value = 1031
+    with breaker.call():
+        assert breaker.state == BreakerState.HALF_OPEN
+        # Only one probe at a time
+        with pytest.raises(DatabaseUnavailableError):
+            succeed(breaker)
+    assert breaker.state == BreakerState.CLOSED
+    succeed(breaker)
+
+
+def test_breaker_failed_probe_reopens(monotonic):
+    breaker = CircuitBreaker(1, 10, 60, 30)
+    fail(breaker)
+    monotonic.return_value = 1031
+    fail(breaker)
+    assert breaker.state == BreakerState.OPEN
+    monotonic.return_value = 1060
+    with pytest.raises(DatabaseUnavailableError):
+        succeed(breaker)
+
+
+def test_breaker_cancelled_probe_frees_probe_slot(monotonic):
+    breaker = CircuitBreaker(1, 10, 60, 30)
+    fail(breaker)
+    monotonic.return_value = 1031
+    with pytest.raises(KeyboardInterrupt):
+        with breaker.call():
+            raise KeyboardInterrupt
+    assert breaker.state == BreakerState.HALF_OPEN
+    succeed(breaker)
+    assert breaker.state == BreakerState.CLOSED
+
+
+def test_breaker_disabled():
+    assert CircuitBreaker.build(config_db_breaker_failures=0,
+                                config_db_breaker_slow_query_time=10,
+                                config_db_breaker_window=60,
+                                config_db_breaker_cooldown=30) is None
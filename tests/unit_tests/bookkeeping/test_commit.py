@@ -0,0 +1,118 @@
+import pytest
+import asyncio
+import os
+
+from tests import timeout
+from replayserver.bookkeeping.commit import ReplayCommitter, SaveDurability
+from replayserver.bookkeeping.executor import SaveExecutor
+
+
+@pytest.fixture
+def save_executor(event_loop):
+    return SaveExecutor(2, 4)
+
+
+def write_tmpfile(tmpdir, name, data):
+    tmpfile = tmpdir.join(name + ".tmp")
+    tmpfile.write_binary(data)
+    return str(tmpfile), str(tmpdir.join(name))
+
+
+@pytest.mark.parametrize("durability", list(SaveDurability))
+@pytest.mark.asyncio
+@timeout(1)
+async def test_committer_moves_file(save_executor, tmpdir, durability):
+    committer = ReplayCommitter(save_executor, durability, 0.01)
+    tmpfile, rfile = write_tmpfile(tmpdir, "replay", b"foo")
+    tmpdir.join("replay").write_binary(b"")
+    await committer.commit(tmpfile, rfile)
+    assert tmpdir.join("replay").read_binary() == b"foo"
+    assert not tmpdir.join("replay.tmp").exists()
+
+
+@pytest.mark.parametrize("durability", list(SaveDurability))
+@pytest.mark.asyncio
+@timeout(1)
+async def test_committer_missing_file(save_executor, tmpdir, durability):
+    committer = ReplayCommitter(save_executor, durability, 0.01)
+    with pytest.raises(OSError):
+        await committer.commit(str(tmpdir.join("foo.tmp")),
+                               str(tmpdir.join("foo")))
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_committer_syncs_per_file(save_executor, tmpdir, mocker):
+    fsync = mocker.spy(os, "fsync")
+    committer = ReplayCommitter(save_executor, SaveDurability.FSYNC, 0.01)
+    for name in ["r1", "r2"]:
+        await committer.commit(*write_tmpfile(tmpdir, name, b"foo"))
+    assert fsync.call_count == 4    # Files and their directory
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_committer_no_sync(save_executor, tmpdir, mocker):
+    fsync = mocker.spy(os, "fsync")
+    committer = ReplayCommitter(save_executor, SaveDurability.NONE, 0.01)
+    await committer.commit(*write_tmpfile(tmpdir, "r1", b"foo"))
+    fsync.assert_not_called()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_committer_group_commit(save_executor, tmpdir, mocker):
+    fsync = mocker.spy(os, "fsync")
+    commit_group = mocker.spy(ReplayCommitter, "_commit_group")
+    committer = ReplayCommitter(save_executor, SaveDurability.GROUP, 0.05)
+
+    commits = [committer.commit(*write_tmpfile(tmpdir, f"r{i}", b"foo"))
+               for i in range(5)]
+    commits.append(committer.commit(str(tmpdir.join("missing.tmp")),
+                                    str(tmpdir.join("missing"))))
+    results = await asyncio.gather(*commits, return_exceptions=True)
+
+    assert results[:5] == [None] * 5
+    assert isinstance(results[5], OSError)
+    assert commit_group.call_count == 1
+    assert fsync.call_count == 6    # Files and their one directory
+    for i in range(5):
+        assert tmpdir.join(f"r{i}").read_binary() == b"foo"
+
+    await committer.commit(*write_tmpfile(tmpdir, "r5", b"foo"))
+    assert commit_group.call_count == 2
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_committer_group_syncs_data_before_rename(save_executor,
+                                                        tmpdir, mocker):
+    names = [f"r{i}" for i in range(3)]
+    visible_at_sync = []
+    fsync = os.fsync
+
+    def record_fsync(fd):
+        visible_at_sync.append([tmpdir.join(n).exists() for n in names])
+        fsync(fd)
+
+    mocker.patch.object(os, "fsync", side_effect=record_fsync)
+    committer = ReplayCommitter(save_executor, SaveDurability.GROUP, 0.05)
+    await asyncio.gather(*[
+        committer.commit(*write_tmpfile(tmpdir, n, b"foo")) for n in names])
+
+    # Data is synced while no replay has its final name yet, and the
+    # directory is synced after the renames
+    assert visible_at_sync == [[False] * 3] * 3 + [[True] * 3]
+
+
+@pytest.mark.parametrize("durability", list(SaveDurability))
+@pytest.mark.asyncio
+@timeout(1)
+async def test_committer_removes_tmpfile_on_failure(save_executor, tmpdir,
+                                                    mocker, durability):
+    mocker.patch.object(os, "replace", side_effect=OSError)
+    committer = ReplayCommitter(save_executor, durability, 0.05)
+    tmpfile, rfile = write_tmpfile(tmpdir, "replay", b"foo")
+    with pytest.raises(OSError):
+        await committer.commit(tmpfile, rfile)
+    assert not os.path.exists(tmpfile)
@@ -0,0 +1,216 @@
+import pytest
+import asyncio
+import random
+import zlib
+
+from tests import timeout
+from replayserver.bookkeeping.compression import ReplayCompressor, \
+    ParallelReplayCompressor
+from replayserver.bookkeeping.executor import SaveExecutor
+
+
+@pytest.fixture
+def save_executor(event_loop):
+    return SaveExecutor(2, 4)
+
+
+compressors = [
+    lambda *args: ReplayCompressor(*args, 6),
+    lambda *args: ParallelReplayCompressor(*args, 6, 3, 0),
+]
+
+
+@pytest.mark.parametrize("compressor_cls", compressors)
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compressor_compresses_while_stream_is_written(
+        outside_source_stream, mock_replay_headers, save_executor,
+        compressor_cls):
+    header = mock_replay_headers()
+    header.data = b"header"
+    compressor = compressor_cls(outside_source_stream, save_executor, 4)
+    outside_source_stream.set_header(header)
+    for i in range(10):
+        outside_source_stream.feed_data(b"data" * i)
+        await asyncio.sleep(0.01)
+    outside_source_stream.finish()
+
+    length, compressed = await compressor.finish()
+    expected = b"header" + b"".join(b"data" * i for i in range(10))
+    assert length == len(expected)
+    assert zlib.decompress(b"".join(compressed)) == expected
+
+
+@pytest.mark.parametrize("compressor_cls", compressors)
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compressor_stream_ended_before_compressing(
+        outside_source_stream, mock_replay_headers, save_executor,
+        compressor_cls):
+    header = mock_replay_headers()
+    header.data = b"header"
+    outside_source_stream.set_header(header)
+    outside_source_stream.feed_data(b"foo" * 1000)
+    outside_source_stream.finish()
+
+    compressor = compressor_cls(outside_source_stream, save_executor, 64)
+    length, compressed = await compressor.finish()
+    assert length == 3006
+    assert zlib.decompress(b"".join(compressed)) == b"header" + b"foo" * 1000
+
+
+@pytest.mark.parametrize("compressor_cls", compressors)
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compressor_compresses_in_bounded_batches(
+        outside_source_stream, mock_replay_headers, mocker, save_executor,
+        compressor_cls):
+    header = mock_replay_headers()
+    header.data = b"header"
+    outside_source_stream.set_header(header)
+    outside_source_stream.feed_data(b"foo" * 1000)
+    outside_source_stream.finish()
+
+    compressor = compressor_cls(outside_source_stream, save_executor, 64)
+    spy = mocker.spy(compressor._executor, "run")
+    await compressor.finish()
+    batches = [call[0][2] for call in spy.call_args_list]
+    assert len(batches) > 1
+    assert all(sum(len(c) for c in chunks) <= 64 for chunks in batches)
+
+
+@pytest.mark.parametrize("compressor_cls", compressors)
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compressor_no_header(outside_source_stream, save_executor,
+                                    compressor_cls):
+    compressor = compressor_cls(outside_source_stream, save_executor, 64)
+    outside_source_stream.finish()
+    length, compressed = await compressor.finish()
+    assert length == 0
+    assert zlib.decompress(b"".join(compressed)) == b""
+
+
+@pytest.mark.parametrize("compressor_cls", compressors)
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compressor_has_no_task_while_waiting_for_data(
+        outside_source_stream, mock_replay_headers, save_executor,
+        compressor_cls):
+    all_tasks = getattr(asyncio, "all_tasks", asyncio.Task.all_tasks)
+    tasks_before = len(all_tasks())
+    header = mock_replay_headers()
+    header.data = b"header"
+    compressor = compressor_cls(outside_source_stream, save_executor, 4)
+    assert len(all_tasks()) == tasks_before
+
+    outside_source_stream.set_header(header)
+    outside_source_stream.feed_data(b"data")
+    await asyncio.sleep(0.05)
+    assert len(all_tasks()) == tasks_before
+
+    outside_source_stream.feed_data(b"more")
+    outside_source_stream.finish()
+    length, compressed = await compressor.finish()
+    assert zlib.decompress(b"".join(compressed)) == b"headerdatamore"
+
+
+@pytest.mark.parametrize("compressor_cls", compressors)
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compressor_compresses_header_before_data(
+        outside_source_stream, mock_replay_headers, mocker, save_executor,
+        compressor_cls):
+    header = mock_replay_headers()
+    header.data = b"header"
+    compressor = compressor_cls(outside_source_stream, save_executor, 64)
+    spy = mocker.spy(compressor._executor, "run")
+    outside_source_stream.set_header(header)
+    await asyncio.sleep(0.01)
+    assert [call[0][2] for call in spy.call_args_list] == [[b"header"]]
+
+
+@pytest.mark.parametrize("compressor_cls", compressors)
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compressor_logs_failure_without_finish(
+        outside_source_stream, mock_replay_headers, mocker, save_executor,
+        compressor_cls):
+    header = mock_replay_headers()
+    header.data = b"header"
+    compressor = compressor_cls(outside_source_stream, save_executor, 64)
+    mocker.patch.object(compressor._executor, "run", side_effect=OSError)
+    logger = mocker.patch("replayserver.bookkeeping.compression.logger")
+    outside_source_stream.set_header(header)
+    await compressor.wait_for_stream_done()
+    logger.exception.assert_called_once()
+    # Exception is still there for finish(), but counts as retrieved
+    assert not compressor._done._log_traceback
+    with pytest.raises(OSError):
+        await compressor.finish()
+
+
+@pytest.mark.parametrize("level", [-1, 0, 1, 4, 6, 9])
+@pytest.mark.asyncio
+@timeout(1)
+async def test_parallel_compressor_output_is_zlib_stream(
+        outside_source_stream, mock_replay_headers, save_executor, level):
+    header = mock_replay_headers()
+    header.data = b"header"
+    outside_source_stream.set_header(header)
+    data = b"".join(i.to_bytes(4, "little") for i in range(50000))
+    for i in range(0, len(data), 1000):
+        outside_source_stream.feed_data(data[i:i + 1000])
+    outside_source_stream.finish()
+
+    compressor = ParallelReplayCompressor(outside_source_stream,
+                                          save_executor, 10000, level, 3, 0)
+    length, compressed = await compressor.finish()
+    assert length == len(data) + 6
+    assert zlib.decompress(b"".join(compressed)) == b"header" + data
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_parallel_compressor_uses_previous_data_as_dictionary(
+        outside_source_stream, mock_replay_headers, save_executor):
+    header = mock_replay_headers()
+    header.data = b"header"
+    outside_source_stream.set_header(header)
+    rand = random.Random(0)
+    block = bytes(rand.getrandbits(8) for i in range(1024))
+    for i in range(8):
+        outside_source_stream.feed_data(block)
+    outside_source_stream.finish()
+
+    compressor = ParallelReplayCompressor(outside_source_stream,
+                                          save_executor, 1024, 6, 3, 0)
+    length, compressed = await compressor.finish()
+    # Repeated blocks compress to almost nothing
+    assert len(b"".join(compressed)) < 2 * 1024
+    assert zlib.decompress(b"".join(compressed)) == b"header" + block * 8
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_parallel_compressor_waits_for_min_block_size(
+        outside_source_stream, mock_replay_headers, mocker, save_executor):
+    header = mock_replay_headers()
+    header.data = b"header"
+    compressor = ParallelReplayCompressor(outside_source_stream,
+                                          save_executor, 64, 6, 3, 32)
+    spy = mocker.spy(compressor._executor, "run")
+    outside_source_stream.set_header(header)
+    for i in range(20):
+        outside_source_stream.feed_data(b"12345")
+        await asyncio.sleep(0.01)
+    outside_source_stream.finish()
+
+    length, compressed = await compressor.finish()
+    assert zlib.decompress(b"".join(compressed)) == b"header" + b"12345" * 20
+    batches = [sum(len(c) for c in call[0][2])
+               for call in spy.call_args_list]
+    assert batches[0] == 6     # Header
+    # Only the batch at stream end can be smaller
+    assert all(32 <= size <= 64 for size in batches[1:-1])
+    assert sum(batches) == length
@@ -1,10 +1,16 @@
 import pytest
+import asyncio
+import asynctest
 from tests import docker_faf_db_config
 import datetime
 import random
+import pymysql
 
 from replayserver.bookkeeping.database import Database, ReplayDatabaseQueries
-from replayserver.errors import BookkeepingError
+from replayserver.bookkeeping.breaker import CircuitBreaker, BreakerState
+from replayserver.errors import BookkeepingError, \
+    DatabaseConnectionError, DatabaseUnavailableError
+from replayserver import metrics
 
 
 docker_db_config = {
@@ -12,7 +18,15 @@ docker_db_config = {
     "config_db_port": docker_faf_db_config["port"],
     "config_db_user": docker_faf_db_config["user"],
     "config_db_password": docker_faf_db_config["password"],
-    "config_db_name": docker_faf_db_config["db"]
+    "config_db_name": docker_faf_db_config["db"],
+    "config_db_pool_min_size": 1,
+    "config_db_pool_max_size": 10,
+    "config_db_pool_recycle": -1,
+    "config_db_pool_acquire_timeout": 30,
+    "config_db_breaker_failures": 5,
+    "config_db_breaker_slow_query_time": 10,
+    "config_db_breaker_window": 60,
+    "config_db_breaker_cooldown": 30,
 }
 
 
@@ -68,9 +82,79 @@ async def test_database_commits_results():
     await db.stop()
 
 
+def mock_pool(conn):
+    pool = asynctest.Mock(spec=["acquire", "release"])
+
+    async def acquire():
+        return await conn
+    pool.acquire.side_effect = acquire
+    pool.release = asynctest.CoroutineMock()
+    return pool
+
+
+@pytest.mark.asyncio
+async def test_database_pool_acquire_timeout(event_loop):
+    pool = mock_pool(event_loop.create_future())   # Never done
+    db = Database(asynctest.CoroutineMock(return_value=pool), 0.01)
+    await db.start()
+    with pytest.raises(DatabaseConnectionError):
+        await db.execute('SELECT * FROM login')
+    pool.release.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_database_releases_connection_on_error(event_loop):
+    conn = asynctest.MagicMock()
+    conn.cursor.side_effect = RuntimeError
+    connected = event_loop.create_future()
+    connected.set_result(conn)
+    pool = mock_pool(connected)
+    db = Database(asynctest.CoroutineMock(return_value=pool), 1)
+    await db.start()
+    with pytest.raises(BookkeepingError):
+        await db.execute('SELECT * FROM login')
+    pool.release.assert_awaited_with(conn)
+    assert metrics.db_connections_in_use._value.get() == 0
+
+
+@pytest.mark.asyncio
+async def test_database_query_errors_dont_trip_breaker(event_loop):
+    conn = asynctest.MagicMock()
+    conn.cursor.side_effect = pymysql.err.ProgrammingError
+    connected = event_loop.create_future()
+    connected.set_result(conn)
+    pool = mock_pool(connected)
+    breaker = CircuitBreaker(1, 10, 60, 30)
+    db = Database(asynctest.CoroutineMock(return_value=pool), 1, breaker)
+    await db.start()
+    for i in range(3):
+        with pytest.raises(BookkeepingError) as e:
+            await db.execute('SELECT * FROM updates_nonexistent')
+        assert not isinstance(e.value, DatabaseConnectionError)
+    assert breaker.state == BreakerState.CLOSED
+
+    conn.cursor.side_effect = pymysql.err.OperationalError
+    with pytest.raises(DatabaseConnectionError):
+        await db.execute('SELECT * FROM login')
+    assert breaker.state == BreakerState.OPEN
+
+
+@pytest.mark.asyncio
+async def test_database_breaker_fails_fast(event_loop):
+    pool = mock_pool(event_loop.create_future())   # Never done
+    breaker = CircuitBreaker(1, 10, 60, 30)
+    db = Database(asynctest.CoroutineMock(return_value=pool), 0.01, breaker)
+    await db.start()
+    with pytest.raises(BookkeepingError):
+        await db.execute('SELECT * FROM login')
+    with pytest.raises(DatabaseUnavailableError):
+        await db.execute('SELECT * FROM login')
+    assert pool.acquire.call_count == 1
+
+
 @pytest.mark.asyncio
 async def test_queries_get_teams(mock_database):
-    queries = ReplayDatabaseQueries(mock_database)
+    queries = ReplayDatabaseQueries(mock_database, 0)
     await mock_database.add_mock_game((1, 1, 1),
                                       [(1, 1), (2, 2)])
     teams = await queries.get_teams_in_game(1)
@@ -79,14 +163,14 @@ async def test_queries_get_teams(mock_database):
 
 @pytest.mark.asyncio
 async def test_queries_missing_teams(mock_database):
-    queries = ReplayDatabaseQueries(mock_database)
+    queries = ReplayDatabaseQueries(mock_database, 0)
     with pytest.raises(BookkeepingError):
         await queries.get_teams_in_game(1)
 
 
 @pytest.mark.asyncio
 async def test_queries_ignore_ai_players(mock_database):
-    queries = ReplayDatabaseQueries(mock_database)
+    queries = ReplayDatabaseQueries(mock_database, 0)
     await mock_database.add_mock_game((1, 1, 1),
                                       [(1, 1), (2, 2), (3, 3, 1)])
     teams = await queries.get_teams_in_game(1)
@@ -95,7 +179,7 @@ async def test_queries_ignore_ai_players(mock_database):
 
 @pytest.mark.asyncio
 async def test_queries_get_game_stats(mock_database):
-    queries = ReplayDatabaseQueries(mock_database)
+    queries = ReplayDatabaseQueries(mock_database, 0)
     await mock_database.add_mock_game((1, 1, 1),
                                       [(1, 1), (2, 2)])
     stats = await queries.get_game_stats(1)
@@ -113,23 +197,53 @@ async def test_queries_get_game_stats(mock_database):
     }
 
 
+@pytest.mark.asyncio
+async def test_queries_get_many_game_stats(mock_database):
+    queries = ReplayDatabaseQueries(mock_database, 0)
+    await mock_database.add_mock_game((1, 1, 1),
+                                      [(1, 1), (2, 2)])
+    stats = await queries.get_many_game_stats([1, 2])
+    assert list(stats.keys()) == [1]
+    assert stats[1] == await queries.get_game_stats(1)
+
+
+@pytest.mark.asyncio
+async def test_queries_get_teams_in_games(mock_database):
+    queries = ReplayDatabaseQueries(mock_database, 0)
+    await mock_database.add_mock_game((1, 1, 1),
+                                      [(1, 1), (2, 2)])
+    teams = await queries.get_teams_in_games([1, 2])
+    assert teams == {1: {1: ["user1"], 2: ["user2"]}}
+
+
+@pytest.mark.asyncio
+async def test_queries_get_game_end(mock_database):
+    queries = ReplayDatabaseQueries(mock_database, 0)
+    await mock_database.add_mock_game((1, 1, 1),
+                                      [(1, 1), (2, 2)])
+    game_end = await queries.get_game_end(1)
+    assert game_end == datetime.datetime(2001, 1, 2, 0, 0).timestamp()
+    with pytest.raises(BookkeepingError):
+        await queries.get_game_end(2)
+
+
 @pytest.mark.asyncio
 async def test_queries_missing_game_stats(mock_database):
-    queries = ReplayDatabaseQueries(mock_database)
+    queries = ReplayDatabaseQueries(mock_database, 0)
     with pytest.raises(BookkeepingError):
         await queries.get_game_stats(1)
 
 
 @pytest.mark.asyncio
 async def test_queries_null_game_end(mock_database):
-    queries = ReplayDatabaseQueries(mock_database)
+    queries = ReplayDatabaseQueries(mock_database, 0)
     stats = await queries.get_game_stats(101)   # Game with no end time
     assert type(stats['game_end']) is float
 
 
 @pytest.mark.asyncio
 async def test_queries_get_mod_versions(mock_database):
-    queries = ReplayDatabaseQueries(mock_database)
+    queries = ReplayDatabaseQueries(mock_database, 0)
     mod = await queries.get_mod_versions("faf")
     assert mod == {
         '1': 1,
@@ -143,3 +257,106 @@ async def test_queries_get_mod_versions(mock_database):
         '9': 1,
         '10': 1,
     }
+
+
+@pytest.fixture
+def mock_query_database():
+    class D:
+        async def execute():
+            pass
+
+    db = asynctest.Mock(spec=D)
+    db.execute.return_value = [{"file_id": 1, "version": 2}]
+    return db
+
+
+@pytest.mark.asyncio
+async def test_queries_mod_versions_cached(mock_query_database):
+    queries = ReplayDatabaseQueries(mock_query_database, 60)
+    assert await queries.get_mod_versions("faf") == {"1": 2}
+    assert await queries.get_mod_versions("faf") == {"1": 2}
+    assert mock_query_database.execute.call_count == 1
+    await queries.get_mod_versions("ladder1v1")
+    assert mock_query_database.execute.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_queries_mod_versions_expire(mock_query_database, mocker):
+    queries = ReplayDatabaseQueries(mock_query_database, 60)
+    monotonic = mocker.patch("time.monotonic", return_value=1000)
+    await queries.get_mod_versions("faf")
+    monotonic.return_value = 1059
+    await queries.get_mod_versions("faf")
+    assert mock_query_database.execute.call_count == 1
+    monotonic.return_value = 1061
+    await queries.get_mod_versions("faf")
+    assert mock_query_database.execute.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_queries_mod_versions_single_flight(mock_query_database):
+    queries = ReplayDatabaseQueries(mock_query_database, 60)
+    query_done = asyncio.Event()
+
+    async def slow_query(*args, **kwargs):
+        await query_done.wait()
+        return [{"file_id": 1, "version": 2}]
+
+    mock_query_database.execute.side_effect = slow_query
+    lookups = [asyncio.ensure_future(queries.get_mod_versions("faf"))
+               for i in range(5)]
+    await asyncio.sleep(0.01)
+    lookups[0].cancel()
+    query_done.set()
+    results = await asyncio.gather(*lookups[1:])
+    assert results == [{"1": 2}] * 4
+    assert mock_query_database.execute.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_queries_mod_versions_errors_not_cached(mock_query_database):
+    queries = ReplayDatabaseQueries(mock_query_database, 60)
+    mock_query_database.execute.side_effect = [
+        BookkeepingError, [{"file_id": 1, "version": 2}]]
+    with pytest.raises(BookkeepingError):
+        await queries.get_mod_versions("faf")
+    assert await queries.get_mod_versions("faf") == {"1": 2}
+
+
+@pytest.mark.asyncio
+async def test_queries_mod_versions_stale_on_refresh_failure(
+        mock_query_database, mocker):
+    queries = ReplayDatabaseQueries(mock_query_database, 60)
+    monotonic = mocker.patch("time.monotonic", return_value=1000)
+    await queries.get_mod_versions("faf")
+    monotonic.return_value = 1061
+    mock_query_database.execute.side_effect = [
+        BookkeepingError, [{"file_id": 1, "version": 3}]]
+    assert await queries.get_mod_versions("faf") == {"1": 2}
+    # Still stale, so we try again next time
+    assert await queries.get_mod_versions("faf") == {"1": 3}
+    assert mock_query_database.execute.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_queries_mod_versions_waiters_not_hits(mock_query_database):
+    def lookups(result):
+        return metrics.mod_versions_cache.labels(result=result)._value.get()
+
+    queries = ReplayDatabaseQueries(mock_query_database, 60)
+    query_done = asyncio.Event()
+
+    async def slow_query(*args, **kwargs):
+        await query_done.wait()
+        return [{"file_id": 1, "version": 2}]
+
+    mock_query_database.execute.side_effect = slow_query
+    hits, waits = lookups("hit"), lookups("wait")
+    pending = [asyncio.ensure_future(queries.get_mod_versions("faf"))
+               for i in range(3)]
+    await asyncio.sleep(0.01)
+    query_done.set()
+    await asyncio.gather(*pending)
+    await queries.get_mod_versions("faf")
+    assert lookups("wait") - waits == 2
+    assert lookups("hit") - hits == 1
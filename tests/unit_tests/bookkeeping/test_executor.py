@@ -0,0 +1,94 @@
+import pytest
+import asyncio
+import threading
+
+from tests import timeout
+from replayserver.bookkeeping.executor import SaveExecutor, \
+    CompressionExecutor
+from replayserver import metrics
+
+
+def queue_depth():
+    return metrics.save_queue_depth._value.get()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_executor_runs_jobs_in_own_threads(event_loop):
+    executor = SaveExecutor(2, 4)
+    name = await executor.run("test", lambda: threading.current_thread().name)
+    assert name.startswith("replay-save")
+    assert await executor.run("test", lambda x, y: x + y, 1, 2) == 3
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_executor_job_exception(event_loop):
+    executor = SaveExecutor(2, 4)
+
+    def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await executor.run("test", fail)
+    assert queue_depth() == 0
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_executor_limits_jobs_handed_to_pool(event_loop):
+    executor = SaveExecutor(1, 1)
+    release = threading.Event()
+    started = []
+
+    def job(i):
+        started.append(i)
+        release.wait()
+
+    jobs = [asyncio.ensure_future(executor.run("test", job, i))
+            for i in range(4)]
+    await asyncio.sleep(0.05)
+    assert started == [0]
+    assert queue_depth() == 3
+    assert executor._pool._work_queue.qsize() == 1
+
+    release.set()
+    await asyncio.gather(*jobs)
+    assert started == [0, 1, 2, 3]
+    assert queue_depth() == 0
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_executor_cancelled_jobs_leave_queue(event_loop):
+    executor = SaveExecutor(1, 1)
+    release = threading.Event()
+    jobs = [asyncio.ensure_future(executor.run("test", release.wait))
+            for i in range(3)]
+    await asyncio.sleep(0.05)
+    jobs[1].cancel()
+    jobs[2].cancel()
+    await asyncio.sleep(0.05)
+    assert queue_depth() == 0
+    release.set()
+    await jobs[0]
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_compression_executor_is_separate_from_saves(event_loop):
+    compression = CompressionExecutor(1, 1)
+    saves = SaveExecutor(1, 1)
+    release = threading.Event()
+    jobs = [asyncio.ensure_future(compression.run("compress", release.wait))
+            for i in range(3)]
+    await asyncio.sleep(0.05)
+    assert metrics.compression_queue_depth._value.get() == 2
+    assert queue_depth() == 0
+
+    # Saves don't wait behind busy compression
+    name = await saves.run("test", lambda: threading.current_thread().name)
+    assert name.startswith("replay-save")
+    release.set()
+    await asyncio.gather(*jobs)
+    assert metrics.compression_queue_depth._value.get() == 0
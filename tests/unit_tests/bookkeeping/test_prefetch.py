@@ -0,0 +1,101 @@
+import pytest
+import asyncio
+import asynctest
+
+from tests import timeout
+from replayserver.bookkeeping.prefetch import MetadataPrefetcher
+from replayserver.errors import BookkeepingError
+
+
+@pytest.fixture
+def mock_queries():
+    class Q:
+        async def get_many_game_stats():
+            pass
+
+        async def get_teams_in_games():
+            pass
+
+    queries = asynctest.Mock(spec=Q)
+    queries.get_many_game_stats.side_effect = \
+        lambda ids: {i: {"stats": i} for i in ids if i != 3}
+    queries.get_teams_in_games.side_effect = \
+        lambda ids: {i: {1: [f"user{i}"]} for i in ids}
+    return queries
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_prefetcher_fetches_games_in_batches(mock_queries):
+    prefetcher = MetadataPrefetcher(mock_queries, 0.01, 0.05)
+    prefetches = [prefetcher.prefetch(i) for i in range(1, 5)]
+    results = await asyncio.gather(*prefetches)
+
+    assert results[0] == ({"stats": 1}, {1: ["user1"]})
+    assert results[1] == ({"stats": 2}, {1: ["user2"]})
+    assert results[2] is None   # No stats found
+    assert results[3] == ({"stats": 4}, {1: ["user4"]})
+    mock_queries.get_many_game_stats.assert_called_once_with([1, 2, 3, 4])
+    mock_queries.get_teams_in_games.assert_called_once_with([1, 2, 3, 4])
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_prefetcher_waits_for_delay(mock_queries):
+    prefetcher = MetadataPrefetcher(mock_queries, 0.1, 0.01)
+    prefetch = prefetcher.prefetch(1)
+    await asyncio.sleep(0.05)
+    mock_queries.get_many_game_stats.assert_not_called()
+    assert await prefetch == ({"stats": 1}, {1: ["user1"]})
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_prefetcher_separate_batches(mock_queries):
+    prefetcher = MetadataPrefetcher(mock_queries, 0, 0.01)
+    await prefetcher.prefetch(1)
+    await prefetcher.prefetch(2)
+    assert mock_queries.get_many_game_stats.call_count == 2
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_prefetcher_query_error(mock_queries):
+    mock_queries.get_teams_in_games.side_effect = BookkeepingError
+    prefetcher = MetadataPrefetcher(mock_queries, 0, 0.01)
+    assert await prefetcher.prefetch(1) is None
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_prefetcher_cancelled_prefetch(mock_queries):
+    prefetcher = MetadataPrefetcher(mock_queries, 0, 0.05)
+    first = prefetcher.prefetch(1)
+    second = prefetcher.prefetch(2)
+    await asyncio.sleep(0.01)
+    first.cancel()
+    assert await second == ({"stats": 2}, {1: ["user2"]})
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_prefetcher_unexpected_error(mock_queries):
+    # E.g. a game with no start time in the database
+    mock_queries.get_many_game_stats.side_effect = AttributeError
+    prefetcher = MetadataPrefetcher(mock_queries, 0, 0.01)
+    results = await asyncio.gather(prefetcher.prefetch(1),
+                                   prefetcher.prefetch(2))
+    assert results == [None, None]
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_prefetcher_uses_no_task_per_game(mock_queries):
+    all_tasks = getattr(asyncio, "all_tasks", asyncio.Task.all_tasks)
+    tasks_before = len(all_tasks())
+    prefetcher = MetadataPrefetcher(mock_queries, 0.05, 0.01)
+    prefetches = [prefetcher.prefetch(i) for i in range(100)]
+    await asyncio.sleep(0)
+    assert len(all_tasks()) == tasks_before
+    await asyncio.gather(*prefetches)
+    assert mock_queries.get_many_game_stats.call_count == 1
@@ -0,0 +1,291 @@
+import pytest
+import asyncio
+import asynctest
+import os
+
+from tests import timeout
+from tests.replays import example_replay
+from replayserver.bookkeeping.spool import SaveSpool
+from replayserver.bookkeeping.executor import SaveExecutor
+from replayserver.bookkeeping.commit import ReplayCommitter, SaveDurability
+from replayserver.bookkeeping.compression import ReplayCompressor
+from replayserver.bookkeeping.storage import ReplayFilePaths, ReplaySaver
+from replayserver.errors import BookkeepingError, \
+    DatabaseConnectionError, DatabaseUnavailableError
+
+
+@pytest.fixture
+def mock_saver():
+    class S:
+        def forget_replay():
+            pass
+
+        def take_compressor():
+            pass
+
+        async def get_replay_info():
+            pass
+
+        def get_degraded_replay_info():
+            pass
+
+        async def write_replay():
+            pass
+
+    saver = asynctest.Mock(spec=S)
+    saver.get_replay_info.return_value = {"uid": 1}
+    saver.get_degraded_replay_info.return_value = {"uid": 1, "title": None}
+    saver.take_compressor.return_value = asynctest.Mock(
+        wait_for_stream_done=asynctest.CoroutineMock())
+    return saver
+
+
+@pytest.fixture
+def spool_args(mock_saver, tmpdir, event_loop):
+    executor = SaveExecutor(2, 4)
+    committer = ReplayCommitter(executor, SaveDurability.NONE, 0.01)
+    return str(tmpdir.join("spool")), mock_saver, executor, committer
+
+
+def example_stream(outside_source_stream, mock_replay_headers):
+    outside_source_stream.set_header(mock_replay_headers(example_replay))
+    outside_source_stream.feed_data(b"foo")
+    outside_source_stream.feed_data(b"bar")
+    outside_source_stream.finish()
+    return outside_source_stream
+
+
+async def wait_for_saves(spool):
+    while spool._tasks:
+        await asyncio.wait(list(spool._tasks))
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_saves_replay(spool_args, mock_saver, tmpdir,
+                                  outside_source_stream, mock_replay_headers):
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    stream = example_stream(outside_source_stream, mock_replay_headers)
+    await spool.add(1, stream)
+
+    spooled = tmpdir.join("spool", "1.spool")
+    assert spooled.read_binary() == example_replay.header_data + b"foobar"
+    await wait_for_saves(spool)
+
+    mock_saver.get_replay_info.assert_called_with(1, example_replay.header)
+    mock_saver.write_replay.assert_called_with(
+        1, {"uid": 1}, mock_saver.take_compressor.return_value,
+        recovered=False)
+    assert not spooled.exists()
+    await spool.stop()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_no_header(spool_args, mock_saver, outside_source_stream):
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    outside_source_stream.finish()
+    with pytest.raises(BookkeepingError):
+        await spool.add(1, outside_source_stream)
+    mock_saver.forget_replay.assert_called_with(1)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_retries_getting_info(spool_args, mock_saver,
+                                          outside_source_stream,
+                                          mock_replay_headers):
+    mock_saver.get_replay_info.side_effect = [
+        DatabaseConnectionError, DatabaseUnavailableError, {"uid": 1}]
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    await spool.add(1, example_stream(outside_source_stream,
+                                      mock_replay_headers))
+    await wait_for_saves(spool)
+    assert mock_saver.get_replay_info.call_count == 3
+    mock_saver.write_replay.assert_called()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_saves_degraded_after_retries(spool_args, mock_saver,
+                                                  tmpdir,
+                                                  outside_source_stream,
+                                                  mock_replay_headers):
+    mock_saver.get_replay_info.side_effect = DatabaseConnectionError
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    await spool.add(1, example_stream(outside_source_stream,
+                                      mock_replay_headers))
+    await wait_for_saves(spool)
+    assert mock_saver.get_replay_info.call_count == 3
+    game_id, info = mock_saver.write_replay.call_args[0][:2]
+    assert game_id == 1
+    assert info == {"uid": 1, "title": None}
+    assert os.listdir(str(tmpdir.join("spool"))) == []
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_gives_up_without_degraded_info(spool_args, mock_saver,
+                                                    tmpdir,
+                                                    outside_source_stream,
+                                                    mock_replay_headers):
+    mock_saver.get_replay_info.side_effect = DatabaseUnavailableError
+    mock_saver.get_degraded_replay_info.side_effect = BookkeepingError
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    await spool.add(1, example_stream(outside_source_stream,
+                                      mock_replay_headers))
+    await wait_for_saves(spool)
+    mock_saver.write_replay.assert_not_called()
+    assert not tmpdir.join("spool", "1.spool").exists()
+    assert tmpdir.join("spool", "1.spool.failed").exists()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_does_not_retry_other_errors(spool_args, mock_saver,
+                                                 tmpdir,
+                                                 outside_source_stream,
+                                                 mock_replay_headers):
+    mock_saver.get_replay_info.side_effect = BookkeepingError
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    await spool.add(1, example_stream(outside_source_stream,
+                                      mock_replay_headers))
+    await wait_for_saves(spool)
+    assert mock_saver.get_replay_info.call_count == 1
+    mock_saver.write_replay.assert_not_called()
+    assert tmpdir.join("spool", "1.spool.failed").exists()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_keeps_replay_in_memory_if_spooling_fails(
+        spool_args, mock_saver, tmpdir, outside_source_stream,
+        mock_replay_headers):
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    os.rmdir(str(tmpdir.join("spool")))
+    await spool.add(1, example_stream(outside_source_stream,
+                                      mock_replay_headers))
+    await wait_for_saves(spool)
+    mock_saver.write_replay.assert_called()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_saves_degraded_if_spooling_fails(
+        spool_args, mock_saver, tmpdir, outside_source_stream,
+        mock_replay_headers):
+    mock_saver.get_replay_info.side_effect = BookkeepingError
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    os.rmdir(str(tmpdir.join("spool")))
+    await spool.add(1, example_stream(outside_source_stream,
+                                      mock_replay_headers))
+    await wait_for_saves(spool)
+    mock_saver.get_degraded_replay_info.assert_called_once()
+    game_id, info = mock_saver.write_replay.call_args[0][:2]
+    assert game_id == 1
+    assert info == {"uid": 1, "title": None}
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_recovers_replays_on_start(spool_args, mock_saver,
+                                               tmpdir):
+    spooldir = tmpdir.mkdir("spool")
+    spooldir.join("1.spool").write_binary(example_replay.data)
+    spooldir.join("2.spool.tmp").write_binary(b"partial")
+    spooldir.join("3.spool").write_binary(b"garbage")
+
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    await wait_for_saves(spool)
+
+    mock_saver.get_replay_info.assert_called_once()
+    game_id, header = mock_saver.get_replay_info.call_args[0]
+    assert game_id == 1
+    assert header["map_name"] == example_replay.header["map_name"]
+    game_id, stream = mock_saver.take_compressor.call_args[0]
+    assert game_id == 1
+    assert stream.header.data == example_replay.header_data
+    assert stream.header.data + stream.data.bytes() == example_replay.data
+    assert stream.ended()
+    assert sorted(os.listdir(str(spooldir))) == ["3.spool.failed"]
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_recovers_replays_in_batches(spool_args, mock_saver,
+                                                 tmpdir):
+    spooldir = tmpdir.mkdir("spool")
+    count = SaveSpool.RECOVERY_BATCH * 2 + 1
+    for i in range(1, count + 1):
+        spooldir.join(f"{i}.spool").write_binary(example_replay.data)
+    release = asyncio.Event()
+    in_progress = []
+
+    async def get_info(game_id, header):
+        in_progress.append(game_id)
+        await release.wait()
+        return {"uid": game_id}
+
+    mock_saver.get_replay_info.side_effect = get_info
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    await asyncio.sleep(0.05)
+    assert len(in_progress) == SaveSpool.RECOVERY_BATCH
+
+    release.set()
+    await wait_for_saves(spool)
+    assert sorted(in_progress) == list(range(1, count + 1))
+    assert os.listdir(str(spooldir)) == []
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_recovery_reuses_replay_file_placeholder(spool_args,
+                                                             mock_saver,
+                                                             tmpdir):
+    # Previous run crashed after allocating the replay file, but before
+    # writing it
+    _, _, executor, committer = spool_args
+    paths = ReplayFilePaths(str(tmpdir.join("replays")), executor)
+    rfile = await paths.get(1)
+    spooldir = tmpdir.mkdir("spool")
+    spooldir.join("1.spool").write_binary(example_replay.data)
+
+    def compressor_builder(stream):
+        return ReplayCompressor(stream, executor, 1024, 6)
+    saver = ReplaySaver(paths, None, executor, committer, compressor_builder,
+                        None)
+    mock_saver.take_compressor.side_effect = saver.take_compressor
+    mock_saver.write_replay.side_effect = saver.write_replay
+
+    spool = SaveSpool(*spool_args, 0.01, 0.01, 3)
+    await spool.start()
+    await wait_for_saves(spool)
+
+    assert os.path.getsize(rfile) > 0
+    assert os.listdir(str(spooldir)) == []
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_spool_stop_leaves_unsaved_replays(spool_args, mock_saver,
+                                                 tmpdir,
+                                                 outside_source_stream,
+                                                 mock_replay_headers):
+    mock_saver.get_replay_info.side_effect = DatabaseUnavailableError
+    spool = SaveSpool(*spool_args, 0.01, 10, 100)
+    await spool.start()
+    await spool.add(1, example_stream(outside_source_stream,
+                                      mock_replay_headers))
+    await spool.stop()
+    assert not spool._tasks
+    assert tmpdir.join("spool", "1.spool").exists()
@@ -0,0 +1,136 @@
+import pytest
+import datetime
+import time
+
+from replayserver.bookkeeping.database import ReplayDatabaseQueries
+from replayserver.bookkeeping.sqlite import SqliteDatabase
+from replayserver.errors import BookkeepingError
+
+
+async def add_game(db, game_id, players, end_time='2001-01-02 00:00:00'):
+    await db.execute("""
+        INSERT INTO `game_stats`
+            (`id`, `startTime`, `endTime`, `gameType`,
+             `gameMod`, `host`, `mapId`, `gameName`, `validity`)
+        VALUES
+            (%s, '2001-01-01 00:00:00', %s, '0', 1, 1, 1,
+             'Name of the game', 1)
+    """, ((game_id, end_time),))
+    for player_id, team in players:
+        await db.execute("""
+            INSERT INTO `game_player_stats`
+                (`gameId`, `playerId`, `AI`, `team`)
+            VALUES (%s, %s, 0, %s)
+        """, ((game_id, player_id, team),))
+
+
+@pytest.fixture
+async def sqlite_db():
+    db = SqliteDatabase(":memory:", 0)
+    await db.start()
+    for i in range(1, 3):
+        await db.execute(
+            "INSERT INTO `login` (`id`, `login`) VALUES (%s, %s)",
+            ((i, f"user{i}"),))
+    await db.execute("INSERT INTO `map` VALUES (1, 'scmp_1')")
+    await db.execute("INSERT INTO `map_version` "
+                     "VALUES (1, 'maps/scmp_1.zip', 1)")
+    await db.execute("INSERT INTO `game_featuredMods` VALUES (1, 'faf')")
+    await db.execute("INSERT INTO `updates_faf` VALUES (1, 'a', 'a')")
+    await db.execute("INSERT INTO `updates_faf_files` VALUES "
+                     "(1, 1, 1, 'a', '', 0), (2, 1, 2, 'b', '', 0)")
+    try:
+        yield db
+    finally:
+        await db.stop()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_query_not_started():
+    db = SqliteDatabase(":memory:", 0)
+    with pytest.raises(BookkeepingError):
+        await db.execute("SELECT * FROM `login`")
+
+
+@pytest.mark.asyncio
+async def test_sqlite_bad_query(sqlite_db):
+    with pytest.raises(BookkeepingError):
+        await sqlite_db.execute("SELECT * glablagradargh")
+    with pytest.raises(BookkeepingError):
+        await sqlite_db.execute("SELECT * FROM `login` WHERE `id` = %s")
+
+
+@pytest.mark.asyncio
+async def test_sqlite_expands_sequence_params(sqlite_db):
+    rows = await sqlite_db.execute(
+        "SELECT `login` FROM `login` WHERE `id` IN %s ORDER BY `id`",
+        (((1, 2),),))
+    assert rows == [{"login": "user1"}, {"login": "user2"}]
+    rows = await sqlite_db.execute(
+        "SELECT `login` FROM `login` WHERE `id` = %s", (2,))
+    assert rows == [{"login": "user2"}]
+
+
+@pytest.mark.asyncio
+async def test_sqlite_latency():
+    db = SqliteDatabase(":memory:", 0.05)
+    await db.start()
+    start = time.monotonic()
+    await db.execute("SELECT * FROM `login`")
+    assert time.monotonic() - start >= 0.05
+    await db.stop()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_replay_queries(sqlite_db):
+    queries = ReplayDatabaseQueries(sqlite_db, 0)
+    await add_game(sqlite_db, 1, [(1, 1), (2, 2)])
+    await add_game(sqlite_db, 2, [(1, 1)], end_time=None)
+
+    teams = await queries.get_teams_in_game(1)
+    assert teams == {1: ["user1"], 2: ["user2"]}
+    stats = await queries.get_game_stats(1)
+    assert stats == {
+        'featured_mod': 'faf',
+        'game_type': '0',
+        'recorder': 'user1',
+        'host': 'user1',
+        'launched_at': datetime.datetime(2001, 1, 1, 0, 0).timestamp(),
+        'game_end': datetime.datetime(2001, 1, 2, 0, 0).timestamp(),
+        'title': 'Name of the game',
+        'mapname': 'scmp_1',
+        'map_file_path': 'maps/scmp_1.zip',
+        'num_players': 2
+    }
+    assert await queries.get_mod_versions("faf") == {"1": 2}
+    with pytest.raises(BookkeepingError):
+        await queries.get_game_stats(3)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_batched_replay_queries(sqlite_db):
+    queries = ReplayDatabaseQueries(sqlite_db, 0)
+    await add_game(sqlite_db, 1, [(1, 1), (2, 2)])
+    await add_game(sqlite_db, 2, [(1, 1)], end_time=None)
+
+    teams = await queries.get_teams_in_games([1, 2, 3])
+    assert teams == {1: {1: ["user1"], 2: ["user2"]}, 2: {1: ["user1"]}}
+    stats = await queries.get_many_game_stats([1, 2, 3])
+    assert sorted(stats.keys()) == [1, 2]
+    assert stats[2]['num_players'] == 1
+    before = time.time()
+    assert await queries.get_game_end(2) >= before
+
+
+@pytest.mark.asyncio
+async def test_sqlite_batched_stats_match_single_game(sqlite_db):
+    queries = ReplayDatabaseQueries(sqlite_db, 0)
+    await add_game(sqlite_db, 1, [(1, 1), (2, 2)])
+    await add_game(sqlite_db, 2, [(1, 1)])
+    # Stats query joins map versions, so a game gets a row for each
+    await sqlite_db.execute("INSERT INTO `map_version` "
+                            "VALUES (2, 'maps/scmp_1.v0002.zip', 1)")
+
+    stats = await queries.get_many_game_stats([1, 2])
+    assert stats[1] == await queries.get_game_stats(1)
+    assert stats[2] == await queries.get_game_stats(2)
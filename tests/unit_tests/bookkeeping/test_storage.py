@@ -1,35 +1,54 @@
 import pytest
+import asyncio
 import asynctest
 import datetime
+import base64
+import io
 import os
+import pymysql
 import stat
+import struct
+import tracemalloc
 
 from tests.replays import example_replay, unpack_replay
-from replayserver.bookkeeping.storage import ReplayFilePaths, ReplaySaver
-from replayserver.errors import BookkeepingError
+from replayserver.bookkeeping.storage import ReplayFilePaths, ReplaySaver, \
+    Base64Writer
+from replayserver.bookkeeping.compression import ReplayCompressor
+from replayserver.bookkeeping.executor import SaveExecutor
+from replayserver.bookkeeping.commit import ReplayCommitter, SaveDurability
+from replayserver.bookkeeping.database import Database, ReplayDatabaseQueries
+from replayserver.bookkeeping.breaker import CircuitBreaker, BreakerState
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
 
 
-def test_replay_paths(tmpdir):
-    paths = ReplayFilePaths(str(tmpdir))
-    rpath = paths.get(1123456789)
+@pytest.fixture
+def save_executor(event_loop):
+    return SaveExecutor(2, 4)
+
+
+@pytest.mark.asyncio
+async def test_replay_paths(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    rpath = await paths.get(1123456789)
     expected = tmpdir.join("11", "23", "45", "67",
                            "1123456789.fafreplay")
     assert rpath == str(expected)
     assert expected.exists()
 
 
-def test_replay_paths_odd_ids(tmpdir):
-    paths = ReplayFilePaths(str(tmpdir))
+@pytest.mark.asyncio
+async def test_replay_paths_odd_ids(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
 
-    rpath = paths.get(12345)
+    rpath = await paths.get(12345)
     assert rpath == str(tmpdir.join("0", "0", "1", "23",
                                     "12345.fafreplay"))
 
-    rpath = paths.get(0)
+    rpath = await paths.get(0)
     assert rpath == str(tmpdir.join("0", "0", "0", "0",
                                     "0.fafreplay"))
 
-    rpath = paths.get(101010101)
+    rpath = await paths.get(101010101)
     assert rpath == str(tmpdir.join("1", "1", "1", "1",
                                     "101010101.fafreplay"))
 
@@ -37,31 +56,110 @@ def test_replay_paths_odd_ids(tmpdir):
     # But I imagine same legacy code is used everywhere, so let's keep that
     # broken behaviour.
     # We didn't even break 8 digits yet anyway.
-    rpath = paths.get(111122223333)
+    rpath = await paths.get(111122223333)
     assert rpath == str(tmpdir.join("11", "22", "22", "33",
                                     "111122223333.fafreplay"))
 
 
-def test_replay_paths_same_folder(tmpdir):
-    paths = ReplayFilePaths(str(tmpdir))
-    paths.get(11111111)
-    paths.get(11111112)
+@pytest.mark.asyncio
+async def test_replay_paths_same_folder(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    await paths.get(11111111)
+    await paths.get(11111112)
     assert tmpdir.join("0", "11", "11", "11", "11111111.fafreplay").exists()
     assert tmpdir.join("0", "11", "11", "11", "11111112.fafreplay").exists()
 
 
-def test_replay_paths_second_access_not_allowed(tmpdir):
+@pytest.mark.asyncio
+async def test_replay_paths_second_access_not_allowed(tmpdir, save_executor):
     # We should not allow getting the same path twice to avoid overwriting or
     # corrupting the existing replay
-    paths = ReplayFilePaths(str(tmpdir))
-    paths.get(1123456789)
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    await paths.get(1123456789)
     with pytest.raises(BookkeepingError):
-        paths.get(1123456789)
+        await paths.get(1123456789)
+
+
+@pytest.mark.asyncio
+async def test_replay_paths_reuse_placeholder(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    rfile = await paths.get(1123456789)
+    assert await paths.get(1123456789, reuse_placeholder=True) == rfile
+
+    # Never reuse a file that has a replay in it
+    with open(rfile, "wb") as f:
+        f.write(b"foo")
+    with pytest.raises(BookkeepingError):
+        await paths.get(1123456789, reuse_placeholder=True)
+
+
+@pytest.mark.asyncio
+async def test_replay_paths_creates_next_folder_ahead(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    await paths.get(11111111)
+    assert tmpdir.join("0", "11", "11", "12").isdir()
+
+
+@pytest.mark.asyncio
+async def test_replay_paths_remembers_created_folders(tmpdir, save_executor,
+                                                      mocker):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    await paths.get(11111111)
+    makedirs = mocker.spy(os, "makedirs")
+    await paths.get(11111112)
+    makedirs.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_replay_paths_recreates_removed_folder(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    await paths.get(11111111)
+    tmpdir.join("0", "11", "11", "11").remove()
+    rfile = await paths.get(11111112)
+    assert rfile == str(tmpdir.join("0", "11", "11", "11",
+                                    "11111112.fafreplay"))
+    assert os.path.exists(rfile)
+
+
+@pytest.mark.asyncio
+async def test_replay_paths_remembers_few_folders(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir), save_executor)
+    for i in range(20):
+        await paths.get(11111111 + i * ReplayFilePaths.IDS_PER_DIRECTORY)
+    assert len(paths._created_dirs) <= ReplayFilePaths.REMEMBERED_DIRS
+
+
+@pytest.mark.asyncio
+async def test_replay_paths_folder_not_writable(tmpdir, save_executor):
+    paths = ReplayFilePaths(str(tmpdir.join("file")), save_executor)
+    tmpdir.join("file").write("")
+    with pytest.raises(BookkeepingError):
+        await paths.get(11111111)
+
+
+@pytest.mark.parametrize("pieces", [
+    [],
+    [b"a"],
+    [b"ab", b"c", b"", b"defg"],
+    [b"a", b"b", b"c", b"d"],
+    [bytes(range(256)) * 1000, b"x", bytes(range(256)) * 1000],
+])
+def test_base64_writer(pieces):
+    out = io.BytesIO()
+    writer = Base64Writer(out)
+    for piece in pieces:
+        writer.write(piece)
+    writer.close()
+    assert out.getvalue() == base64.b64encode(b"".join(pieces))
 
 
 @pytest.fixture
 def mock_replay_paths():
-    return asynctest.Mock(spec=['get'])
+    class P:
+        async def get():
+            pass
+
+    return asynctest.Mock(spec=P)
 
 
 @pytest.fixture
@@ -76,6 +174,9 @@ def mock_database_queries():
         async def get_mod_versions():
             pass
 
+        async def get_game_end():
+            pass
+
     return asynctest.Mock(spec=Q)
 
 
@@ -96,14 +197,20 @@ def_mod_versions = {'1': 1}
 
 
 @pytest.fixture
-def standard_saver_args(mock_replay_paths, mock_database_queries, tmpdir):
+def standard_saver_args(mock_replay_paths, mock_database_queries,
+                        save_executor, tmpdir):
     rfile = str(tmpdir.join("replay"))
     open(rfile, "a").close()
     mock_replay_paths.get.return_value = rfile
     mock_database_queries.get_teams_in_game.return_value = def_teams_in_game
     mock_database_queries.get_game_stats.return_value = def_game_stats
     mock_database_queries.get_mod_versions.return_value = def_mod_versions
-    return mock_replay_paths, mock_database_queries
+
+    def compressor_builder(stream):
+        return ReplayCompressor(stream, save_executor, 1024, 6)
+    committer = ReplayCommitter(save_executor, SaveDurability.NONE, 0.01)
+    return (mock_replay_paths, mock_database_queries, save_executor,
+            committer, compressor_builder, None)
 
 
 def set_example_stream_data(outside_source_stream, mock_replay_headers):
@@ -133,6 +240,21 @@ async def test_replay_saver_save_replay(standard_saver_args,
     assert rep == example_replay.header_data + b"bar"
 
 
+@pytest.mark.asyncio
+async def test_replay_saver_prepared_replay(standard_saver_args,
+                                            mock_replay_headers,
+                                            outside_source_stream, tmpdir):
+    saver = ReplaySaver(*standard_saver_args)
+    saver.prepare_replay(1111, outside_source_stream)
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    await saver.save_replay(1111, outside_source_stream)
+
+    rfile = str(tmpdir.join("replay"))
+    head, rep = unpack_replay(open(rfile, "rb").read())
+    assert head['uid'] == 1111
+    assert rep == example_replay.header_data + b"bar"
+
+
 @pytest.mark.asyncio
 async def test_replay_saver_no_header(standard_saver_args,
                                       outside_source_stream, tmpdir):
@@ -143,17 +265,37 @@ async def test_replay_saver_no_header(standard_saver_args,
 
 
 @pytest.mark.asyncio
-async def test_replay_saver_readonly_file(standard_saver_args,
-                                          mock_replay_headers,
-                                          outside_source_stream, tmpdir):
+async def test_replay_saver_readonly_directory(standard_saver_args,
+                                               mock_replay_headers,
+                                               outside_source_stream, tmpdir):
     set_example_stream_data(outside_source_stream, mock_replay_headers)
 
-    rfile = str(tmpdir.join("replay"))
-    os.chmod(rfile, stat.S_IRUSR)
+    rdir = tmpdir.mkdir("readonly")
+    rfile = str(rdir.join("replay"))
+    open(rfile, "a").close()
+    standard_saver_args[0].get.return_value = rfile
+    os.chmod(str(rdir), stat.S_IRUSR | stat.S_IXUSR)
+
+    saver = ReplaySaver(*standard_saver_args)
+    try:
+        with pytest.raises(BookkeepingError):
+            await saver.save_replay(1111, outside_source_stream)
+    finally:
+        os.chmod(str(rdir), stat.S_IRWXU)
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_write_failure_keeps_no_partial_file(
+        standard_saver_args, mock_replay_headers, outside_source_stream,
+        tmpdir, mocker):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    mocker.patch.object(Base64Writer, "close", side_effect=OSError)
 
     saver = ReplaySaver(*standard_saver_args)
     with pytest.raises(BookkeepingError):
         await saver.save_replay(1111, outside_source_stream)
+    assert tmpdir.join("replay").read_binary() == b""
+    assert not tmpdir.join("replay.tmp").exists()
 
 
 @pytest.mark.asyncio
@@ -171,3 +313,172 @@ async def test_replay_saver_null_team(standard_saver_args,
     rfile = str(tmpdir.join("replay"))
     head, rep = unpack_replay(open(rfile, "rb").read())
     assert head["teams"]["null"] == ["SomeGuy"]
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_database_unavailable(standard_saver_args,
+                                                 mock_replay_headers,
+                                                 outside_source_stream,
+                                                 tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    mock_queries = standard_saver_args[1]
+    mock_queries.get_game_stats.side_effect = DatabaseUnavailableError
+
+    saver = ReplaySaver(*standard_saver_args)
+    await saver.save_replay(1111, outside_source_stream)
+    rfile = str(tmpdir.join("replay"))
+    head, rep = unpack_replay(open(rfile, "rb").read())
+    assert head['uid'] == 1111
+    assert head['featured_mod'] is None
+    assert head['teams'] == {}
+    assert head['featured_mod_versions'] == {}
+    assert rep == example_replay.header_data + b"bar"
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_connection_error_with_breaker_closed(
+        standard_saver_args, mock_replay_headers, outside_source_stream,
+        tmpdir):
+    # A single query losing its connection doesn't open the breaker, but it
+    # should still not cost us the replay
+    class Pool:
+        async def acquire(self):
+            raise pymysql.err.OperationalError(2013, "Lost connection")
+
+    async def start_pool():
+        return Pool()
+
+    breaker = CircuitBreaker(5, 10, 60, 30)
+    db = Database(start_pool, 1, breaker)
+    await db.start()
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    args = list(standard_saver_args)
+    args[1] = ReplayDatabaseQueries(db, 60)
+
+    saver = ReplaySaver(*args)
+    await saver.save_replay(1111, outside_source_stream)
+    assert breaker.state is BreakerState.CLOSED
+    rfile = str(tmpdir.join("replay"))
+    head, rep = unpack_replay(open(rfile, "rb").read())
+    assert head['uid'] == 1111
+    assert head['featured_mod'] is None
+    assert rep == example_replay.header_data + b"bar"
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_query_failure_is_not_degraded(
+        standard_saver_args, mock_replay_headers, outside_source_stream,
+        tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    mock_queries = standard_saver_args[1]
+    mock_queries.get_game_stats.side_effect = BookkeepingError
+
+    saver = ReplaySaver(*standard_saver_args)
+    with pytest.raises(BookkeepingError):
+        await saver.save_replay(1111, outside_source_stream)
+    assert tmpdir.join("replay").read_binary() == b""
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_memory_use_is_constant(standard_saver_args,
+                                                   mock_replay_headers,
+                                                   outside_source_stream,
+                                                   tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    compressed = [os.urandom(64 * 1024 + 1) for i in range(128)]
+    compressor = asynctest.Mock(spec=["finish"])
+    compressor.finish = asynctest.CoroutineMock(
+        return_value=(1234, compressed))
+    paths, queries, executor, committer, _, _ = standard_saver_args
+    saver = ReplaySaver(paths, queries, executor, committer,
+                        lambda stream: compressor, None)
+
+    tracemalloc.start()
+    try:
+        await saver.save_replay(1111, outside_source_stream)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 1024 * 1024    # About 8MB of data
+
+    rfile = str(tmpdir.join("replay"))
+    head, b64_part = open(rfile, "rb").read().split(b"\n", 1)
+    data = base64.b64decode(b64_part)
+    assert data == struct.pack("i", 1234) + b"".join(compressed)
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_queries_run_concurrently(standard_saver_args,
+                                                     mock_replay_headers,
+                                                     outside_source_stream,
+                                                     event_loop):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    mock_queries = standard_saver_args[1]
+    both_started = asyncio.Event()
+    started = []
+
+    def query(result):
+        async def run(game_id):
+            started.append(result)
+            if len(started) == 2:
+                both_started.set()
+            await both_started.wait()
+            return result
+        return run
+
+    mock_queries.get_game_stats.side_effect = query(def_game_stats)
+    mock_queries.get_teams_in_game.side_effect = query(def_teams_in_game)
+
+    saver = ReplaySaver(*standard_saver_args)
+    await asyncio.wait_for(saver.save_replay(1111, outside_source_stream),
+                           timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_uses_prefetched_info(standard_saver_args,
+                                                 mock_replay_headers,
+                                                 outside_source_stream,
+                                                 tmpdir):
+    paths, queries, executor, committer, compressor_builder, _ = \
+        standard_saver_args
+    queries.get_game_end.return_value = 12345.0
+    prefetcher = asynctest.Mock(spec=["prefetch"])
+    prefetched = asyncio.Future()
+    prefetched.set_result((dict(def_game_stats), def_teams_in_game))
+    prefetcher.prefetch.return_value = prefetched
+
+    saver = ReplaySaver(paths, queries, executor, committer,
+                        compressor_builder, prefetcher)
+    saver.prepare_replay(1111, outside_source_stream)
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    await saver.save_replay(1111, outside_source_stream)
+
+    queries.get_game_stats.assert_not_called()
+    queries.get_teams_in_game.assert_not_called()
+    rfile = str(tmpdir.join("replay"))
+    head, rep = unpack_replay(open(rfile, "rb").read())
+    assert head['game_end'] == 12345.0
+    assert head['title'] == def_game_stats['title']
+    assert head['teams'] == {"1": ["user1"], "2": ["user2"]}
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_prefetch_not_ready(standard_saver_args,
+                                               mock_replay_headers,
+                                               outside_source_stream,
+                                               tmpdir):
+    paths, queries, executor, committer, compressor_builder, _ = \
+        standard_saver_args
+    prefetcher = asynctest.Mock(spec=["prefetch"])
+    prefetched = asyncio.Future()
+    prefetcher.prefetch.return_value = prefetched
+
+    saver = ReplaySaver(paths, queries, executor, committer,
+                        compressor_builder, prefetcher)
+    saver.prepare_replay(1111, outside_source_stream)
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    await saver.save_replay(1111, outside_source_stream)
+
+    assert prefetched.cancelled()
+    queries.get_game_stats.assert_called_with(1111)
+    queries.get_game_end.assert_not_called()
@@ -203,7 +203,7 @@ async def test_merger_connection_extends_grace_period(
 
 @skip_if_needs_asynctest_107
 @pytest.mark.asyncio
-@timeout(0.1)
+@timeout(0.2)
 async def test_merger_active_connection_prevents_ending(
         outside_source_stream, mock_merge_strategy, mock_stream_builder,
         mock_connection_streams, mock_connections, event_loop):
@@ -4,6 +4,7 @@ import asyncio
 from tests import fast_forward_time
 from replayserver.receive.mergestrategy import MergeStrategies
 from replayserver.stream import ReplayStream, ConcreteDataMixin
+from replayserver.receive.stream import OutsideSourceReplayStream
 
 
 # Technically we shouldn't rely on abstract classes being good, and should use
@@ -18,13 +19,22 @@ class MockStream(ConcreteDataMixin, ReplayStream):
         return self._ended
 
 
-general_test_strats = [MergeStrategies.GREEDY, MergeStrategies.FOLLOW_STREAM]
+general_test_strats = [MergeStrategies.GREEDY, MergeStrategies.FOLLOW_STREAM,
+                       MergeStrategies.QUORUM]
+config = {
+    "config_mergestrategy_stall_check_period": 60,
+    "config_mergestrategy_share_matching_data": False,
+    "config_mergestrategy_discard_diverged_data": False,
+    "config_mergestrategy_failover_lead_bytes": 0,
+    "config_mergestrategy_failover_lead_time": 0,
+    "config_mergestrategy_quorum_size": 2,
+    "config_mergestrategy_quorum_block_size": 4096,
+}
 
 
 @pytest.mark.parametrize("strategy", general_test_strats)
 def test_strategy_ends_stream_when_finalized(strategy, outside_source_stream):
-    strat = strategy.build(outside_source_stream,
-                           config_mergestrategy_stall_check_period=60)
+    strat = strategy.build(outside_source_stream, **config)
     stream1 = MockStream()
     strat.stream_added(stream1)
     strat.stream_removed(stream1)
@@ -34,8 +44,7 @@ def test_strategy_ends_stream_when_finalized(strategy, outside_source_stream):
 
 @pytest.mark.parametrize("strategy", general_test_strats)
 def test_strategy_picks_at_least_one_header(strategy, outside_source_stream):
-    strat = strategy.build(outside_source_stream,
-                           config_mergestrategy_stall_check_period=60)
+    strat = strategy.build(outside_source_stream, **config)
     stream1 = MockStream()
     stream2 = MockStream()
     stream2._header = "Header"
@@ -51,8 +60,7 @@ def test_strategy_picks_at_least_one_header(strategy, outside_source_stream):
 
 @pytest.mark.parametrize("strategy", general_test_strats)
 def test_strategy_gets_all_data_of_one(strategy, outside_source_stream):
-    strat = strategy.build(outside_source_stream,
-                           config_mergestrategy_stall_check_period=60)
+    strat = strategy.build(outside_source_stream, **config)
     stream1 = MockStream()
     stream1._header = "Header"
 
@@ -73,8 +81,7 @@ def test_strategy_gets_all_data_of_one(strategy, outside_source_stream):
 
 @pytest.mark.parametrize("strategy", general_test_strats)
 def test_strategy_gets_common_prefix_of_all(strategy, outside_source_stream):
-    strat = strategy.build(outside_source_stream,
-                           config_mergestrategy_stall_check_period=60)
+    strat = strategy.build(outside_source_stream, **config)
     stream1 = MockStream()
     stream2 = MockStream()
     stream2._header = "Header"
@@ -103,8 +110,7 @@ def test_strategy_gets_common_prefix_of_all(strategy, outside_source_stream):
 @pytest.mark.parametrize("strategy", [MergeStrategies.FOLLOW_STREAM])
 def test_strategy_follow_stream_later_has_more_data(strategy,
                                                     outside_source_stream):
-    strat = strategy.build(outside_source_stream,
-                           config_mergestrategy_stall_check_period=60)
+    strat = strategy.build(outside_source_stream, **config)
     stream1 = MockStream()
     stream2 = MockStream()
     stream2._header = "Header"
@@ -127,8 +133,7 @@ def test_strategy_follow_stream_later_has_more_data(strategy,
 @pytest.mark.parametrize("strategy", [MergeStrategies.FOLLOW_STREAM])
 def test_strategy_follow_stream_new_tracked_stream_diverges(
         strategy, outside_source_stream):
-    strat = strategy.build(outside_source_stream,
-                           config_mergestrategy_stall_check_period=60)
+    strat = strategy.build(outside_source_stream, **config)
     stream1 = MockStream()
     stream2 = MockStream()
     stream2._header = "Header"
@@ -152,8 +157,9 @@ def test_strategy_follow_stream_new_tracked_stream_diverges(
 @pytest.mark.parametrize("strategy", [MergeStrategies.FOLLOW_STREAM])
 async def test_strategy_follow_stream_deals_with_stalled_connections(
         event_loop, strategy, outside_source_stream):
-    strat = strategy.build(outside_source_stream,
-                           config_mergestrategy_stall_check_period=3)
+    strat = strategy.build(
+        outside_source_stream,
+        **dict(config, config_mergestrategy_stall_check_period=3))
     stalled_stream = MockStream()
     ahead_stream = MockStream()
 
@@ -189,3 +195,391 @@ async def test_strategy_follow_stream_deals_with_stalled_connections(
     strat.stream_removed(stalled_stream)
     strat.stream_removed(ahead_stream)
     strat.finalize()
+
+
+def test_strategy_follow_stream_fails_over_to_stream_ahead_by_bytes(
+        outside_source_stream):
+    strat = MergeStrategies.FOLLOW_STREAM.build(
+        outside_source_stream,
+        **dict(config, config_mergestrategy_failover_lead_bytes=10))
+    stalled_stream = MockStream()
+    ahead_stream = MockStream()
+    diverging_stream = MockStream()
+    for stream in [stalled_stream, ahead_stream, diverging_stream]:
+        stream._header = "Header"
+        strat.stream_added(stream)
+        strat.new_header(stream)
+
+    stalled_stream._data += b"a" * 10
+    strat.new_data(stalled_stream)
+    assert outside_source_stream.data.bytes() == b"a" * 10
+
+    diverging_stream._data += b"b" * 30
+    strat.new_data(diverging_stream)
+    ahead_stream._data += b"a" * 19
+    strat.new_data(ahead_stream)
+    # Not far enough ahead yet, diverging stream is never picked
+    assert outside_source_stream.data.bytes() == b"a" * 10
+
+    ahead_stream._data += b"a"
+    strat.new_data(ahead_stream)
+    assert outside_source_stream.data.bytes() == b"a" * 20
+
+    # We follow the new stream from now on
+    ahead_stream._data += b"a"
+    strat.new_data(ahead_stream)
+    stalled_stream._data += b"a" * 15
+    strat.new_data(stalled_stream)
+    assert outside_source_stream.data.bytes() == b"a" * 21
+
+    for stream in [stalled_stream, ahead_stream, diverging_stream]:
+        strat.stream_removed(stream)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"a" * 25
+
+
+@fast_forward_time(1, 20)
+@pytest.mark.asyncio
+async def test_strategy_follow_stream_fails_over_to_stream_ahead_by_time(
+        event_loop, outside_source_stream):
+    strat = MergeStrategies.FOLLOW_STREAM.build(
+        outside_source_stream,
+        **dict(config, config_mergestrategy_failover_lead_time=5))
+    stalled_stream = MockStream()
+    ahead_stream = MockStream()
+    for stream in [stalled_stream, ahead_stream]:
+        stream._header = "Header"
+        strat.stream_added(stream)
+        strat.new_header(stream)
+
+    stalled_stream._data += b"a" * 10
+    strat.new_data(stalled_stream)
+
+    for i in range(4):
+        await asyncio.sleep(1)
+        ahead_stream._data += b"a" * 5
+        strat.new_data(ahead_stream)
+
+    # Tracked stream hasn't been quiet for long enough
+    assert outside_source_stream.data.bytes() == b"a" * 10
+
+    await asyncio.sleep(1)
+    ahead_stream._data += b"a" * 5
+    strat.new_data(ahead_stream)
+    assert outside_source_stream.data.bytes() == b"a" * 25
+
+    strat.stream_removed(stalled_stream)
+    strat.stream_removed(ahead_stream)
+    strat.finalize()
+
+
+def test_strategy_follow_stream_no_failover_by_default(
+        outside_source_stream):
+    strat = MergeStrategies.FOLLOW_STREAM.build(outside_source_stream,
+                                                **config)
+    tracked_stream = MockStream()
+    ahead_stream = MockStream()
+    for stream in [tracked_stream, ahead_stream]:
+        stream._header = "Header"
+        strat.stream_added(stream)
+        strat.new_header(stream)
+
+    tracked_stream._data += b"a" * 10
+    strat.new_data(tracked_stream)
+    ahead_stream._data += b"a" * 1000
+    strat.new_data(ahead_stream)
+    assert outside_source_stream.data.bytes() == b"a" * 10
+
+    strat.stream_removed(tracked_stream)
+    strat.stream_removed(ahead_stream)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"a" * 1000
+
+
+def test_strategy_follow_stream_shares_matching_data(outside_source_stream):
+    strat = MergeStrategies.FOLLOW_STREAM.build(
+        outside_source_stream,
+        **dict(config, config_mergestrategy_share_matching_data=True))
+    stream1 = MockStream()
+    stream2 = MockStream()
+    stream3 = MockStream()
+    for stream in [stream1, stream2, stream3]:
+        stream._header = "Header"
+        strat.stream_added(stream)
+        strat.new_header(stream)
+
+    stream1._data += b"Data and"
+    strat.new_data(stream1)
+    stream2._data += b"Data and stuff"
+    strat.new_data(stream2)
+    stream3._data += b"Data or"
+    strat.new_data(stream3)
+
+    # Matching data is not kept by matching streams
+    assert stream1._data._chunks == []
+    assert stream2._data._chunks == [b"Data and stuff"]
+    assert stream3._data._chunks == [b"Data or"]
+
+    stream1._data += b" stuff and things"
+    strat.new_data(stream1)
+    stream2._data += b" and things"
+    strat.new_data(stream2)
+
+    assert stream1._data._chunks == []
+    assert stream2._data._chunks == []
+    assert stream1.data.bytes() == b"Data and stuff and things"
+    assert stream2.data.bytes() == b"Data and stuff and things"
+    assert stream3.data.bytes() == b"Data or"
+
+    for stream in [stream1, stream2, stream3]:
+        strat.stream_removed(stream)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"Data and stuff and things"
+
+
+def test_strategy_follow_stream_discards_diverged_data(outside_source_stream):
+    strat = MergeStrategies.FOLLOW_STREAM.build(
+        outside_source_stream,
+        **dict(config, config_mergestrategy_discard_diverged_data=True))
+    stream1 = MockStream()
+    stream2 = MockStream()
+    for stream in [stream1, stream2]:
+        stream._header = "Header"
+        strat.stream_added(stream)
+        strat.new_header(stream)
+
+    stream1._data += b"Data and stuff"
+    strat.new_data(stream1)
+    stream2._data += b"Data or"
+    strat.new_data(stream2)
+
+    assert stream2._data.discarded
+    assert not stream1._data.discarded
+    stream2._data += b" things"
+    strat.new_data(stream2)
+    assert len(stream2.data) == 14
+
+    for stream in [stream1, stream2]:
+        strat.stream_removed(stream)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"Data and stuff"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("strategy", general_test_strats)
+async def test_strategy_feeds_sink_without_copying(strategy):
+    sink = OutsideSourceReplayStream()
+    strat = strategy.build(sink, **config)
+    stream1 = MockStream()
+    stream1._header = "Header"
+    strat.stream_added(stream1)
+    strat.new_header(stream1)
+
+    chunks = [b"Best f", b"r", b"iends"]
+    for chunk in chunks:
+        stream1._data += chunk
+        strat.new_data(stream1)
+    strat.stream_removed(stream1)
+    strat.finalize()
+
+    assert sink.data.bytes() == b"Best friends"
+    assert all(a is b for a, b in zip(sink._data._chunks, chunks))
+
+
+def quorum_strategy(sink, quorum_size=2, **kwargs):
+    return MergeStrategies.QUORUM.build(
+        sink, **dict(config, config_mergestrategy_quorum_size=quorum_size,
+                     config_mergestrategy_quorum_block_size=4, **kwargs))
+
+
+def add_streams(strat, count):
+    streams = [MockStream() for _ in range(count)]
+    for stream in streams:
+        stream._header = "Header"
+        strat.stream_added(stream)
+        strat.new_header(stream)
+    return streams
+
+
+def test_strategy_quorum_commits_blocks_writers_agree_on(
+        outside_source_stream):
+    strat = quorum_strategy(outside_source_stream)
+    stream1, stream2, stream3 = add_streams(strat, 3)
+
+    stream1._data += b"aaaabb"
+    strat.new_data(stream1)
+    assert outside_source_stream.data.bytes() == b""
+    stream3._data += b"aaaaXXXX"
+    strat.new_data(stream3)
+    assert outside_source_stream.data.bytes() == b"aaaa"
+    stream2._data += b"aaaabbbb"
+    strat.new_data(stream2)
+    assert outside_source_stream.data.bytes() == b"aaaa"
+    stream1._data += b"bb"
+    strat.new_data(stream1)
+    assert outside_source_stream.data.bytes() == b"aaaabbbb"
+
+    # Diverged stream doesn't count anymore, even if it ends up longest
+    stream3._data += b"cccccccc"
+    strat.new_data(stream3)
+    for stream in [stream1, stream2, stream3]:
+        strat.stream_removed(stream)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"aaaabbbb"
+
+
+def test_strategy_quorum_progresses_without_stalled_writer(
+        outside_source_stream):
+    strat = quorum_strategy(outside_source_stream)
+    stalled, stream1, stream2 = add_streams(strat, 3)
+
+    stalled._data += b"aaaa"
+    strat.new_data(stalled)
+    for i in range(5):
+        for stream in [stream1, stream2]:
+            stream._data += b"aaaa"
+            strat.new_data(stream)
+    assert outside_source_stream.data.bytes() == b"a" * 20
+
+    for stream in [stalled, stream1, stream2]:
+        strat.stream_removed(stream)
+    strat.finalize()
+
+
+def test_strategy_quorum_follows_stream_without_enough_writers(
+        outside_source_stream):
+    strat = quorum_strategy(outside_source_stream)
+    stream1, = add_streams(strat, 1)
+
+    stream1._data += b"aaaaaa"
+    strat.new_data(stream1)
+    assert outside_source_stream.data.bytes() == b"aaaaaa"
+
+    # Enough writers, back to waiting for a quorum
+    stream2, = add_streams(strat, 1)
+    stream1._data += b"bbbbbb"
+    strat.new_data(stream1)
+    assert outside_source_stream.data.bytes() == b"aaaaaa"
+    stream2._data += b"aaaaaabbbb"
+    strat.new_data(stream2)
+    assert outside_source_stream.data.bytes() == b"aaaaaabb"
+
+    # Lost a writer, follow the one left
+    strat.stream_removed(stream1)
+    assert outside_source_stream.data.bytes() == b"aaaaaabbbb"
+    stream2._data += b"bbcc"
+    strat.new_data(stream2)
+    assert outside_source_stream.data.bytes() == b"aaaaaabbbbbbcc"
+
+    strat.stream_removed(stream2)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"aaaaaabbbbbbcc"
+
+
+def test_strategy_quorum_rejects_writers_disagreeing_with_followed_data(
+        outside_source_stream):
+    strat = quorum_strategy(outside_source_stream)
+    stream1, = add_streams(strat, 1)
+    stream1._data += b"aaaaaa"
+    strat.new_data(stream1)
+
+    stream2, stream3 = add_streams(strat, 2)
+    for stream in [stream2, stream3]:
+        stream._data += b"aaaaXXbb"
+        strat.new_data(stream)
+    assert outside_source_stream.data.bytes() == b"aaaaaa"
+    # Both diverged, so we follow the only writer left
+    stream1._data += b"bb"
+    strat.new_data(stream1)
+    assert outside_source_stream.data.bytes() == b"aaaaaabb"
+
+    for stream in [stream1, stream2, stream3]:
+        strat.stream_removed(stream)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"aaaaaabb"
+
+
+def test_strategy_quorum_follows_stream_far_ahead_of_lagging_writer(
+        outside_source_stream):
+    strat = quorum_strategy(outside_source_stream,
+                            config_mergestrategy_failover_lead_bytes=100)
+    lagging, ahead = add_streams(strat, 2)
+
+    lagging._data += b"a" * 8
+    strat.new_data(lagging)
+    ahead._data += b"a" * 96
+    strat.new_data(ahead)
+    assert outside_source_stream.data.bytes() == b"a" * 8
+
+    # Both writers are connected, but they'll never agree on new data
+    ahead._data += b"a" * 16
+    strat.new_data(ahead)
+    assert outside_source_stream.data.bytes() == b"a" * 112
+    ahead._data += b"b" * 4
+    strat.new_data(ahead)
+    assert outside_source_stream.data.bytes() == b"a" * 112 + b"b" * 4
+
+    # Lagging writer catching up isn't enough, we follow until they agree
+    lagging._data += b"a" * 96
+    strat.new_data(lagging)
+    assert outside_source_stream.data.bytes() == b"a" * 112 + b"b" * 4
+
+    for stream in [lagging, ahead]:
+        strat.stream_removed(stream)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"a" * 112 + b"b" * 4
+
+
+@fast_forward_time(1, 20)
+@pytest.mark.asyncio
+async def test_strategy_quorum_follows_stream_ahead_by_time(
+        event_loop, outside_source_stream):
+    strat = quorum_strategy(outside_source_stream,
+                            config_mergestrategy_failover_lead_time=5)
+    lagging, ahead = add_streams(strat, 2)
+
+    for i in range(4):
+        await asyncio.sleep(1)
+        ahead._data += b"aaaa"
+        strat.new_data(ahead)
+    assert outside_source_stream.data.bytes() == b""
+
+    await asyncio.sleep(1)
+    ahead._data += b"aaaa"
+    strat.new_data(ahead)
+    assert outside_source_stream.data.bytes() == b"a" * 20
+
+    for stream in [lagging, ahead]:
+        strat.stream_removed(stream)
+    strat.finalize()
+
+
+@fast_forward_time(1, 20)
+@pytest.mark.asyncio
+async def test_strategy_quorum_deals_with_stalled_connections(
+        event_loop, outside_source_stream):
+    strat = quorum_strategy(outside_source_stream,
+                            config_mergestrategy_stall_check_period=3)
+    active, stalled1, stalled2 = add_streams(strat, 3)
+
+    active._data += b"aaaa"
+    strat.new_data(active)
+    for i in range(10):
+        await asyncio.sleep(1)
+    # No quorum, but sink didn't stall forever
+    assert outside_source_stream.data.bytes() == b"aaaa"
+
+    active._data += b"bbbb"
+    strat.new_data(active)
+    assert outside_source_stream.data.bytes() == b"aaaabbbb"
+
+    # Followed stream stalls too, move on to one that's ahead
+    stalled1._data += b"aaaabbbbcc"
+    strat.new_data(stalled1)
+    for i in range(10):
+        await asyncio.sleep(1)
+    assert outside_source_stream.data.bytes() == b"aaaabbbbcc"
+
+    for stream in [active, stalled1, stalled2]:
+        strat.stream_removed(stream)
+    strat.finalize()
@@ -5,7 +5,8 @@ from tests import timeout
 from asynctest.helpers import exhaust_callbacks
 
 from replayserver.receive.stream import ConnectionReplayStream, \
-    OutsideSourceReplayStream
+    OutsideSourceReplayStream, AdaptiveReadSize
+from replayserver.buffer import ChunkedBuffer
 from replayserver.errors import MalformedDataError
 
 
@@ -19,7 +20,8 @@ def mock_header_read():
 async def test_replay_stream_read_header(mock_header_read,
                                          controlled_connections):
     mock_conn = controlled_connections(b"Lorem ipsum")
-    stream = ConnectionReplayStream(mock_header_read, mock_conn)
+    stream = ConnectionReplayStream(mock_header_read, mock_conn,
+                                    AdaptiveReadSize(4096, 4096))
 
     mock_header_read.return_value = "Header", b"Leftover"
 
@@ -37,7 +39,8 @@ async def test_replay_stream_read_header(mock_header_read,
 async def test_replay_stream_invalid_header(
         mock_header_read, mock_connections):
     mock_conn = mock_connections()
-    stream = ConnectionReplayStream(mock_header_read, mock_conn)
+    stream = ConnectionReplayStream(mock_header_read, mock_conn,
+                                    AdaptiveReadSize(4096, 4096))
     mock_header_read.side_effect = MalformedDataError
     with pytest.raises(MalformedDataError):
         await stream.read_header()
@@ -49,7 +52,8 @@ async def test_replay_stream_invalid_header(
 async def test_replay_stream_read(
         mock_header_read, mock_connections):
     mock_conn = mock_connections()
-    stream = ConnectionReplayStream(mock_header_read, mock_conn)
+    stream = ConnectionReplayStream(mock_header_read, mock_conn,
+                                    AdaptiveReadSize(4096, 4096))
 
     mock_conn.read.side_effect = [b"Lorem ", b"ipsum", b""]
     await stream.read()
@@ -63,6 +67,59 @@ async def test_replay_stream_read(
     assert stream.ended()
 
 
+@pytest.mark.asyncio
+@timeout(1)
+async def test_replay_stream_adapts_read_size(
+        mock_header_read, mock_connections):
+    mock_conn = mock_connections()
+    stream = ConnectionReplayStream(mock_header_read, mock_conn,
+                                    AdaptiveReadSize(10, 40))
+
+    async def read_all_of(size):
+        return b"a" * size
+
+    async def read_little(size):
+        return b"a"
+
+    mock_conn.read.side_effect = read_all_of
+    for size in [10, 20, 40, 40]:
+        await stream.read()
+        mock_conn.read.assert_called_with(size)
+
+    mock_conn.read.side_effect = read_little
+    for size in [40, 20, 10, 10]:
+        await stream.read()
+        mock_conn.read.assert_called_with(size)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_replay_stream_read_after_discarding(
+        mock_header_read, mock_connections):
+    mock_conn = mock_connections()
+    stream = ConnectionReplayStream(mock_header_read, mock_conn,
+                                    AdaptiveReadSize(4096, 4096))
+
+    mock_conn.read.side_effect = [b"Lorem ", b"ipsum", b""]
+    await stream.read()
+    assert stream.discard_data() == 6
+    await stream.read()
+    assert len(stream.data) == 11
+    await stream.read()
+    assert len(stream.data) == 11
+    assert stream.ended()
+
+
+def test_adaptive_read_size_keeps_size_for_mostly_full_reads():
+    read_size = AdaptiveReadSize(16, 64)
+    read_size.update(16)
+    assert read_size.value == 32
+    read_size.update(20)
+    assert read_size.value == 32
+    read_size.update(15)
+    assert read_size.value == 16
+
+
 @pytest.mark.asyncio
 @timeout(0.1)
 async def test_outside_source_stream_read_header():
@@ -104,3 +161,48 @@ async def test_outside_source_stream_finish():
     stream.finish()
     await f
     assert stream.ended()
+
+
+def test_outside_source_stream_data_callback():
+    stream = OutsideSourceReplayStream()
+    calls = []
+    stream.add_data_callback(lambda: calls.append(len(stream.data)))
+    stream.feed_data(b"Lorem")
+    stream.feed_data(b"ipsum")
+    assert calls == [5]     # Only called once
+
+    stream.add_data_callback(lambda: calls.append(stream.ended()))
+    stream.finish()
+    assert calls == [5, True]
+
+
+def test_outside_source_stream_header_fires_data_callback():
+    stream = OutsideSourceReplayStream()
+    calls = []
+    stream.add_data_callback(lambda: calls.append(stream.header))
+    stream.set_header("header")
+    assert calls == ["header"]
+
+
+@pytest.mark.asyncio
+@timeout(0.1)
+async def test_outside_source_stream_spills_to_disk(tmpdir):
+    stream = OutsideSourceReplayStream.build(
+        config_replay_spill_dir=str(tmpdir),
+        config_replay_spill_hot_window=4,
+        config_replay_spill_segment_size=1024)
+    stream.feed_data(b"Lorem ")
+    stream.feed_data(b"ipsum")
+    data = await stream.wait_for_data(2)
+    assert data == b"rem ipsum"
+    assert stream.data.bytes() == b"Lorem ipsum"
+    assert stream._data._cold_length == 7
+
+
+def test_outside_source_stream_no_spilling():
+    stream = OutsideSourceReplayStream.build(
+        config_replay_spill_dir=None,
+        config_replay_spill_hot_window=4,
+        config_replay_spill_segment_size=1024)
+    stream.feed_data(b"Lorem ipsum")
+    assert isinstance(stream._data, ChunkedBuffer)
@@ -8,39 +8,29 @@ from replayserver.send.stream import DelayedReplayStream
 
 
 @pytest.fixture
-def mock_timestamp(locked_mock_coroutines):
-    end, wait = locked_mock_coroutines()
-    stamp_list = []
-
-    async def mock_stamps():
-        while True:
-            if stamp_list:
-                yield stamp_list.pop(0)
-            else:
-                await wait()
-                if not stamp_list:
-                    return
+def mock_ticker():
+    callbacks = []
 
     def next_stamp(pos):
-        stamp_list.append(pos)
-        end.set()
-        end.clear()
+        for callback in callbacks:
+            callback(pos, False)
 
-    def end_stamps():
-        end.set()
+    def end_stamps(pos=0):
+        for callback in callbacks:
+            callback(pos, True)
 
-    mock_stamp = asynctest.Mock(spec=["timestamps"], _stamps=stamp_list,
-                                _resume_stamps=end, _next_stamp=next_stamp,
-                                _end_stamps=end_stamps)
-    mock_stamp.timestamps.side_effect = mock_stamps
-    return mock_stamp
+    mock_ticker = asynctest.Mock(spec=["track"], _next_stamp=next_stamp,
+                                 _end_stamps=end_stamps)
+    mock_ticker.track.side_effect = \
+        lambda stream, callback: callbacks.append(callback)
+    return mock_ticker
 
 
 @pytest.mark.asyncio
 @timeout(0.1)
-async def test_delayed_stream_header(outside_source_stream, mock_timestamp,
+async def test_delayed_stream_header(outside_source_stream, mock_ticker,
                                      event_loop):
-    stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
+    stream = DelayedReplayStream(outside_source_stream, mock_ticker)
 
     f = asyncio.ensure_future(stream.wait_for_header())
     await exhaust_callbacks(event_loop)
@@ -53,44 +43,41 @@ async def test_delayed_stream_header(outside_source_stream, mock_timestamp,
     h = await f
     assert h == "Header"
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
-
 
 @pytest.mark.asyncio
 @timeout(0.1)
-async def test_stream_ends_before_header(outside_source_stream, mock_timestamp,
+async def test_stream_ends_before_header(outside_source_stream, mock_ticker,
                                          event_loop):
-    stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
+    stream = DelayedReplayStream(outside_source_stream, mock_ticker)
     outside_source_stream.finish()
-    mock_timestamp._end_stamps()
+    mock_ticker._end_stamps()
     assert (await stream.wait_for_header()) is None
 
 
 @pytest.mark.asyncio
 @timeout(0.1)
-async def test_delayed_stream_data(outside_source_stream, mock_timestamp,
+async def test_delayed_stream_data(outside_source_stream, mock_ticker,
                                    event_loop):
-    stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
+    stream = DelayedReplayStream(outside_source_stream, mock_ticker)
 
     outside_source_stream.feed_data(b"abcde")
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 0
 
-    mock_timestamp._next_stamp(0)
+    mock_ticker._next_stamp(0)
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 0
 
-    mock_timestamp._next_stamp(0)
+    mock_ticker._next_stamp(0)
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 0
 
-    mock_timestamp._next_stamp(3)
+    mock_ticker._next_stamp(3)
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 3
     assert stream.data.bytes() == b"abc"
 
-    mock_timestamp._next_stamp(4)
+    mock_ticker._next_stamp(4)
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 4
     assert stream.data.bytes() == b"abcd"
@@ -100,45 +87,39 @@ async def test_delayed_stream_data(outside_source_stream, mock_timestamp,
     assert len(stream.data) == 4
     assert stream.data.bytes() == b"abcd"
 
-    mock_timestamp._next_stamp(7)
+    mock_ticker._next_stamp(7)
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 7
     assert stream.data.bytes() == b"abcdefg"
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
-
 
 @pytest.mark.asyncio
 @timeout(0.1)
-async def test_stamps_ending_end_stream(outside_source_stream, mock_timestamp,
+async def test_stamps_ending_end_stream(outside_source_stream, mock_ticker,
                                         event_loop):
-    stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
+    stream = DelayedReplayStream(outside_source_stream, mock_ticker)
 
     outside_source_stream.feed_data(b"abcde")
-    mock_timestamp._next_stamp(5)
+    mock_ticker._next_stamp(5)
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 5
 
-    mock_timestamp._resume_stamps.set()
+    mock_ticker._end_stamps(5)
     await exhaust_callbacks(event_loop)
     assert stream.ended()
     d = await stream.wait_for_data()
     assert d == b""
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
-
 
 @pytest.mark.asyncio
 @timeout(0.1)
 async def test_delayed_stream_data_methods(outside_source_stream,
-                                           mock_timestamp,
+                                           mock_ticker,
                                            event_loop):
-    stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
+    stream = DelayedReplayStream(outside_source_stream, mock_ticker)
 
     outside_source_stream.feed_data(b"abcde")
-    mock_timestamp._next_stamp(3)
+    mock_ticker._next_stamp(3)
     await exhaust_callbacks(event_loop)
 
     assert len(stream.data) == 3
@@ -146,6 +127,3 @@ async def test_delayed_stream_data_methods(outside_source_stream,
     assert stream.data[1:4] == b"bc"
     assert stream.data[1:2] == b"b"
     assert stream.data.bytes() == b"abc"
-
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
@@ -2,7 +2,7 @@ import asyncio
 import pytest
 from tests import fast_forward_time, timeout
 
-from replayserver.send.timestamp import Timestamp
+from replayserver.send.timestamp import Timestamp, TimestampTicker
 
 
 @pytest.mark.asyncio
@@ -10,12 +10,13 @@ from replayserver.send.timestamp import Timestamp
 @timeout(20)
 async def test_timestamp(event_loop, mock_replay_streams):
     mock_replay_stream = mock_replay_streams()
-    stamp = Timestamp(mock_replay_stream, 1, 5)
+    ticker = TimestampTicker(1, 5)
     mock_replay_stream.configure_mock(data=b"")
     mock_replay_stream.ended.return_value = False
 
     data_at_second = []
     stream_end_time = 0
+    stamps_ended = asyncio.Event()
 
     async def add_data():
         nonlocal stream_end_time
@@ -28,17 +29,64 @@ async def test_timestamp(event_loop, mock_replay_streams):
         mock_replay_stream.ended.return_value = True
         stream_end_time = event_loop.time()
 
-    async def check_timestamps():
-        async for pos in stamp.timestamps():
-            if not mock_replay_stream.ended():
-                second = int(event_loop.time() + 0.5)
-                past_pos = data_at_second[max(0, second - 5)]
-                assert pos <= past_pos
-            else:
-                assert event_loop.time() - stream_end_time <= 1
+    def check_timestamp(pos, ended):
+        if not ended:
+            second = int(event_loop.time() + 0.5)
+            past_pos = data_at_second[max(0, second - 5)]
+            assert pos <= past_pos
+        else:
+            assert event_loop.time() - stream_end_time <= 1
+            assert pos == 10
+            stamps_ended.set()
 
-    f = asyncio.ensure_future(add_data())
-    g = asyncio.ensure_future(check_timestamps())
+    ticker.track(mock_replay_stream, check_timestamp)
+    await add_data()
+    await stamps_ended.wait()
+    assert len(ticker) == 0
 
-    await f
-    await g
+
+def test_timestamp_delays_by_samples(mock_replay_streams):
+    mock_replay_stream = mock_replay_streams()
+    mock_replay_stream.configure_mock(data=b"")
+    mock_replay_stream.ended.return_value = False
+    stamp = Timestamp(mock_replay_stream, 1, 2)
+
+    positions = []
+    for i in range(5):
+        mock_replay_stream.data += b"a"
+        positions.append(stamp.stamp())
+    assert positions == [0, 0, 1, 2, 3]
+
+    mock_replay_stream.ended.return_value = True
+    assert stamp.stamp() == 5
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.25, 25)
+@timeout(20)
+async def test_ticker_tracks_many_streams(event_loop, mock_replay_streams):
+    ticker = TimestampTicker(1, 0)
+    streams = [mock_replay_streams() for i in range(3)]
+    positions = [[] for i in range(3)]
+    for i, stream in enumerate(streams):
+        stream.configure_mock(data=b"a" * i)
+        stream.ended.return_value = False
+        ticker.track(stream, lambda pos, ended, i=i: positions[i].append(pos))
+
+    await asyncio.sleep(0.5)
+    assert positions == [[0], [1], [2]]
+    streams[0].ended.return_value = True
+    await asyncio.sleep(1)
+    assert positions == [[0, 0], [1, 1], [2, 2]]
+    assert len(ticker) == 2
+
+    for stream in streams:
+        stream.ended.return_value = True
+    await asyncio.sleep(1)
+    assert len(ticker) == 0
+    # Ticker stops when there's nothing to track, and restarts when needed
+    await asyncio.sleep(2)
+    assert positions == [[0, 0], [1, 1, 1], [2, 2, 2]]
+    ticker.track(streams[0], lambda pos, ended: positions[0].append(pos))
+    await asyncio.sleep(0.5)
+    assert positions[0] == [0, 0, 0]
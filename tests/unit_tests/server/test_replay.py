@@ -4,13 +4,13 @@ import asyncio
 from asynctest.helpers import exhaust_callbacks
 
 from tests import timeout, fast_forward_time
-from replayserver.server.replay import Replay
+from replayserver.server.replay import Replay, ReplayState
 from replayserver.server.connection import ConnectionHeader
 from replayserver.errors import MalformedDataError
 
 
 @pytest.fixture
-def mock_merger(locked_mock_coroutines):
+def mock_merger(manual_end_callbacks):
     class M:
         canonical_stream = None
 
@@ -20,16 +20,16 @@ def mock_merger(locked_mock_coroutines):
         def close():
             pass
 
-        async def wait_for_ended():
+        def add_end_callback():
             pass
 
-    replay_end, ended_wait = locked_mock_coroutines()
+    replay_end, add_callback = manual_end_callbacks()
     return asynctest.Mock(spec=M, _manual_end=replay_end,
-                          wait_for_ended=ended_wait)
+                          add_end_callback=add_callback)
 
 
 @pytest.fixture
-def mock_sender(locked_mock_coroutines):
+def mock_sender(manual_end_callbacks):
     class S:
         async def handle_connection():
             pass
@@ -37,12 +37,12 @@ def mock_sender(locked_mock_coroutines):
         def close():
             pass
 
-        async def wait_for_ended():
+        def add_end_callback():
             pass
 
-    replay_end, ended_wait = locked_mock_coroutines()
+    replay_end, add_callback = manual_end_callbacks()
     return asynctest.Mock(spec=S, _manual_end=replay_end,
-                          wait_for_ended=ended_wait)
+                          add_end_callback=add_callback)
 
 
 @pytest.mark.asyncio
@@ -131,9 +131,10 @@ async def test_replay_keeps_proper_event_order(
 
     async def bookkeeper_check(*args, **kwargs):
         # Merging has to end before bookkeeping starts
-        mock_merger.wait_for_ended.assert_awaited()
+        assert mock_merger._manual_end.is_set()
+        assert replay.state == ReplayState.SAVING
         # We shall not wait for stream sending to end before bookkeeping
-        mock_sender.wait_for_ended.assert_not_awaited()
+        mock_sender.add_end_callback.assert_not_called()
         return
 
     mock_bookkeeper.save_replay.side_effect = bookkeeper_check
@@ -145,3 +146,30 @@ async def test_replay_keeps_proper_event_order(
     await exhaust_callbacks(event_loop)
     mock_sender._manual_end.set()
     await replay.wait_for_ended()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_replay_goes_through_states(
+        event_loop, mock_merger, mock_sender, mock_bookkeeper):
+    save_end = asyncio.Event()
+
+    async def wait_for_save(*args, **kwargs):
+        await save_end.wait()
+
+    mock_bookkeeper.save_replay.side_effect = wait_for_save
+
+    replay = Replay(mock_merger, mock_sender, mock_bookkeeper, 15, 1)
+    assert replay.state == ReplayState.WRITING
+    mock_sender._manual_end.set()
+    await exhaust_callbacks(event_loop)
+    assert replay.state == ReplayState.WRITING
+
+    mock_merger._manual_end.set()
+    await exhaust_callbacks(event_loop)
+    assert replay.state == ReplayState.SAVING
+
+    save_end.set()
+    await replay.wait_for_ended()
+    assert replay.state == ReplayState.ENDED
+    mock_merger.canonical_stream.close_data.assert_called_once()
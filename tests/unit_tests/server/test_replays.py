@@ -10,7 +10,7 @@ from replayserver.errors import CannotAcceptConnectionError
 
 
 @pytest.fixture
-def mock_replays(locked_mock_coroutines):
+def mock_replays(manual_end_callbacks):
     def build():
         class R:
             async def handle_connection():
@@ -22,12 +22,12 @@ def mock_replays(locked_mock_coroutines):
             def do_not_wait_for_more_connections():
                 pass
 
-            async def wait_for_ended():
+            def add_end_callback():
                 pass
 
-        replay_end, ended_wait = locked_mock_coroutines()
+        replay_end, add_callback = manual_end_callbacks()
         return asynctest.Mock(spec=R, _manual_end=replay_end,
-                              wait_for_ended=ended_wait)
+                              add_end_callback=add_callback)
     return build
 
 
@@ -77,7 +77,7 @@ async def test_readers_successful_connection(
 @pytest.mark.asyncio
 @timeout(1)
 async def test_replays_closing(
-        mock_replays, mock_replay_builder, mock_conn_plus_head):
+        mock_replays, mock_replay_builder, mock_conn_plus_head, event_loop):
     writer = mock_conn_plus_head(ConnectionHeader.Type.WRITER, 1)
     mock_replay = mock_replays()
     mock_replay_builder.side_effect = [mock_replay]
@@ -85,10 +85,12 @@ async def test_replays_closing(
 
     await replays.handle_connection(*writer)
     assert 1 in replays
-    mock_replay._manual_end.set()
-    await replays.stop_all()
+    f = asyncio.ensure_future(replays.stop_all())
+    await exhaust_callbacks(event_loop)
     mock_replay.close.assert_called()
-    mock_replay.wait_for_ended.assert_awaited()     # Only true if await ended
+    mock_replay._manual_end.set()
+    await f
+    mock_replay.add_end_callback.assert_called()
     assert 1 not in replays
 
 
@@ -0,0 +1,73 @@
+import pytest
+import struct
+
+from replayserver.struct.bufferread import BufferReader, NeedMoreData
+
+
+def test_buffer_reader_take():
+    buf = BufferReader(b"foobar")
+    assert buf.take(4) == b"foob"
+    assert buf.position == 4
+    assert buf.take(2) == b"ar"
+    assert buf.position == 6
+
+
+def test_buffer_reader_take_too_much():
+    buf = BufferReader(b"foobar")
+    buf.take(4)
+    with pytest.raises(NeedMoreData) as e:
+        buf.take(3)
+    assert e.value.needed == 7
+    assert buf.position == 4
+
+
+def test_buffer_reader_unpack():
+    buf = BufferReader(b"\1\0\0\0\2\0")
+    assert buf.unpack(struct.Struct("<I")) == 1
+    with pytest.raises(NeedMoreData) as e:
+        buf.unpack(struct.Struct("<I"))
+    assert e.value.needed == 8
+
+
+def test_buffer_reader_take_until():
+    buf = BufferReader(b"foo\0bar")
+    assert buf.take_until(b"\0") == b"foo\0"
+    with pytest.raises(NeedMoreData) as e:
+        buf.take_until(b"\0")
+    assert e.value.needed == 8
+    assert buf.position == 4
+
+
+def test_buffer_reader_take_until_resumes_scan():
+    scanned = {}
+    data = bytearray(b"foo")
+    buf = BufferReader(data, scanned=scanned)
+    with pytest.raises(NeedMoreData):
+        buf.take_until(b"\0")
+    buf.release()
+    assert scanned == {0: 3}
+
+    data += b"bar\0"
+    buf = BufferReader(data, scanned=scanned)
+    assert buf.take_until(b"\0") == b"foobar\0"
+    buf.release()
+
+
+def test_buffer_reader_maxlen():
+    buf = BufferReader(b"foobar", 4)
+    with pytest.raises(ValueError):
+        buf.take(5)
+    with pytest.raises(ValueError):
+        buf.take_until(b"r")
+
+    buf = BufferReader(b"foob", 4)
+    with pytest.raises(ValueError):
+        buf.take_until(b"\0")
+
+
+def test_buffer_reader_release():
+    data = bytearray(b"foo")
+    buf = BufferReader(data)
+    buf.take(1)
+    buf.release()
+    data += b"bar"
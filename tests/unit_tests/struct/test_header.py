@@ -277,16 +277,88 @@ def test_load_example_header():
     assert v.value.value == PARSED_HEADER
 
 
+def test_parse_example_header():
+    result, length = header.parse_header(bytes(example_replay.data))
+    assert result == PARSED_HEADER
+    assert length == example_replay.header_size
+
+
+def test_parse_incomplete_header():
+    data = bytes(example_replay.header_data)
+    for i in range(0, len(data)):
+        result, needed = header.parse_header(data[:i])
+        assert result is None
+        assert i < needed <= len(data)
+
+
+def test_parse_header_in_chunks_resumes_scans():
+    data = bytes(example_replay.header_data)
+    scanned = {}
+    for i in range(0, len(data)):
+        result, needed = header.parse_header(data[:i], scanned=scanned)
+        assert result is None
+        # Nothing is ever searched past what we had
+        assert all(end <= i for end in scanned.values())
+    result, length = header.parse_header(data, scanned=scanned)
+    assert result == PARSED_HEADER
+    assert length == len(data)
+
+
+def test_parse_invalid_header():
+    with pytest.raises(ValueError):
+        header.parse_header(b"\0" * 100)
+
+
+def test_parse_header_maxlen():
+    with pytest.raises(ValueError):
+        header.parse_header(bytes(example_replay.data), 1000)
+
+
+def test_parse_lua_values_same_as_generator():
+    values = [b"\2", b"\3\x17", b"\3\0", b"\1aaaaa\0",
+              b"\0" + struct.pack("<f", 2.375),
+              b"\4\1a\0\1b\0\5", b"\4\2\4\1a\0\4\5\5\5"]
+    for data in values:
+        with pytest.raises(StopIteration) as v:
+            run_cor(header.read_lua_value, data)
+        buf = header.BufferReader(data)
+        assert header.parse_lua_value(buf) == v.value.value
+        assert buf.position == len(data)
+
+
+@pytest.mark.parametrize("data", [b"\4\4\5\2\5", b"\5\4",
+                                  b"\4\1a\0\1b\0\1c\0\5", b"\1aaaa\xc0 \0"])
+def test_parse_invalid_lua_values(data):
+    with pytest.raises(ValueError):
+        header.parse_lua_value(header.BufferReader(data))
+
+
+parsers = [header.HeaderParser.GENERATOR, header.HeaderParser.BUFFER]
+
+
 @pytest.mark.asyncio
-async def test_replayheader_coroutine(controlled_connections):
+@pytest.mark.parametrize("parser", parsers)
+async def test_replayheader_coroutine(controlled_connections, parser):
     conn = controlled_connections(example_replay.data)
-    head, leftovers = await header.ReplayHeader.from_connection(conn)
+    head, leftovers = await header.ReplayHeader.from_connection(
+        conn, parser=parser)
     assert head.struct == PARSED_HEADER
     assert example_replay.data.startswith(head.data + leftovers)
 
 
 @pytest.mark.asyncio
-async def test_replayheader_coroutine_invalid_header(controlled_connections):
+@pytest.mark.parametrize("parser", parsers)
+async def test_replayheader_coroutine_invalid_header(controlled_connections,
+                                                     parser):
     conn = controlled_connections(b"\0" * 100)
     with pytest.raises(MalformedDataError):
-        await header.ReplayHeader.from_connection(conn)
+        await header.ReplayHeader.from_connection(conn, parser=parser)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("parser", parsers)
+async def test_replayheader_coroutine_premature_end(controlled_connections,
+                                                    parser):
+    conn = controlled_connections(example_replay.header_data[:-1])
+    with pytest.raises(MalformedDataError):
+        await header.ReplayHeader.from_connection(conn, parser=parser)
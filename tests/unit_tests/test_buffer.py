@@ -0,0 +1,192 @@
+import pytest
+
+from replayserver.buffer import ChunkedBuffer, SpilledBuffer, chunks_equal
+
+
+def build_buffer(*chunks):
+    buf = ChunkedBuffer()
+    for chunk in chunks:
+        buf += chunk
+    return buf
+
+
+def test_buffer_empty():
+    buf = ChunkedBuffer()
+    assert len(buf) == 0
+    assert buf.bytes() == b""
+    assert buf[0:10] == b""
+    assert list(buf.chunks()) == []
+
+
+def test_buffer_append_and_length():
+    buf = build_buffer(b"Lorem", bytearray(b" "), b"", b"ipsum")
+    assert len(buf) == 11
+    assert buf.bytes() == b"Lorem ipsum"
+    assert bytes(buf) == b"Lorem ipsum"
+
+
+def test_buffer_does_not_share_mutable_data():
+    data = bytearray(b"abc")
+    buf = build_buffer(data, memoryview(data))
+    data[0:1] = b"x"
+    assert buf.bytes() == b"abcabc"
+
+
+def test_buffer_shares_immutable_data():
+    data = b"abc"
+    view = memoryview(data)[1:]
+    buf = build_buffer(data, view)
+    assert buf._chunks[0] is data
+    assert buf._chunks[1] is view
+
+
+@pytest.mark.parametrize("s", [
+    slice(0, 11), slice(2, 9), slice(5, 6), slice(0, 5), slice(5, None),
+    slice(None, 3), slice(-4, None), slice(3, 2), slice(0, 100),
+    slice(1, 10, 3),
+])
+def test_buffer_slicing_across_chunks(s):
+    buf = build_buffer(b"Lo", b"rem", b" ", b"ips", b"um")
+    assert buf[s] == b"Lorem ipsum"[s]
+
+
+def test_buffer_only_supports_slices():
+    buf = build_buffer(b"abc")
+    with pytest.raises(ValueError):
+        buf[1]
+
+
+def test_buffer_chunks_are_not_copied():
+    first, second = b"Lorem ", b"ipsum"
+    buf = build_buffer(first, second)
+    chunks = list(buf.chunks())
+    assert chunks[0] is first
+    assert chunks[1] is second
+
+    chunks = list(buf.chunks(3, 8))
+    assert [bytes(c) for c in chunks] == [b"em ", b"ip"]
+    assert chunks[0].obj is first
+    assert chunks[1].obj is second
+
+
+def test_buffer_share_prefix():
+    base = build_buffer(b"Lorem ipsum dolor")
+    buf = build_buffer(b"Lo", b"rem", b" ", b"ips", b"um")
+    buf.share_prefix(base, 8)
+    assert buf._chunks == [b"ips", b"um"]
+    assert len(buf) == 11
+    for i in range(12):
+        for j in range(i, 12):
+            assert buf[i:j] == b"Lorem ipsum"[i:j]
+    assert buf.bytes() == b"Lorem ipsum"
+
+    buf += b" sit"
+    buf.share_prefix(base, 2)    # Sharing less than before does nothing
+    buf.share_prefix(base, 11)
+    assert buf._chunks == [b" sit"]
+    assert buf.bytes() == b"Lorem ipsum sit"
+
+
+def test_buffer_share_everything():
+    base = build_buffer(b"Lorem ipsum")
+    buf = build_buffer(b"Lorem ", b"ipsum")
+    buf.share_prefix(base, 11)
+    assert buf._chunks == []
+    assert buf.bytes() == b"Lorem ipsum"
+    buf += b" dolor"
+    assert buf.bytes() == b"Lorem ipsum dolor"
+    assert buf[9:13] == b"um d"
+
+
+def test_buffer_cannot_share_more_than_it_has():
+    base = build_buffer(b"Lorem ipsum")
+    buf = build_buffer(b"Lorem")
+    with pytest.raises(ValueError):
+        buf.share_prefix(base, 6)
+
+
+def test_buffer_discard():
+    base = build_buffer(b"Lorem ipsum")
+    buf = build_buffer(b"Lorem ", b"ipsum", b" dolor")
+    buf.share_prefix(base, 6)
+    assert buf.discard() == 11
+    assert buf.discarded
+    assert len(buf) == 17
+    buf += b" sit"
+    assert len(buf) == 21
+    assert buf._chunks == []
+    assert buf[21:] == b""
+    with pytest.raises(ValueError):
+        buf[0:1]
+    with pytest.raises(ValueError):
+        buf.bytes()
+
+
+def test_spilled_buffer(tmpdir):
+    buf = SpilledBuffer(str(tmpdir), 8, 16)
+    data = b"".join(bytes([i]) * 5 for i in range(20))
+    for pos in range(0, len(data), 5):
+        buf += data[pos:pos + 5]
+        assert len(buf) == pos + 5
+        assert buf.bytes() == data[:pos + 5]
+
+    assert len(buf._segments) == 6
+    assert buf._cold_length == 92
+    # Only hot window (plus what's left of the partially spilled chunk)
+    # stays in memory
+    assert sum(len(c) for c in buf._hot._chunks) == 10
+
+    for i in range(0, 101, 3):
+        for j in range(i, 101, 7):
+            assert buf[i:j] == data[i:j]
+    assert b"".join(buf.chunks(3, 97)) == data[3:97]
+
+
+def test_spilled_buffer_keeps_data_if_spilling_fails(tmpdir):
+    buf = SpilledBuffer(str(tmpdir.join("nonexistent")), 2, 16)
+    buf += b"Lorem "
+    buf += b"ipsum"
+    assert buf.bytes() == b"Lorem ipsum"
+    assert buf._segments == []
+
+
+def test_spilled_buffer_close(tmpdir):
+    buf = SpilledBuffer(str(tmpdir), 4, 4)
+    buf += b"Lorem ipsum dolor"
+    segments = list(buf._segments)
+    view = segments[0].view(0, 4)
+    buf.close()
+    assert all(segment._file.closed for segment in segments)
+    # A map someone still looks at stays readable until they let go
+    assert view == b"Lore"
+    assert all(segment._map.closed for segment in segments[1:])
+
+    buf += b" sit amet"
+    assert len(buf._segments) == len(segments)
+
+
+def test_buffer_shared_with_spilled_buffer(tmpdir):
+    base = SpilledBuffer(str(tmpdir), 4, 4)
+    base += b"Lorem ipsum dolor"
+    buf = build_buffer(b"Lorem ipsum", b" sit")
+    buf.share_prefix(base, 11)
+    assert buf.bytes() == b"Lorem ipsum sit"
+    assert buf[5:13] == b" ipsum s"
+
+
+@pytest.mark.parametrize("chunks1, chunks2, equal", [
+    ([], [], True),
+    ([b"Lorem ipsum"], [b"Lorem", b" ", b"ipsum"], True),
+    ([b"Lo", b"rem ip", b"sum"], [b"Lorem", b" ", b"ipsum"], True),
+    ([b"Lorem ipsum"], [b"Lorem", b" ", b"ipsun"], False),
+    ([b"Lorem"], [b"Lorem", b" "], False),
+    ([memoryview(b"Lorem")[1:]], [b"orem"], True),
+])
+def test_chunks_equal(chunks1, chunks2, equal):
+    assert chunks_equal(chunks1, chunks2) == equal
+    assert chunks_equal(chunks2, chunks1) == equal
+
+
+def test_chunks_equal_skips_empty_chunks():
+    assert chunks_equal([b"a", b"", b"b"], [b"ab", b""])
+    assert not chunks_equal([b"a", b""], [b"ab"])
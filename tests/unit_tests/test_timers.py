@@ -0,0 +1,112 @@
+import pytest
+import asyncio
+from tests import fast_forward_time, timeout
+
+from replayserver.timers import TimerWheel, get_timer_wheel
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.5, 100)
+@timeout(50)
+async def test_timers_fire_in_order(event_loop):
+    wheel = TimerWheel(tick=0.1, slots=4, levels=2)
+    fired = []
+    start = event_loop.time()
+
+    def fire(delay):
+        assert event_loop.time() - start >= delay
+        assert event_loop.time() - start <= delay + 0.6
+        fired.append(delay)
+
+    # Some fit in lowest level, some need cascading, some overflow
+    delays = [0.05, 0.3, 0.35, 1, 1.55, 2.5, 7, 7.01, 30]
+    for delay in reversed(delays):
+        wheel.call_later(delay, fire, delay)
+    assert len(wheel) == len(delays)
+    await asyncio.sleep(31)
+    assert fired == delays
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.5, 100)
+@timeout(50)
+async def test_timers_cancel(event_loop):
+    wheel = TimerWheel(tick=0.1, slots=4, levels=2)
+    fired = []
+    handles = [wheel.call_later(delay, fired.append, delay)
+               for delay in [0.5, 1, 10]]
+    handles[1].cancel()
+    handles[2].cancel()
+    assert handles[1].cancelled()
+    assert len(wheel) == 1
+    await asyncio.sleep(11)
+    assert fired == [0.5]
+    assert not handles[0].cancelled()
+    handles[0].cancel()     # No-op after firing
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.5, 100)
+@timeout(50)
+async def test_timers_scheduled_from_callbacks(event_loop):
+    wheel = TimerWheel(tick=0.1, slots=4, levels=2)
+    fired = []
+
+    def reschedule(count):
+        fired.append(event_loop.time())
+        if count > 0:
+            wheel.call_later(1, reschedule, count - 1)
+
+    wheel.call_later(1, reschedule, 5)
+    await asyncio.sleep(20)
+    assert len(fired) == 6
+    # Wheel went idle, then starts again
+    wheel.call_later(1, fired.append, None)
+    await asyncio.sleep(2)
+    assert fired[-1] is None
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.5, 100)
+@timeout(50)
+async def test_timer_wheel_timeout(event_loop):
+    wheel = TimerWheel(tick=0.1)
+    with pytest.raises(asyncio.TimeoutError):
+        with wheel.timeout(1):
+            await asyncio.sleep(2)
+    with wheel.timeout(2):
+        await asyncio.sleep(1)
+    await asyncio.sleep(2)      # Timer was cancelled, we won't get cancelled
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_timer_wheel_timeout_does_not_swallow_cancel(event_loop):
+    wheel = TimerWheel()
+
+    async def wait():
+        with wheel.timeout(10):
+            await asyncio.sleep(10)
+
+    f = asyncio.ensure_future(wait())
+    await asyncio.sleep(0.01)
+    f.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await f
+    assert len(wheel) == 0
+
+
+def test_timer_wheel_per_loop():
+    async def get_wheel():
+        return get_timer_wheel()
+
+    loop = asyncio.new_event_loop()
+    try:
+        wheel = loop.run_until_complete(get_wheel())
+    finally:
+        loop.close()
+    assert get_timer_wheel() is get_timer_wheel()
+    assert get_timer_wheel() is not wheel